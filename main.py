@@ -2,7 +2,8 @@
 import argparse
 
 from utils.train import train
-from utils.evaluation import evaluate, predict_from_stdin
+from utils.evaluation import evaluate, predict_from_stdin, export_numpy, quantization_report, \
+    analysis_pruning_report
 
 import sys
 
@@ -15,6 +16,9 @@ if __name__ == "__main__":
     parser.add_argument("--command", default="train", choices=["train",
                                                                "evaluate",
                                                                "predict_stdin",
+                                                               "export_numpy",
+                                                               "quantization_report",
+                                                               "analysis_pruning_report",
                                                                "webapp"])
 
     args = parser.parse_args(backup_sys_argv[1:3])
@@ -26,6 +30,12 @@ if __name__ == "__main__":
         evaluate(sys_argv_to_be_transferred)
     elif args.command == "predict_stdin":
         predict_from_stdin(sys_argv_to_be_transferred)
+    elif args.command == "export_numpy":
+        export_numpy(sys_argv_to_be_transferred)
+    elif args.command == "quantization_report":
+        quantization_report(sys_argv_to_be_transferred)
+    elif args.command == "analysis_pruning_report":
+        analysis_pruning_report(sys_argv_to_be_transferred)
     elif args.command == "webapp":
         from web.api.webapp import start_webapp
         start_webapp(sys_argv_to_be_transferred)
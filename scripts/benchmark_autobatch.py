@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Training throughput of the batching modes for every dynet autobatch strategy and batch size.
+
+dynet reads its automatic batching strategy from the command line when it is imported, so every
+strategy is measured in its own process. The remaining arguments are the usual training arguments
+of main.py, e.g.
+
+    python scripts/benchmark_autobatch.py --strategies 0,1,2 --batch-sizes 1,8,32 -- \\
+        --train ... --dev ... --test ... --active_models 2 --integration_mode 2
+
+reports the sentences per second for the padded and the autobatch training modes.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+RESULT_PREFIX = "BENCHMARK "
+
+
+def run_worker(batch_sizes, n_batches, training_args):
+
+    from toolkit.joint_ner_and_md_model import MainTaggerModel
+    from utils import read_parameters_from_sys_argv
+    from utils.loader import prepare_datasets
+
+    opts, parameters = read_parameters_from_sys_argv([sys.argv[0]] + training_args)
+
+    # the benchmark model and its models database live in a temporary directory instead of ./models
+    model = MainTaggerModel(opts=opts, parameters=parameters, models_path=tempfile.mkdtemp())
+    data_dict, _, _, _, _, _ = prepare_datasets(model, opts, parameters)
+    model.build(training=True, **parameters)
+
+    train_data = data_dict["ner"]["train"] + data_dict["md"]["train"]
+    random.seed(0)
+    random.shuffle(train_data)
+
+    for train_batching in ["padded", "autobatch"]:
+        model.parameters['train_batching'] = train_batching
+        for batch_size in batch_sizes:
+            batches = [[train_data[(batch_idx * batch_size + idx) % len(train_data)] for idx in range(batch_size)]
+                       for batch_idx in range(n_batches + 1)]
+            for batch_idx, batch in enumerate(batches):
+                # the first batch is a warm up
+                if batch_idx == 1:
+                    start_time = time.time()
+                loss = model.get_loss(batch)
+                if loss is not None:
+                    loss.value()
+                    model.loss_anomaly_detector.check()
+                    loss.backward()
+                    model.trainer.update()
+            elapsed_time = time.time() - start_time
+            print(RESULT_PREFIX + json.dumps({"train_batching": train_batching,
+                                              "batch_size": batch_size,
+                                              "sentences_per_second": n_batches * batch_size / elapsed_time}))
+            sys.stdout.flush()
+
+
+def main():
+
+    parser = argparse.ArgumentParser("benchmark the training throughput of the dynet autobatch strategies")
+    parser.add_argument("--strategies", default="0,1,2",
+                        help="Comma separated dynet autobatch strategies, see --dynet-autobatch")
+    parser.add_argument("--batch-sizes", default="1,8,32",
+                        help="Comma separated numbers of sentences in a batch")
+    parser.add_argument("--n-batches", default=20, type=int,
+                        help="Number of timed batches for every setting")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+
+    args, training_args = parser.parse_known_args()
+    if len(training_args) > 0 and training_args[0] == "--":
+        training_args = training_args[1:]
+    batch_sizes = [int(batch_size) for batch_size in args.batch_sizes.split(",")]
+
+    if args.worker:
+        run_worker(batch_sizes, args.n_batches, training_args)
+        return
+
+    results = []
+    for strategy in args.strategies.split(","):
+        print("Measuring dynet autobatch strategy %s..." % strategy)
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--worker",
+                                          "--batch-sizes", args.batch_sizes,
+                                          "--n-batches", str(args.n_batches), "--"] +
+                                         training_args + ["--dynet-autobatch", strategy])
+        for line in output.decode("utf-8").split("\n"):
+            if line.startswith(RESULT_PREFIX):
+                result = json.loads(line[len(RESULT_PREFIX):])
+                result["strategy"] = strategy
+                results.append(result)
+
+    print("%-10s %-15s %-12s %s" % ("strategy", "train_batching", "batch_size", "sentences/sec"))
+    for result in results:
+        print("%-10s %-15s %-12d %.2f" % (result["strategy"], result["train_batching"],
+                                          result["batch_size"], result["sentences_per_second"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+MD accuracy and speed of the morpho tag sequence encoders.
+
+A model is trained for a few epochs with every encoder of --morpho_tag_encoder and evaluated on the
+MD development set. The remaining arguments are the usual training arguments of main.py, e.g.
+
+    python scripts/benchmark_morpho_tag_encoder.py --encoders bilstm,sum --n-epochs 3 -- \\
+        --train ... --dev ... --test ... --active_models 2 --integration_mode 2
+
+reports the MD accuracy and the training and tagging sentences per second of every encoder.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def measure_encoder(morpho_tag_encoder, n_epochs, training_args):
+
+    from toolkit.joint_ner_and_md_model import MainTaggerModel
+    from utils import read_parameters_from_sys_argv
+    from utils.evaluation import eval_with_specific_model
+    from utils.loader import prepare_datasets
+
+    opts, parameters = read_parameters_from_sys_argv([sys.argv[0]] + training_args)
+    opts.morpho_tag_encoder = morpho_tag_encoder
+    parameters['morpho_tag_encoder'] = morpho_tag_encoder
+
+    # every benchmark model and its models database live in a temporary directory instead of ./models
+    model = MainTaggerModel(opts=opts, parameters=parameters, models_path=tempfile.mkdtemp())
+    data_dict, _, _, _, _, _ = prepare_datasets(model, opts, parameters)
+    model.build(training=True, **parameters)
+
+    train_data = data_dict["md"]["train"]
+    batch_size = parameters['batch_size']
+    random.seed(0)
+
+    n_trained_sentences = 0
+    training_time = 0.0
+    for epoch in range(n_epochs):
+        random.shuffle(train_data)
+        start_time = time.time()
+        for batch_idx in range(0, len(train_data), batch_size):
+            loss = model.get_loss(train_data[batch_idx:batch_idx + batch_size])
+            if loss is not None:
+                loss.value()
+                model.loss_anomaly_detector.check()
+                loss.backward()
+                model.trainer.update()
+        training_time += time.time() - start_time
+        n_trained_sentences += len(train_data)
+
+    dev_data = data_dict["md"]["dev"]
+    model.clear_inference_caches()
+    start_time = time.time()
+    _, morph_accuracies, _, _ = eval_with_specific_model(model, n_epochs, {"md": {"dev": dev_data}})
+    tagging_time = time.time() - start_time
+
+    return {"morpho_tag_encoder": morpho_tag_encoder,
+            "md_accuracy": morph_accuracies["md"]["dev"],
+            "train_sentences_per_second": n_trained_sentences / training_time,
+            "tagging_sentences_per_second": len(dev_data) / tagging_time}
+
+
+def main():
+
+    parser = argparse.ArgumentParser("benchmark the MD accuracy and the speed of the morpho tag encoders")
+    parser.add_argument("--encoders", default="bilstm,sum",
+                        help="Comma separated morpho tag encoders, see --morpho_tag_encoder")
+    parser.add_argument("--n-epochs", default=3, type=int,
+                        help="Number of training epochs for every encoder")
+
+    args, training_args = parser.parse_known_args()
+    if len(training_args) > 0 and training_args[0] == "--":
+        training_args = training_args[1:]
+
+    results = []
+    for morpho_tag_encoder in args.encoders.split(","):
+        print("Measuring the %s morpho tag encoder..." % morpho_tag_encoder)
+        results.append(measure_encoder(morpho_tag_encoder, args.n_epochs, training_args))
+
+    print("%-10s %-12s %-20s %s" % ("encoder", "md_accuracy", "train sentences/sec", "tagging sentences/sec"))
+    for result in results:
+        print("%-10s %-12.4f %-20.2f %.2f" % (result["morpho_tag_encoder"], result["md_accuracy"],
+                                              result["train_sentences_per_second"],
+                                              result["tagging_sentences_per_second"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import itertools
+import unittest
+
+import numpy as np
+
+from toolkit import crf_numpy
+
+ID_TO_TAG = {0: "O", 1: "B-PER", 2: "I-PER", 3: "E-PER", 4: "S-PER", 5: "B-LOC", 6: "E-LOC"}
+N_TAGS = len(ID_TO_TAG)
+B_ID = N_TAGS
+E_ID = N_TAGS + 1
+
+
+def random_problem(rng, n_words):
+    emissions = crf_numpy.pad_emissions(rng.randn(n_words, N_TAGS))
+    transitions = rng.randn(N_TAGS + 2, N_TAGS + 2)
+    return emissions, transitions
+
+
+def path_score(emissions, transitions, path):
+    score = transitions[path[0], B_ID] + transitions[E_ID, path[-1]]
+    for t, tag_id in enumerate(path):
+        score += emissions[t, tag_id]
+        if t > 0:
+            score += transitions[tag_id, path[t - 1]]
+    return score
+
+
+def all_paths(n_words):
+    return [list(path) for path in itertools.product(range(N_TAGS), repeat=n_words)]
+
+
+def is_valid_iobes(path):
+    tags = ["O"] + [ID_TO_TAG[tag_id] for tag_id in path] + ["O"]
+    for prev_tag, next_tag in zip(tags[:-1], tags[1:]):
+        prev_prefix, prev_type = (prev_tag.split("-") + [""])[:2]
+        next_prefix, next_type = (next_tag.split("-") + [""])[:2]
+        inside = prev_prefix in ["B", "I"]
+        if next_prefix in ["I", "E"]:
+            if not inside or prev_type != next_type:
+                return False
+        elif inside:
+            return False
+    return True
+
+
+class ViterbiTest(unittest.TestCase):
+
+    def test_viterbi_decode_finds_the_best_path(self):
+        rng = np.random.RandomState(0)
+        for n_words in [1, 2, 3, 4]:
+            emissions, transitions = random_problem(rng, n_words)
+            scores = {tuple(path): path_score(emissions, transitions, path) for path in all_paths(n_words)}
+            best_path = max(scores, key=scores.get)
+            path, score = crf_numpy.viterbi_decode(emissions, transitions, B_ID, E_ID)
+            self.assertEqual(tuple(path), best_path)
+            self.assertAlmostEqual(score, scores[best_path], places=6)
+
+    def test_viterbi_nbest_lists_the_best_paths_in_order(self):
+        rng = np.random.RandomState(1)
+        k = 5
+        for n_words in [1, 2, 3, 4]:
+            emissions, transitions = random_problem(rng, n_words)
+            expected_scores = sorted([path_score(emissions, transitions, path) for path in all_paths(n_words)],
+                                     reverse=True)[:k]
+            nbest = crf_numpy.viterbi_nbest(emissions, transitions, B_ID, E_ID, k)
+            self.assertEqual(len(nbest), min(k, N_TAGS ** n_words))
+            scores = [score for _, score in nbest]
+            self.assertEqual(scores, sorted(scores, reverse=True))
+            self.assertEqual(len(set(tuple(path) for path, _ in nbest)), len(nbest))
+            for (path, score), expected_score in zip(nbest, expected_scores):
+                self.assertAlmostEqual(score, path_score(emissions, transitions, path), places=6)
+                self.assertAlmostEqual(score, expected_score, places=6)
+            # the best of the k best is the viterbi path
+            self.assertEqual(nbest[0][0], crf_numpy.viterbi_decode(emissions, transitions, B_ID, E_ID)[0])
+
+    def test_constrained_viterbi_decode_finds_the_best_valid_path(self):
+        rng = np.random.RandomState(2)
+        predecessor_index, predecessor_mask = crf_numpy.allowed_predecessors(ID_TO_TAG, B_ID, E_ID,
+                                                                             tag_scheme="iobes")
+        for n_words in [1, 2, 3, 4]:
+            emissions, transitions = random_problem(rng, n_words)
+            # favour the invalid transitions, so that the unconstrained path is likely to be invalid
+            transitions[2, 0] += 5.0
+            scores = {tuple(path): path_score(emissions, transitions, path)
+                      for path in all_paths(n_words) if is_valid_iobes(path)}
+            best_path = max(scores, key=scores.get)
+            path, score = crf_numpy.constrained_viterbi_decode(emissions, transitions, B_ID, E_ID,
+                                                               predecessor_index, predecessor_mask)
+            self.assertTrue(is_valid_iobes(path))
+            self.assertEqual(tuple(path), best_path)
+            self.assertAlmostEqual(score, scores[best_path], places=6)
+
+    def test_constrained_viterbi_nbest_paths_are_valid(self):
+        rng = np.random.RandomState(3)
+        predecessor_index, predecessor_mask = crf_numpy.allowed_predecessors(ID_TO_TAG, B_ID, E_ID,
+                                                                             tag_scheme="iobes")
+        for n_words in [1, 2, 3, 4]:
+            emissions, transitions = random_problem(rng, n_words)
+            masked_transitions = crf_numpy.mask_transitions(transitions, predecessor_index, predecessor_mask)
+            nbest = crf_numpy.viterbi_nbest(emissions, masked_transitions, B_ID, E_ID, 4)
+            self.assertTrue(len(nbest) > 0)
+            for path, _ in nbest:
+                self.assertTrue(is_valid_iobes(path))
+
+
+class ForwardBackwardTest(unittest.TestCase):
+
+    def test_marginals_match_the_enumeration_and_sum_to_one(self):
+        rng = np.random.RandomState(4)
+        tag_to_id = {tag: tag_id for tag_id, tag in ID_TO_TAG.items()}
+        for n_words in [1, 2, 3, 4]:
+            emissions, transitions = random_problem(rng, n_words)
+            paths = all_paths(n_words)
+            scores = np.array([path_score(emissions, transitions, path) for path in paths])
+            log_partition = crf_numpy.log_sum_exp(scores)
+            probs = np.exp(scores - log_partition)
+            expected_posteriors = np.zeros((n_words, N_TAGS))
+            for path, prob in zip(paths, probs):
+                expected_posteriors[np.arange(n_words), path] += prob
+
+            marginals = crf_numpy.CRFMarginals(emissions, transitions, B_ID, E_ID, tag_to_id)
+            self.assertAlmostEqual(marginals.log_partition, log_partition, places=6)
+            posteriors = marginals.tag_posteriors()
+            self.assertTrue(np.allclose(posteriors.sum(axis=1), 1.0))
+            self.assertTrue(np.allclose(posteriors, expected_posteriors))
+
+            # the probability of a segment is the total probability of the paths which contain it
+            segment = [1, 3] if n_words >= 2 else [4]
+            expected_segment_prob = sum([prob for path, prob in zip(paths, probs) if path[:len(segment)] == segment])
+            self.assertAlmostEqual(marginals.segment_prob(0, segment), expected_segment_prob, places=6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from utils.dynetsaver import dequantize_rows, is_int8_lookup_parameter_name, quantize_rows
+
+try:
+    import dynet
+except ImportError:
+    dynet = None
+
+
+class QuantizeRowsTest(unittest.TestCase):
+
+    def test_round_trip_error_is_within_half_a_step_of_every_row(self):
+        rng = np.random.RandomState(0)
+        matrix = rng.randn(50, 20).astype(np.float32) * rng.uniform(0.01, 10.0, size=(50, 1)).astype(np.float32)
+        quantized, scales = quantize_rows(matrix)
+        self.assertEqual(quantized.dtype, np.int8)
+        self.assertEqual(scales.dtype, np.float32)
+        errors = np.abs(dequantize_rows(quantized, scales) - matrix)
+        # the rounding error is at most half of the quantization step, i.e. max(|row|) / 254
+        bounds = np.max(np.abs(matrix), axis=1) / 254.0
+        self.assertTrue(np.all(errors <= bounds[:, np.newaxis] * (1 + 1e-5)))
+
+    def test_largest_magnitude_of_every_row_is_exact(self):
+        matrix = np.array([[0.5, -2.0, 1.0], [3.0, 0.0, -1.5]], dtype=np.float32)
+        quantized, scales = quantize_rows(matrix)
+        self.assertEqual(list(np.max(np.abs(quantized), axis=1)), [127, 127])
+        restored = dequantize_rows(quantized, scales)
+        self.assertAlmostEqual(restored[0, 1], -2.0, places=6)
+        self.assertAlmostEqual(restored[1, 0], 3.0, places=6)
+
+    def test_zero_rows_are_restored_as_zeros(self):
+        matrix = np.zeros((3, 4), dtype=np.float32)
+        quantized, scales = quantize_rows(matrix)
+        self.assertTrue(np.all(dequantize_rows(quantized, scales) == 0))
+
+
+class Int8LookupParameterNameTest(unittest.TestCase):
+
+    def test_only_the_embedding_tables_are_int8(self):
+        self.assertTrue(is_int8_lookup_parameter_name("/wordembeddings"))
+        self.assertTrue(is_int8_lookup_parameter_name("/charembeddings"))
+        self.assertTrue(is_int8_lookup_parameter_name("/charembeddings_1"))
+        self.assertFalse(is_int8_lookup_parameter_name("/capembeddings"))
+        self.assertFalse(is_int8_lookup_parameter_name("/_0"))
+        self.assertFalse(is_int8_lookup_parameter_name("/_3"))
+
+
+@unittest.skipIf(dynet is None, "dynet is not installed")
+class RestoreQuantizedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def build(self):
+        model = dynet.ParameterCollection()
+        embeddings = model.add_lookup_parameters((30, 8), name="charembeddings")
+        transitions = model.add_lookup_parameters((5, 5))
+        W = model.add_parameters((4, 8))
+        return model, embeddings, transitions, W
+
+    def test_round_trip(self):
+        from utils.dynetsaver import restore_quantized, save_quantized
+
+        model, embeddings, transitions, W = self.build()
+        filepath = os.path.join(self.tmp_dir, "model.quantized.npz")
+        save_quantized(model, filepath)
+
+        restored_model, restored_embeddings, restored_transitions, restored_W = self.build()
+        restore_quantized(restored_model, filepath)
+
+        original = embeddings.as_array()
+        bounds = np.max(np.abs(original), axis=1) / 254.0
+        self.assertTrue(np.all(np.abs(restored_embeddings.as_array() - original) <= bounds[:, np.newaxis] * (1 + 1e-5)))
+        # the other lookup tables are not rounded
+        self.assertTrue(np.array_equal(restored_transitions.as_array(), transitions.as_array()))
+        self.assertTrue(np.allclose(restored_W.as_array(), W.as_array(), rtol=1e-3, atol=1e-3))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+# coding=utf-8
+import codecs
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zlib
+
+import numpy as np
+
+from utils.embedding_store import EmbeddingStore, PagedEmbeddings, PRETRAINED_EMBEDDING_FALLBACKS
+
+
+def write_embeddings(filepath, lines):
+    with codecs.open(filepath, "w", "utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def words_in_slot(slot, mask, n):
+    """
+    The first n words of the form w<i> which hash to the given slot of a table of mask+1 slots.
+    """
+    words = []
+    idx = 0
+    while len(words) < n:
+        word = "w%d" % idx
+        if zlib.crc32(word.encode("utf-8")) & mask == slot:
+            words.append(word)
+        idx += 1
+    return words
+
+
+class EmbeddingStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.emb_path = os.path.join(self.tmp_dir, "embeddings.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_build_and_lookup(self):
+        write_embeddings(self.emb_path, ["ankara 1 2 3",
+                                         "İstanbul 4 5 6",
+                                         "bad line",
+                                         "ali 7 8 9"])
+        store = EmbeddingStore.open_or_convert(self.emb_path, 3)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.dim, 3)
+        self.assertEqual(list(store.words()), ["ankara", "İstanbul", "ali"])
+        for word, vector in [("ankara", [1, 2, 3]), ("İstanbul", [4, 5, 6]), ("ali", [7, 8, 9])]:
+            self.assertIn(word, store)
+            self.assertEqual(store.vectors[store.lookup(word)].tolist(), vector)
+
+    def test_missing_words(self):
+        write_embeddings(self.emb_path, ["ankara 1 2", "ali 3 4"])
+        store = EmbeddingStore.open_or_convert(self.emb_path, 2)
+        self.assertEqual(store.lookup("veli"), -1)
+        self.assertEqual(store.lookup(""), -1)
+        self.assertEqual(store.lookup("Ankara"), -1)
+        self.assertNotIn("veli", store)
+
+    def test_empty_store(self):
+        write_embeddings(self.emb_path, ["bad line"])
+        store = EmbeddingStore.open_or_convert(self.emb_path, 2)
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.lookup("ankara"), -1)
+
+    def test_colliding_words(self):
+        # 4 words give a table of 8 slots
+        mask = 7
+        colliding_words = words_in_slot(3, mask, 4)
+        other_word = words_in_slot(5, mask, 1)[0]
+        stored_words = colliding_words[:3] + [other_word]
+        write_embeddings(self.emb_path, ["%s %d 0" % (word, idx) for idx, word in enumerate(stored_words)])
+        store = EmbeddingStore.open_or_convert(self.emb_path, 2)
+        self.assertEqual(len(store.index), mask + 1)
+        for idx, word in enumerate(stored_words):
+            self.assertEqual(store.lookup(word), idx)
+            self.assertEqual(store.vectors[idx, 0], idx)
+        # a missing word probes the whole chain of its slot
+        self.assertEqual(store.lookup(colliding_words[3]), -1)
+
+    def test_the_last_vector_of_a_repeated_word_is_kept(self):
+        write_embeddings(self.emb_path, ["ankara 1 2", "ali 3 4", "ankara 5 6"])
+        store = EmbeddingStore.open_or_convert(self.emb_path, 2)
+        self.assertEqual(store.vectors[store.lookup("ankara")].tolist(), [5, 6])
+        self.assertEqual(store.vectors[store.lookup("ali")].tolist(), [3, 4])
+
+    def test_lookup_with_fallbacks(self):
+        write_embeddings(self.emb_path, ["ankara 1 2", "ali00 3 4"])
+        store = EmbeddingStore.open_or_convert(self.emb_path, 2)
+        self.assertEqual(store.lookup_with_fallbacks("ankara", PRETRAINED_EMBEDDING_FALLBACKS),
+                         (store.lookup("ankara"), 0))
+        self.assertEqual(store.lookup_with_fallbacks("ANKARA", PRETRAINED_EMBEDDING_FALLBACKS),
+                         (store.lookup("ankara"), 1))
+        self.assertEqual(store.lookup_with_fallbacks("Ali42", PRETRAINED_EMBEDDING_FALLBACKS),
+                         (store.lookup("ali00"), 2))
+        self.assertEqual(store.lookup_with_fallbacks("veli", PRETRAINED_EMBEDDING_FALLBACKS), (-1, -1))
+
+    def test_a_newer_text_file_is_converted_again(self):
+        write_embeddings(self.emb_path, ["ankara 1 2"])
+        EmbeddingStore.open_or_convert(self.emb_path, 2)
+        write_embeddings(self.emb_path, ["ali 3 4"])
+        index_path = os.path.join(EmbeddingStore.default_store_path(self.emb_path), "index.npy")
+        os.utime(self.emb_path, (time.time() + 10, os.path.getmtime(index_path) + 10))
+        store = EmbeddingStore.open_or_convert(self.emb_path, 2)
+        self.assertEqual(store.lookup("ankara"), -1)
+        self.assertEqual(store.vectors[store.lookup("ali")].tolist(), [3, 4])
+
+
+class PagedEmbeddingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmp_dir, "word_embeddings.npy")
+        self.table = np.arange(40, dtype=np.float32).reshape(10, 4)
+        np.save(self.filepath, self.table)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lookups(self):
+        for cache_size in [0, 2, 1024]:
+            embeddings = PagedEmbeddings(self.filepath, cache_size=cache_size)
+            self.assertEqual(len(embeddings), 10)
+            self.assertTrue(np.array_equal(embeddings[3], self.table[3]))
+            ids = np.array([[1, 3, 1], [9, 0, 3]])
+            self.assertTrue(np.array_equal(embeddings[ids], self.table[ids]))
+            self.assertTrue(np.array_equal(embeddings[[5, 5]], self.table[[5, 5]]))
+
+    def test_empty_lookup(self):
+        embeddings = PagedEmbeddings(self.filepath)
+        rows = embeddings[np.zeros((0, 2), dtype=np.int64)]
+        self.assertEqual(rows.shape, (0, 2, 4))
+        self.assertEqual(rows.dtype, np.float32)
+
+
+if __name__ == "__main__":
+    unittest.main()
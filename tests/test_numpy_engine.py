@@ -0,0 +1,138 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+try:
+    import dynet
+except ImportError:
+    dynet = None
+
+ID_TO_TAG = {0: "O", 1: "B-PER", 2: "I-PER", 3: "E-PER", 4: "S-PER", 5: "B-LOC", 6: "I-LOC", 7: "E-LOC", 8: "S-LOC"}
+N_WORDS = 20
+N_CHARS = 15
+N_MORPHO_TAGS = 12
+
+MODEL_ARGS = ["--word_dim", "8", "--word_lstm_dim", "8",
+              "--char_dim", "6", "--char_lstm_dim", "6",
+              "--morpho_tag_dim", "6", "--cap_dim", "3",
+              "--active_models", "2", "--integration_mode", "2",
+              "--dropout", "0"]
+
+
+def random_sentence(rng, n_words):
+    """
+    A sentence as prepared by utils.loader.prepare_dataset, with random ids and 1 to 4 candidate analyses
+    of every word. Some words have no chars, as a word made of chars unseen in training.
+    """
+    chars = [rng.randint(0, N_CHARS, size=rng.randint(0, 7)).tolist() for _ in range(n_words)]
+    n_analyses = rng.randint(1, 5, size=n_words)
+    return {
+        'str_words': ["w%d" % idx for idx in range(n_words)],
+        'word_ids': rng.randint(0, N_WORDS, size=n_words).tolist(),
+        'char_for_ids': chars,
+        'cap_ids': rng.randint(0, 17, size=n_words).tolist(),
+        'morpho_analyzes_tags': [[rng.randint(0, N_MORPHO_TAGS, size=rng.randint(1, 5)).tolist()
+                                  for _ in range(n)] for n in n_analyses],
+        'morpho_analyzes_roots': [[rng.randint(0, N_CHARS, size=rng.randint(1, 6)).tolist()
+                                   for _ in range(n)] for n in n_analyses],
+        'char_lengths': [len(char_ids) for char_ids in chars],
+        'sentence_lengths': n_words,
+        'max_word_length_in_this_sample': max([len(char_ids) for char_ids in chars]),
+        'tag_ids': [0] * n_words,
+        'golden_morph_analysis_indices': [0] * n_words,
+    }
+
+
+@unittest.skipIf(dynet is None, "dynet is not installed")
+class NumpyTaggerTest(unittest.TestCase):
+    """
+    The NumpyTagger of an exported model should compute the scores of MainTaggerModel within tolerance
+    and tag like MainTaggerModel.predict.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def build_model(self, extra_args):
+        from toolkit.joint_ner_and_md_model import MainTaggerModel
+        from utils import read_parameters_from_sys_argv
+
+        opts, parameters = read_parameters_from_sys_argv(["main.py"] + MODEL_ARGS + extra_args)
+        model = MainTaggerModel(opts=opts, parameters=parameters, models_path=self.tmp_dir)
+        model.save_mappings({idx: "word%d" % idx for idx in range(N_WORDS)},
+                            {idx: chr(ord("a") + idx) for idx in range(N_CHARS)},
+                            ID_TO_TAG,
+                            {idx: "Tag%d" % idx for idx in range(N_MORPHO_TAGS)})
+        model.build(training=False, **parameters)
+        return model
+
+    def assert_same_predictions(self, extra_args):
+        from toolkit.numpy_engine import NumpyTagger
+
+        model = self.build_model(extra_args)
+        bundle_path = os.path.join(self.tmp_dir, "model.npz")
+        model.export_numpy(bundle_path)
+        numpy_tagger = NumpyTagger.load(bundle_path)
+
+        rng = np.random.RandomState(0)
+        for n_words in [1, 3, 6, 10]:
+            sentence = random_sentence(rng, n_words)
+
+            dynet.renew_cg()
+            context_representations_for_ner_loss, context_representations_for_md_loss = \
+                model.get_context_representations(sentence, training=False)
+            last_layer_context_representations, _, _ = \
+                model.get_last_layer_context_representations(sentence,
+                                                             context_representations_for_ner_loss,
+                                                             context_representations_for_md_loss)
+            tag_scores = np.stack([np.reshape(tag_score.npvalue(), (-1,))
+                                   for tag_score in model.calculate_tag_scores(last_layer_context_representations)])
+            morph_analysis_representations = [np.stack([np.reshape(representation.npvalue(), (-1,))
+                                                        for representation in representations_for_word])
+                                              for representations_for_word in
+                                              model.get_morph_analysis_representations(sentence)]
+
+            numpy_tag_scores, _ = numpy_tagger.calculate_tag_scores(sentence)
+            numpy_morph_analysis_representations = numpy_tagger.get_morph_analysis_representations(sentence)
+            self.assertEqual(numpy_tag_scores.shape, tag_scores.shape)
+            self.assertTrue(np.allclose(numpy_tag_scores, tag_scores, atol=1e-4))
+            for numpy_representations_for_word, representations_for_word in \
+                    zip(numpy_morph_analysis_representations, morph_analysis_representations):
+                self.assertTrue(np.allclose(numpy_representations_for_word, representations_for_word, atol=1e-4))
+
+            dynet.renew_cg()
+            selected_morph_analyzes, decoded_tags = model.predict(sentence)
+            numpy_selected_morph_analyzes, numpy_decoded_tags = numpy_tagger.predict(sentence)
+            self.assertEqual(list(map(int, numpy_decoded_tags)), list(map(int, decoded_tags)))
+            self.assertEqual(list(map(int, numpy_selected_morph_analyzes)), list(map(int, selected_morph_analyzes)))
+
+    def test_bilstm_encoders(self):
+        self.assert_same_predictions([])
+
+    def test_char_cnn_encoder(self):
+        self.assert_same_predictions(["--char_encoder", "cnn"])
+
+    def test_position_weighted_sum_morpho_tag_encoder(self):
+        self.assert_same_predictions(["--morpho_tag_encoder", "sum"])
+
+    def test_char_cnn_and_position_weighted_sum_encoders(self):
+        self.assert_same_predictions(["--char_encoder", "cnn", "--morpho_tag_encoder", "sum"])
+
+    def test_softmax_output_layer(self):
+        self.assert_same_predictions(["--crf", "0"])
+
+    def test_constrained_decoding(self):
+        self.assert_same_predictions(["--constrained_decoding", "1"])
+
+    def test_softmax_output_layer_with_repaired_tags(self):
+        self.assert_same_predictions(["--crf", "0", "--constrained_decoding", "1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
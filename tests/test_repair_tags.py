@@ -0,0 +1,33 @@
+import unittest
+
+from utils import repair_tag_ids, repair_tags
+
+ID_TO_TAG = {0: "O", 1: "B-PER", 2: "I-PER", 3: "E-PER", 4: "S-PER", 5: "B-LOC", 6: "I-LOC", 7: "E-LOC"}
+TAG_TO_ID = {tag: tag_id for tag_id, tag in ID_TO_TAG.items()}
+
+
+def ids(tags):
+    return [TAG_TO_ID[tag] for tag in tags]
+
+
+class RepairTagsTest(unittest.TestCase):
+
+    def test_invalid_continuations_open_a_new_entity(self):
+        self.assertEqual(repair_tags(["O", "I-PER", "E-PER", "O"]), ["O", "B-PER", "E-PER", "O"])
+        self.assertEqual(repair_tags(["E-PER", "O"]), ["S-PER", "O"])
+        self.assertEqual(repair_tags(["B-PER", "O"], tag_scheme="iob"), ["B-PER", "O"])
+
+    def test_repair_tag_ids(self):
+        self.assertEqual(repair_tag_ids(ids(["O", "I-PER", "E-PER"]), ID_TO_TAG), ids(["O", "B-PER", "E-PER"]))
+        self.assertEqual(repair_tag_ids(ids(["B-PER", "O"]), ID_TO_TAG), ids(["S-PER", "O"]))
+
+    def test_repaired_tags_unknown_to_the_model_keep_their_ids(self):
+        # there is no S-LOC tag, so a lone LOC tag can not be repaired
+        for tag in ["B-LOC", "I-LOC", "E-LOC"]:
+            self.assertEqual(repair_tag_ids(ids(["O", tag, "O"]), ID_TO_TAG), ids(["O", tag, "O"]))
+        self.assertEqual(repair_tag_ids(ids(["I-LOC", "E-LOC", "B-PER"]), ID_TO_TAG),
+                         ids(["B-LOC", "E-LOC", "S-PER"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
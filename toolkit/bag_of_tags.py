@@ -0,0 +1,57 @@
+
+import numpy as np
+
+import dynet
+
+# the positions after this one share the weights of the last position
+MAX_WEIGHTED_POSITIONS = 16
+
+
+class PositionWeightedSumEncoder(object):
+
+    def __init__(self, input_dim, output_dim, model, max_positions=MAX_WEIGHTED_POSITIONS):
+        """
+
+        This class encodes id sequences, e.g. the morpho tags of an analysis, with the sum of their
+        embeddings scaled elementwise by a learned weight vector of every position, followed by an
+        affine transformation. It has no recurrent steps, so sequences of any length take a single
+        batched pass.
+
+        @param input_dim: size of the embeddings
+        @param output_dim: size of the representations
+        @param model
+        @param max_positions: number of positions with their own weights
+        """
+        self.input_dim = input_dim
+        self.output_dim = output_dim
+        self.max_positions = max_positions
+        self.position_weights = model.add_lookup_parameters((max_positions, input_dim),
+                                                            init=dynet.ConstInitializer(1.0))
+        self.W = model.add_parameters((output_dim, input_dim))
+        self.b = model.add_parameters((output_dim))
+
+    def encode_batch(self, lookup_parameters, sequences, pad_id=0):
+        """
+        @param lookup_parameters: LookupParameters holding the embeddings of the ids
+        @param sequences: list of id lists, an empty sequence is encoded as the single id pad_id
+        @return: list of Expression, the representation of every sequence
+        """
+        if len(sequences) == 0:
+            return []
+        sequences = [sequence if len(sequence) > 0 else [pad_id] for sequence in sequences]
+        lengths = np.array([len(sequence) for sequence in sequences])
+
+        weighted_embeddings = []
+        for t in range(max(lengths)):
+            step_mask = (t < lengths).astype(np.float32)
+            embeddings = dynet.lookup_batch(lookup_parameters,
+                                            [sequence[t] if t < len(sequence) else 0 for sequence in sequences])
+            weighted_embeddings.append(
+                dynet.cmult(dynet.cmult(embeddings, self.position_weights[min(t, self.max_positions - 1)]),
+                            dynet.inputTensor(np.tile(step_mask, (self.input_dim, 1)), batched=True)))
+
+        representations = dynet.affine_transform([self.b.expr(), self.W.expr(), dynet.esum(weighted_embeddings)])
+        return [dynet.pick_batch_elem(representations, sequence_idx) for sequence_idx in range(len(sequences))]
+
+    def get_parameters(self):
+        return [self.position_weights, self.W, self.b]
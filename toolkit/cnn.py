@@ -0,0 +1,82 @@
+
+import numpy as np
+
+import dynet
+
+# widths of the convolution filters of a character encoder
+CHAR_CNN_WIDTHS = [2, 3, 4]
+
+
+class CharCNNEncoder(object):
+
+    def __init__(self, input_dim, output_dim, model, widths=CHAR_CNN_WIDTHS):
+        """
+
+        This class encodes id sequences, e.g. the characters of a word, with convolutions of several
+        widths over their embeddings followed by max pooling over the positions. Unlike an RNN, all
+        the positions of all the sequences are computed together.
+
+        @param input_dim: size of the embeddings
+        @param output_dim: size of the representations, shared by the filter widths as evenly as possible
+        @param model
+        @param widths: widths of the filters
+        """
+        assert output_dim >= len(widths)
+        self.input_dim = input_dim
+        self.output_dim = output_dim
+        self.widths = list(widths)
+        self.n_filters = [output_dim // len(widths) + (1 if idx < output_dim % len(widths) else 0)
+                          for idx in range(len(widths))]
+        # the columns [k*input_dim, (k+1)*input_dim) of a filter are multiplied by the k-th input of a window
+        self.filter_Ws = [model.add_parameters((n_filters, width * input_dim))
+                          for width, n_filters in zip(self.widths, self.n_filters)]
+        self.b = model.add_parameters((output_dim))
+
+    def encode_batch(self, lookup_parameters, sequences, pad_id=0):
+        """
+        Encodes a set of id sequences with a single batched computation.
+
+        The sequences are padded with zero vectors to the longest one. A window starts at every
+        position of a sequence which leaves room for the whole window, or at its first position if the
+        sequence is shorter than the filter, and the other windows are masked out of the max pooling.
+
+        @param lookup_parameters: LookupParameters holding the embeddings of the ids
+        @param sequences: list of id lists, an empty sequence is encoded as the single id pad_id
+        @return: list of Expression, the representation of every sequence
+        """
+        if len(sequences) == 0:
+            return []
+        sequences = [sequence if len(sequence) > 0 else [pad_id] for sequence in sequences]
+        lengths = np.array([len(sequence) for sequence in sequences])
+        max_length = int(max(lengths))
+        n_columns = max_length + max(self.widths) - 1
+
+        inputs = []
+        for t in range(n_columns):
+            step_mask = (t < lengths).astype(np.float32)
+            embeddings = dynet.lookup_batch(lookup_parameters,
+                                            [sequence[t] if t < len(sequence) else 0 for sequence in sequences])
+            inputs.append(dynet.cmult(embeddings,
+                                      dynet.inputTensor(np.tile(step_mask, (self.input_dim, 1)), batched=True)))
+        # (input_dim, n_columns) matrix for every sequence
+        X = dynet.concatenate_cols(inputs)
+
+        pooled = []
+        for width, n_filters, filter_W in zip(self.widths, self.n_filters, self.filter_Ws):
+            W = filter_W.expr()
+            # the activations at all the window positions: (n_filters, max_length) for every sequence
+            activations = dynet.esum([dynet.pick_range(W, k * self.input_dim, (k + 1) * self.input_dim, d=1) *
+                                      dynet.pick_range(X, k, k + max_length, d=1)
+                                      for k in range(width)])
+            valid_windows = np.arange(max_length)[:, np.newaxis] <= np.maximum(lengths - width, 0)[np.newaxis, :]
+            window_mask = np.where(valid_windows, 0.0, -1e10).astype(np.float32)
+            activations = activations + dynet.inputTensor(np.tile(window_mask[np.newaxis, :, :], (n_filters, 1, 1)),
+                                                          batched=True)
+            pooled.append(dynet.max_dim(activations, d=1))
+
+        # tanh is monotonic, so it is applied once after the pooling
+        representations = dynet.tanh(dynet.concatenate(pooled) + self.b.expr())
+        return [dynet.pick_batch_elem(representations, sequence_idx) for sequence_idx in range(len(sequences))]
+
+    def get_parameters(self):
+        return self.filter_Ws + [self.b]
@@ -5,10 +5,12 @@
 import dynet
 import numpy as np
 
+from toolkit import crf_numpy
+
 
 class CRF():
 
-    def __init__(self, model, id_to_tag):
+    def __init__(self, model, id_to_tag, tag_scheme="iobes"):
 
         self.id_to_tag = id_to_tag
         self.tag_to_id = {tag: id for id, tag in list(id_to_tag.items())}
@@ -20,34 +22,42 @@ class CRF():
                                                  self.n_tags+2),
                                                 name="transitions")
 
+        # legal predecessors of every tag, used by the constrained decoder
+        self.predecessor_index, self.predecessor_mask = \
+            crf_numpy.allowed_predecessors(self.id_to_tag, self.b_id, self.e_id, tag_scheme=tag_scheme)
+
     def score_sentence(self, observations, tags):
         assert len(observations) == len(tags)
-        score_seq = [0]
         score = dynet.scalarInput(0)
         tags = [self.b_id] + tags
         for i, obs in enumerate(observations):
-            # print self.b_id
-            # print self.e_id
-            # print obs.value()
-            # print tags
-            # print self.transitions
-            # print self.transitions[tags[i+1]].value()
             score = score \
                     + dynet.pick(self.transitions[tags[i + 1]], tags[i])\
                     + dynet.pick(obs, tags[i + 1])
-            score_seq.append(score.value())
         score = score + dynet.pick(self.transitions[self.e_id], tags[-1])
         return score
 
-    def viterbi_loss(self, observations, tags):
-        observations = [dynet.concatenate([obs, dynet.inputVector([-1e10, -1e10])], d=0) for obs in
-                        observations]
-        viterbi_tags, viterbi_score = self.viterbi_decoding(observations)
+    def viterbi_loss(self, observations, tags, constrained=False):
+        """
+        Structured hinge loss, i.e. the score of the best path minus the score of the golden path.
+
+        The best path is found by the NumPy decoder. When it is the golden path, there is nothing
+        to learn from this sentence and None is returned instead of a loss expression, so the
+        sentence adds nothing to the backward pass.
+
+        :param observations: list of n_tags dimensional expressions, i.e. without the <b> and <e> scores
+        :param constrained: find the best path as decode does, among the paths allowed by the tagging scheme
+        :return: the loss expression or None, and the best path
+        """
+        viterbi_tags, _ = self.decode(observations, constrained=constrained)
         if viterbi_tags != tags:
+            observations = [dynet.concatenate([obs, dynet.inputVector([-1e10, -1e10])], d=0) for obs in
+                            observations]
+            viterbi_score = self.score_sentence(observations, viterbi_tags)
             gold_score = self.score_sentence(observations, tags)
             return (viterbi_score - gold_score), viterbi_tags
         else:
-            return dynet.scalarInput(0), viterbi_tags
+            return None, viterbi_tags
 
     def neg_log_loss(self, observations, tags):
         observations = [dynet.concatenate([obs, dynet.inputVector([-1e10, -1e10])], d=0) for obs in observations]
@@ -55,34 +65,149 @@ class CRF():
         forward_score = self.forward(observations)
         return forward_score - gold_score
 
+    def neg_log_loss_batch(self, observations_batch, tags_batch):
+        """
+        Negative log likelihood of a whole minibatch.
+
+        The sentences are padded to the longest one and the emissions of every time step are
+        placed in the batch dimension, so the gold scores and the partition functions of all
+        sentences are computed by the same (batched) graph nodes. Padded time steps are masked
+        out of both.
+
+        :param observations_batch: list of sentences, each a list of n_tags dimensional expressions
+        :param tags_batch: list of gold tag id sequences, none of them empty
+        :return: an expression holding the loss of every sentence in its batch dimension
+        """
+        assert len(observations_batch) == len(tags_batch)
+        n_states = self.n_tags + 2
+        batch_size = len(observations_batch)
+        lengths = [len(observations) for observations in observations_batch]
+        max_length = max(lengths)
+
+        padding = dynet.inputVector([-1e10, -1e10])
+        blank_observation = dynet.zeros((n_states,))
+        # the i-th column of masks is 1 for the sentences which are longer than i
+        masks = (np.arange(max_length)[np.newaxis, :] < np.array(lengths)[:, np.newaxis]).astype(np.float32).T
+
+        transitions = self.transition_matrix()
+
+        init_alphas = [-1e10] * n_states
+        init_alphas[self.b_id] = 0
+        for_expr = dynet.inputVector(init_alphas)
+        gold_scores = []
+        prev_tags = [self.b_id] * batch_size
+        for t in range(max_length):
+            obs = dynet.concatenate_to_batch(
+                [dynet.concatenate([observations[t], padding]) if t < length else blank_observation
+                 for observations, length in zip(observations_batch, lengths)])
+            next_tags = [tags[t] if t < length else 0 for tags, length in zip(tags_batch, lengths)]
+
+            mask = dynet.inputTensor(np.tile(masks[t], (n_states, 1)), batched=True)
+            inverse_mask = dynet.inputTensor(np.tile(1 - masks[t], (n_states, 1)), batched=True)
+            scalar_mask = dynet.inputTensor(masks[t][np.newaxis, :], batched=True)
+
+            gold_scores.append(dynet.cmult(dynet.pick_batch(dynet.lookup_batch(self.transitions, next_tags), prev_tags)
+                                           + dynet.pick_batch(obs, next_tags),
+                                           scalar_mask))
+
+            scores = dynet.concatenate_cols([for_expr] * n_states) + transitions
+            for_expr = dynet.cmult(dynet.logsumexp_dim(scores, d=0) + obs, mask) + dynet.cmult(for_expr, inverse_mask)
+
+            prev_tags = [next_tag if t < length else prev_tag
+                         for next_tag, prev_tag, length in zip(next_tags, prev_tags, lengths)]
+
+        gold_scores.append(dynet.pick_batch(self.transitions[self.e_id], prev_tags))
+        forward_scores = dynet.logsumexp_dim(for_expr + self.transitions[self.e_id], d=0)
+        return forward_scores - dynet.esum(gold_scores)
+
+    def transition_matrix(self):
+        """
+        Arranges the transition scores as a single (n_tags+2)x(n_tags+2) expression in which
+        the entry at [prev_tag, next_tag] is the score of moving from prev_tag to next_tag.
+        """
+        return dynet.concatenate_cols([self.transitions[next_tag] for next_tag in range(self.n_tags + 2)])
+
     def forward(self, observations):
-        def log_sum_exp(scores):
-            npval = scores.npvalue()
-            argmax_score = np.argmax(npval)
-            max_score_expr = dynet.pick(scores, argmax_score)
-            max_score_expr_broadcast = dynet.concatenate([max_score_expr] * (self.n_tags+2))
-            return max_score_expr + dynet.log(
-                dynet.sum_dim(dynet.transpose(dynet.exp(scores - max_score_expr_broadcast)), [1]))
+        """
+        Computes the log partition function with the forward algorithm.
+
+        Every time step is a single broadcasted log-sum-exp over the previous tags, so the
+        recursion stays inside the computation graph and never asks for intermediate values.
+        """
+        transitions = self.transition_matrix()
 
         init_alphas = [-1e10] * (self.n_tags + 2)
         init_alphas[self.b_id] = 0
         for_expr = dynet.inputVector(init_alphas)
-        for idx, obs in enumerate(observations):
-            # print "obs: ", obs.value()
-            alphas_t = []
-            for next_tag in range(self.n_tags+2):
-                obs_broadcast = dynet.concatenate([dynet.pick(obs, next_tag)] * (self.n_tags + 2))
-                # print "for_expr: ", for_expr.value()
-                # print "transitions next_tag: ", self.transitions[next_tag].value()
-                # print "obs_broadcast: ", obs_broadcast.value()
-
-                next_tag_expr = for_expr + self.transitions[next_tag] + obs_broadcast
-                alphas_t.append(log_sum_exp(next_tag_expr))
-            for_expr = dynet.concatenate(alphas_t)
+        for obs in observations:
+            # scores[prev_tag, next_tag] = for_expr[prev_tag] + transitions[prev_tag, next_tag]
+            scores = dynet.concatenate_cols([for_expr] * (self.n_tags + 2)) + transitions
+            # the emission score does not depend on prev_tag, so it is added after the reduction
+            for_expr = dynet.logsumexp_dim(scores, d=0) + obs
         terminal_expr = for_expr + self.transitions[self.e_id]
-        alpha = log_sum_exp(terminal_expr)
+        alpha = dynet.logsumexp_dim(terminal_expr, d=0)
         return alpha
 
+    def emission_matrix(self, observations):
+        """
+        Pulls the emission scores of a sentence out of the graph with a single forward computation.
+
+        :param observations: list of n_tags dimensional expressions, i.e. without the <b> and <e> scores
+        :return: (n_words, n_tags+2) array
+        """
+        if len(observations) == 0:
+            return np.zeros((0, self.n_tags + 2))
+        tag_scores = dynet.concatenate_cols(observations).npvalue()
+        tag_scores = np.reshape(tag_scores, (self.n_tags, len(observations))).T
+        return crf_numpy.pad_emissions(tag_scores)
+
+    def decode(self, observations, constrained=False):
+        """
+        Viterbi decoding for inference. The emission scores and the transitions are copied to NumPy
+        once and the search itself does not touch the computation graph.
+
+        :param observations: list of n_tags dimensional expressions, i.e. without the <b> and <e> scores
+        :param constrained: only consider the transitions allowed by the tagging scheme
+        :return: best path and its score as a float
+        """
+        if constrained:
+            return crf_numpy.constrained_viterbi_decode(self.emission_matrix(observations),
+                                                        self.transitions.as_array(),
+                                                        self.b_id, self.e_id,
+                                                        self.predecessor_index, self.predecessor_mask)
+        return crf_numpy.viterbi_decode(self.emission_matrix(observations),
+                                        self.transitions.as_array(),
+                                        self.b_id, self.e_id)
+
+    def viterbi_nbest(self, observations, k, constrained=False):
+        """
+        Finds the k best tag sequences from a single copy of the emission scores.
+
+        :param observations: list of n_tags dimensional expressions, i.e. without the <b> and <e> scores
+        :param k: number of sequences
+        :param constrained: only consider the transitions allowed by the tagging scheme
+        :return: list of at most k (path, score) pairs, best first
+        """
+        transitions = self.transitions.as_array()
+        if constrained:
+            transitions = crf_numpy.mask_transitions(transitions, self.predecessor_index, self.predecessor_mask)
+        return crf_numpy.viterbi_nbest(self.emission_matrix(observations),
+                                       transitions,
+                                       self.b_id, self.e_id,
+                                       k)
+
+    def marginals(self, observations):
+        """
+        Runs forward-backward in NumPy over the emission scores of a sentence.
+
+        :param observations: list of n_tags dimensional expressions, i.e. without the <b> and <e> scores
+        :return: a crf_numpy.CRFMarginals giving per-token tag posteriors and span probabilities
+        """
+        return crf_numpy.CRFMarginals(self.emission_matrix(observations),
+                                      self.transitions.as_array(),
+                                      self.b_id, self.e_id,
+                                      self.tag_to_id)
+
     def viterbi_decoding(self, observations):
         debug = False
         backpointers = []
@@ -0,0 +1,298 @@
+#
+# NumPy implementations of the inference routines of toolkit.crf.CRF
+#
+# These functions work on plain arrays that are pulled out of the computation graph once per
+# sentence, so they do not depend on dynet and they never create graph nodes.
+#
+# Conventions shared with toolkit.crf.CRF:
+#   emissions: (n_words, n_tags+2) array, the last two columns belong to <b> and <e>
+#   transitions: (n_tags+2, n_tags+2) array, transitions[next_tag, prev_tag]
+#
+
+import numpy as np
+
+
+def pad_emissions(tag_scores):
+    """
+    Appends the (impossible) <b> and <e> columns to a (n_words, n_tags) score matrix.
+    """
+    tag_scores = np.asarray(tag_scores, dtype=np.float64)
+    padding = np.full((tag_scores.shape[0], 2), -1e10)
+    return np.concatenate([tag_scores, padding], axis=1)
+
+
+def viterbi_decode(emissions, transitions, b_id, e_id):
+    """
+    Finds the best tag sequence.
+
+    :param emissions: (n_words, n_tags+2) array
+    :param transitions: (n_tags+2, n_tags+2) array, transitions[next_tag, prev_tag]
+    :return: best path as a list of tag ids and its score
+    """
+    n_words, n_states = emissions.shape
+    transitions = np.asarray(transitions, dtype=np.float64)
+    if n_words == 0:
+        return [], float(transitions[e_id, b_id])
+
+    vvars = np.full(n_states, -1e10)
+    vvars[b_id] = 0
+    backpointers = np.zeros((n_words, n_states), dtype=np.int64)
+    for obs_idx in range(n_words):
+        # scores[next_tag, prev_tag]
+        scores = vvars[np.newaxis, :] + transitions
+        backpointers[obs_idx] = np.argmax(scores, axis=1)
+        vvars = scores[np.arange(n_states), backpointers[obs_idx]] + emissions[obs_idx]
+
+    terminal_scores = vvars + transitions[e_id]
+    best_tag_id = int(np.argmax(terminal_scores))
+    path_score = float(terminal_scores[best_tag_id])
+
+    best_path = [best_tag_id]
+    for obs_idx in range(n_words - 1, 0, -1):
+        best_tag_id = int(backpointers[obs_idx, best_tag_id])
+        best_path.append(best_tag_id)
+    assert backpointers[0, best_path[-1]] == b_id
+    best_path.reverse()
+    return best_path, path_score
+
+
+def allowed_predecessors(id_to_tag, b_id, e_id, tag_scheme="iobes"):
+    """
+    Builds the sparse index of legal transitions of the tagging scheme.
+
+    :return: predecessor_index and predecessor_mask, both (n_tags+2, max_n_predecessors).
+        The legal predecessors of next_tag are predecessor_index[next_tag][predecessor_mask[next_tag]].
+    """
+    n_states = len(id_to_tag) + 2
+
+    def split_tag(tag_id):
+        tag = id_to_tag[tag_id]
+        if tag == "O":
+            return "O", ""
+        tokens = tag.split("-", 1)
+        if len(tokens) != 2:
+            return None, None
+        return tokens[0], tokens[1]
+
+    def is_legal(prev_tag_id, next_tag_id):
+        if next_tag_id == b_id or prev_tag_id == e_id:
+            return False
+        if prev_tag_id == b_id and next_tag_id == e_id:
+            return False
+        prev_prefix, prev_type = split_tag(prev_tag_id) if prev_tag_id != b_id else ("O", "")
+        next_prefix, next_type = split_tag(next_tag_id) if next_tag_id != e_id else ("O", "")
+        if prev_prefix is None or next_prefix is None:
+            # we do not know the constraints of this tag
+            return True
+        if next_prefix in ["I", "E"]:
+            return prev_prefix in ["B", "I"] and prev_type == next_type
+        if tag_scheme == "iobes":
+            # O, B-*, S-* and <e> can only follow the end of an entity
+            return prev_prefix in ["O", "E", "S"]
+        return True
+
+    predecessors = [[prev_tag_id for prev_tag_id in range(n_states) if is_legal(prev_tag_id, next_tag_id)]
+                    for next_tag_id in range(n_states)]
+    max_n_predecessors = max([len(x) for x in predecessors])
+    predecessor_index = np.zeros((n_states, max_n_predecessors), dtype=np.int64)
+    predecessor_mask = np.zeros((n_states, max_n_predecessors), dtype=bool)
+    for next_tag_id, prev_tag_ids in enumerate(predecessors):
+        predecessor_index[next_tag_id, :len(prev_tag_ids)] = prev_tag_ids
+        predecessor_mask[next_tag_id, :len(prev_tag_ids)] = True
+    return predecessor_index, predecessor_mask
+
+
+def constrained_viterbi_decode(emissions, transitions, b_id, e_id, predecessor_index, predecessor_mask):
+    """
+    Viterbi search which only visits the legal predecessors of every tag, see allowed_predecessors.
+    The returned path is always well-formed.
+
+    :return: best path as a list of tag ids and its score
+    """
+    n_words, n_states = emissions.shape
+    transitions = np.asarray(transitions, dtype=np.float64)
+    rows = np.arange(n_states)
+    # transitions of the legal predecessors, -inf elsewhere
+    predecessor_transitions = np.where(predecessor_mask,
+                                       transitions[rows[:, np.newaxis], predecessor_index],
+                                       -np.inf)
+    if n_words == 0:
+        return [], float(transitions[e_id, b_id])
+
+    vvars = np.full(n_states, -np.inf)
+    vvars[b_id] = 0
+    backpointers = np.zeros((n_words, n_states), dtype=np.int64)
+    for obs_idx in range(n_words):
+        # scores[next_tag, k] is the score of coming from the k-th legal predecessor of next_tag
+        scores = vvars[predecessor_index] + predecessor_transitions
+        best_predecessors = np.argmax(scores, axis=1)
+        backpointers[obs_idx] = predecessor_index[rows, best_predecessors]
+        vvars = scores[rows, best_predecessors] + emissions[obs_idx]
+
+    terminal_scores = vvars[predecessor_index[e_id]] + predecessor_transitions[e_id]
+    best_predecessor = int(np.argmax(terminal_scores))
+    best_tag_id = int(predecessor_index[e_id, best_predecessor])
+    path_score = float(terminal_scores[best_predecessor])
+
+    best_path = [best_tag_id]
+    for obs_idx in range(n_words - 1, 0, -1):
+        best_tag_id = int(backpointers[obs_idx, best_tag_id])
+        best_path.append(best_tag_id)
+    best_path.reverse()
+    return best_path, path_score
+
+
+def mask_transitions(transitions, predecessor_index, predecessor_mask):
+    """
+    Dense version of the allowed transitions: illegal entries of the transitions matrix become -inf.
+    """
+    transitions = np.asarray(transitions, dtype=np.float64)
+    legal = np.zeros(transitions.shape, dtype=bool)
+    rows = np.repeat(np.arange(transitions.shape[0])[:, np.newaxis], predecessor_index.shape[1], axis=1)
+    legal[rows[predecessor_mask], predecessor_index[predecessor_mask]] = True
+    return np.where(legal, transitions, -np.inf)
+
+
+def viterbi_nbest(emissions, transitions, b_id, e_id, k):
+    """
+    Finds the k best tag sequences. Every (position, tag) cell keeps its k best partial paths
+    together with the tag and the rank of the partial path it extends.
+
+    :return: list of at most k (path, score) pairs, best first
+    """
+    n_words, n_states = emissions.shape
+    transitions = np.asarray(transitions, dtype=np.float64)
+    if n_words == 0:
+        return [([], float(transitions[e_id, b_id]))]
+
+    # <b> and <e> cannot be assigned to a word
+    word_tags = np.ones(n_states, dtype=bool)
+    word_tags[[b_id, e_id]] = False
+
+    # best_scores[next_tag, rank]
+    best_scores = np.full((n_states, k), -np.inf)
+    best_scores[word_tags, 0] = (transitions[:, b_id] + emissions[0])[word_tags]
+    backpointer_tags = np.zeros((n_words, n_states, k), dtype=np.int64)
+    backpointer_ranks = np.zeros((n_words, n_states, k), dtype=np.int64)
+    for obs_idx in range(1, n_words):
+        # candidates[next_tag, prev_tag * k + rank]
+        candidates = (best_scores[np.newaxis, :, :] + transitions[:, :, np.newaxis]).reshape(n_states, n_states * k)
+        best_candidates = np.argsort(-candidates, axis=1, kind="stable")[:, :k]
+        backpointer_tags[obs_idx] = best_candidates // k
+        backpointer_ranks[obs_idx] = best_candidates % k
+        best_scores = candidates[np.arange(n_states)[:, np.newaxis], best_candidates] + emissions[obs_idx][:, np.newaxis]
+        best_scores[~word_tags] = -np.inf
+
+    terminal_scores = (best_scores + transitions[e_id][:, np.newaxis]).ravel()
+    best_candidates = np.argsort(-terminal_scores, kind="stable")[:k]
+
+    nbest = []
+    for candidate in best_candidates:
+        path_score = float(terminal_scores[candidate])
+        if path_score == -np.inf:
+            break
+        tag_id, rank = int(candidate // k), int(candidate % k)
+        best_path = [tag_id]
+        for obs_idx in range(n_words - 1, 0, -1):
+            tag_id, rank = int(backpointer_tags[obs_idx, tag_id, rank]), int(backpointer_ranks[obs_idx, tag_id, rank])
+            best_path.append(tag_id)
+        best_path.reverse()
+        nbest.append((best_path, path_score))
+    return nbest
+
+
+def log_sum_exp(scores, axis=None):
+    """
+    Numerically stable log(sum(exp(scores))) along the given axis.
+    """
+    max_scores = np.max(scores, axis=axis, keepdims=True)
+    summed = np.log(np.sum(np.exp(scores - max_scores), axis=axis, keepdims=True)) + max_scores
+    if axis is None:
+        return float(summed.ravel()[0])
+    return np.squeeze(summed, axis=axis)
+
+
+def forward_backward(emissions, transitions, b_id, e_id):
+    """
+    Runs the forward and the backward recursions in log space.
+
+    :return: log_alphas and log_betas, both (n_words, n_tags+2), and the log partition function.
+        log_alphas[t, tag] includes the emission score of tag at t, log_betas[t, tag] does not.
+    """
+    n_words, n_states = emissions.shape
+    transitions = np.asarray(transitions, dtype=np.float64)
+
+    log_alphas = np.zeros((n_words, n_states))
+    log_betas = np.zeros((n_words, n_states))
+    if n_words == 0:
+        return log_alphas, log_betas, float(transitions[e_id, b_id])
+
+    log_alphas[0] = transitions[:, b_id] + emissions[0]
+    for t in range(1, n_words):
+        # scores[next_tag, prev_tag]
+        log_alphas[t] = log_sum_exp(log_alphas[t - 1][np.newaxis, :] + transitions, axis=1) + emissions[t]
+
+    log_betas[n_words - 1] = transitions[e_id]
+    for t in range(n_words - 2, -1, -1):
+        # scores[next_tag, prev_tag]
+        log_betas[t] = log_sum_exp((emissions[t + 1] + log_betas[t + 1])[:, np.newaxis] + transitions, axis=0)
+
+    log_partition = log_sum_exp(log_alphas[n_words - 1] + log_betas[n_words - 1])
+    return log_alphas, log_betas, log_partition
+
+
+class CRFMarginals(object):
+    """
+    Posterior quantities of a single sentence under the CRF, computed by forward_backward.
+    """
+
+    def __init__(self, emissions, transitions, b_id, e_id, tag_to_id):
+        self.emissions = emissions
+        self.transitions = np.asarray(transitions, dtype=np.float64)
+        self.tag_to_id = tag_to_id
+        self.n_tags = len(tag_to_id)
+        self.log_alphas, self.log_betas, self.log_partition = \
+            forward_backward(emissions, self.transitions, b_id, e_id)
+
+    def tag_posteriors(self):
+        """
+        :return: (n_words, n_tags) array, the probability of every tag at every position
+        """
+        return np.exp(self.log_alphas + self.log_betas - self.log_partition)[:, :self.n_tags]
+
+    def segment_log_prob(self, start, tag_ids):
+        """
+        Log probability that the tags starting at position start are exactly tag_ids.
+        """
+        end = start + len(tag_ids)
+        assert len(tag_ids) > 0 and 0 <= start and end <= self.emissions.shape[0]
+        score = self.log_alphas[start, tag_ids[0]]
+        for t in range(1, len(tag_ids)):
+            score += self.transitions[tag_ids[t], tag_ids[t - 1]] + self.emissions[start + t, tag_ids[t]]
+        return score + self.log_betas[end - 1, tag_ids[-1]] - self.log_partition
+
+    def segment_prob(self, start, tag_ids):
+        return np.exp(self.segment_log_prob(start, tag_ids))
+
+    def span_prob(self, start, end, entity_type):
+        """
+        Probability that the words in [start, end) form exactly one entity of the given type.
+        """
+        length = end - start
+        iobes = "S-%s" % entity_type in self.tag_to_id
+        if iobes:
+            if length == 1:
+                tags = ["S-%s" % entity_type]
+            else:
+                tags = ["B-%s" % entity_type] + ["I-%s" % entity_type] * (length - 2) + ["E-%s" % entity_type]
+        else:
+            tags = ["B-%s" % entity_type] + ["I-%s" % entity_type] * (length - 1)
+        if any(tag not in self.tag_to_id for tag in tags):
+            return 0.0
+        tag_ids = [self.tag_to_id[tag] for tag in tags]
+        prob = self.segment_prob(start, tag_ids)
+        continuation_tag = "I-%s" % entity_type
+        if not iobes and end < self.emissions.shape[0] and continuation_tag in self.tag_to_id:
+            # in the iob scheme the entity would go on if the next word were tagged I-<entity_type>
+            prob -= self.segment_prob(start, tag_ids + [self.tag_to_id[continuation_tag]])
+        return float(max(prob, 0.0))
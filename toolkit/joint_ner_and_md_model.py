@@ -1,31 +1,31 @@
 import os, sys
-import re
 import numpy as np
 
 import dynet
 from dynet import Model, BiRNNBuilder, CoupledLSTMBuilder
 
-import codecs
+import json
 import pickle
 
 import logging
 
+from toolkit import crf_numpy, numpy_engine
+from toolkit.bag_of_tags import PositionWeightedSumEncoder
+from toolkit.cnn import CharCNNEncoder
 from toolkit.crf import CRF
+from toolkit.rnn import get_final_representations_batch
 from utils.dynetsaver import DynetSaver
+from utils.diagnostics import LossAnomalyDetector
+from utils.embedding_store import EmbeddingStore, PRETRAINED_EMBEDDING_FALLBACKS
+from utils.lru_cache import LRUCache
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-from utils import get_name, create_a_model_subpath, add_a_model_path_to_the_model_paths_database
+from utils import get_name, create_a_model_subpath, add_a_model_path_to_the_model_paths_database, repair_tag_ids
 
-
-def log_sum_exp(scores):
-    npval = scores.npvalue()
-    argmax_score = np.argmax(npval)
-    max_score_expr = dynet.pick(scores, argmax_score)
-    max_score_expr_broadcast = dynet.concatenate([max_score_expr] * (npval.shape[0]))
-    return max_score_expr + dynet.log(
-        dynet.sum_dim(dynet.transpose(dynet.exp(scores - max_score_expr_broadcast)), [1]))
+# the outputs predict can compute: NER tags and the selected morphological analyses
+PREDICTION_TASKS = frozenset(["ner", "md"])
 
 
 class MainTaggerModel(object):
@@ -98,6 +98,13 @@ class MainTaggerModel(object):
                 self.opts = pickle.load(f)
             self.reload_mappings()
 
+        # char representations of the words seen at inference, keyed by their char ids
+        self.char_representation_cache = LRUCache(self.parameters.get('char_cache_size', 100000))
+        # root and morpho tag sequence representations of the analyses seen at inference
+        self.morph_analysis_cache = LRUCache(self.parameters.get('analysis_cache_size', 100000))
+        # checks the per-sentence losses of a batch after its forward computation
+        self.loss_anomaly_detector = LossAnomalyDetector(threshold=self.parameters.get('loss_anomaly_threshold', 1000.0))
+
         self.components = {}
 
     def save_mappings(self, id_to_word, id_to_char, id_to_tag, id_to_morpho_tag):
@@ -191,10 +198,73 @@ class MainTaggerModel(object):
         assert os.path.exists(path)
 
         self.saver.restore(os.path.join(path, "model.ckpt"))
+        self.clear_inference_caches()
+
+    def clear_inference_caches(self):
+        """
+        Drops the cached inference time representations, which become stale whenever the parameters change.
+        """
+        for cache in [self.char_representation_cache, self.morph_analysis_cache]:
+            if len(cache) > 0:
+                cache.clear()
+
+    def export_numpy(self, filepath):
+        """
+        Writes the parameters and the mappings of the model into a single .npz bundle, which
+        toolkit.numpy_engine.NumpyTagger loads and runs without dynet. The word embeddings are
+        written next to it as a .npy file, so that NumpyTagger can memory-map them.
+        """
+        arrays = {}
+
+        def add_coupled_lstm(prefix, builder):
+            for name, parameter in zip(numpy_engine.LSTM_PARAMETER_NAMES, builder.get_parameters()[0]):
+                arrays[prefix + "." + name] = parameter.as_array()
+
+        for builder_name in numpy_engine.BUILDER_NAMES:
+            if not hasattr(self, builder_name):
+                continue
+            builder = getattr(self, builder_name)
+            if isinstance(builder, PositionWeightedSumEncoder):
+                arrays["%s.sum.position_weights" % builder_name] = builder.position_weights.as_array()
+                arrays["%s.sum.W" % builder_name] = builder.W.as_array()
+                arrays["%s.sum.b" % builder_name] = builder.b.as_array()
+            elif isinstance(builder, CharCNNEncoder):
+                arrays["%s.cnn.widths" % builder_name] = np.array(builder.widths)
+                for width, filter_W in zip(builder.widths, builder.filter_Ws):
+                    arrays["%s.cnn.w%d.W" % (builder_name, width)] = filter_W.as_array()
+                arrays["%s.cnn.b" % builder_name] = builder.b.as_array()
+            elif isinstance(builder, BiRNNBuilder):
+                for layer_idx, (fb, bb) in enumerate(builder.builder_layers):
+                    add_coupled_lstm("%s.l%d.fw" % (builder_name, layer_idx), fb)
+                    add_coupled_lstm("%s.l%d.bw" % (builder_name, layer_idx), bb)
+            else:
+                add_coupled_lstm("%s.l0.fw" % builder_name, builder)
+
+        for parameter_name in numpy_engine.DENSE_PARAMETER_NAMES:
+            if hasattr(self, parameter_name):
+                arrays[parameter_name] = getattr(self, parameter_name).as_array()
+
+        if self.crf_module is not None:
+            arrays["crf_transitions"] = self.crf_module.transitions.as_array()
+
+        for mapping_name in numpy_engine.MAPPING_NAMES:
+            mapping = getattr(self, mapping_name)
+            arrays[mapping_name] = np.array([mapping[idx] for idx in range(len(mapping))], dtype=str)
+        arrays["parameters"] = np.array(json.dumps(self.parameters, default=str))
+
+        if "word_embeddings" in arrays:
+            np.save(numpy_engine.word_embeddings_path(filepath), arrays.pop("word_embeddings"))
+        np.savez(filepath, **arrays)
 
     def get_last_layer_context_representations(self, sentence,
                                                context_representations_for_crf_loss,
-                                               context_representations_for_md_loss):
+                                               context_representations_for_md_loss,
+                                               morph_analysis_encodings=None,
+                                               disambiguate=True):
+        """
+        :param disambiguate: select the analysis of every word even if integration_mode does not use the
+            selected analyses. The selection needs a forward computation of the analysis scores.
+        """
         last_layer_context_representations = context_representations_for_crf_loss
 
         if self.parameters['active_models'] in [1, 2, 3]:
@@ -207,17 +277,23 @@ class MainTaggerModel(object):
                 print(("str_words", sentence["str_words"]))
             morph_analysis_representations, morph_analysis_scores = \
                 self.get_morph_analysis_representations_and_scores(sentence,
-                                                                   context_representations_for_md_loss)
+                                                                   context_representations_for_md_loss,
+                                                                   morph_analysis_encodings=morph_analysis_encodings)
 
-            selected_morph_analysis_representations = \
-                self.disambiguate_morph_analyzes(morph_analysis_scores)
+            if disambiguate or self.parameters['integration_mode'] == 2:
+                selected_morph_analysis_representations = \
+                    self.disambiguate_morph_analyzes(morph_analysis_scores)
+            else:
+                selected_morph_analysis_representations = None
 
-            if 'golden_morph_analysis_indices' in list(sentence.keys()):
+            if 'golden_morph_analysis_indices' in list(sentence.keys()) and \
+                    any([golden_idx >= 0 for golden_idx in sentence['golden_morph_analysis_indices']]):
+                # a golden index of -1 marks a correct analysis which has been pruned, see --max_analyses_per_word
                 md_loss = dynet.esum(
                     [dynet.pickneglogsoftmax(morph_analysis_scores_for_word, golden_idx)
                      for golden_idx, morph_analysis_scores_for_word in
                      zip(sentence['golden_morph_analysis_indices'],
-                         morph_analysis_scores)])
+                         morph_analysis_scores) if golden_idx >= 0])
             else:
                 md_loss = dynet.scalarInput(0)
 
@@ -232,8 +308,6 @@ class MainTaggerModel(object):
                      for word_pos, (selected_morph_analysis_representation_pos, context) in
                      enumerate(
                          zip(selected_morph_analysis_representations, context_representations_for_crf_loss))]
-            if md_loss.value() > 1000:
-                logging.error("BEEP")
         else:
             # only the plain old NER model
             # we must decide whether we should implement the morphological embeddings scheme here.
@@ -257,18 +331,24 @@ class MainTaggerModel(object):
             print(("morph_analysis_representations", morph_analysis_representations))
             print(("context_representations", context_representations))
 
-        morph_analysis_scores = \
-            [dynet.softmax(
-                dynet.concatenate([dynet.dot_product(morph_analysis_representation,
-                                                     transform_context(context)) # sum + tanh for context[:half] and contet[half:]
-                                   for morph_analysis_representation in
-                                   morph_analysis_representations[word_pos]]))
-                for word_pos, context in enumerate(context_representations)]
+        morph_analysis_scores = []
+        for word_pos, context in enumerate(context_representations):
+            if len(morph_analysis_representations[word_pos]) == 1:
+                # the softmax over a single candidate is always 1
+                morph_analysis_scores.append(dynet.inputVector([1.0]))
+            else:
+                # the context is transformed once for the word and every candidate analysis is scored
+                # with a single matrix-vector product
+                morph_analysis_scores.append(dynet.softmax(
+                    dynet.transpose(dynet.concatenate_cols(morph_analysis_representations[word_pos])) *
+                    transform_context(context)))  # sum + tanh for context[:half] and contet[half:]
         return morph_analysis_scores
 
-    def get_morph_analysis_representations_and_scores(self, sentence, context_representations):
+    def get_morph_analysis_representations_and_scores(self, sentence, context_representations,
+                                                      morph_analysis_encodings=None):
 
-        morph_analysis_representations = self.get_morph_analysis_representations(sentence)
+        morph_analysis_representations = \
+            self.get_morph_analysis_representations(sentence, morph_analysis_encodings=morph_analysis_encodings)
 
         morph_analysis_scores = self.get_morph_analysis_scores(morph_analysis_representations,
                                                                context_representations)
@@ -277,9 +357,19 @@ class MainTaggerModel(object):
 
     def disambiguate_morph_analyzes(self, morph_analysis_scores):
 
-        selected_morph_analysis_representations = [
-            np.argmax(morph_analysis_scores_for_word.npvalue())
-            for morph_analysis_scores_for_word in morph_analysis_scores]
+        if len(morph_analysis_scores) == 0:
+            return []
+
+        # the scores of all the words are computed with a single forward computation
+        n_analyses = [morph_analysis_scores_for_word.dim()[0][0]
+                      for morph_analysis_scores_for_word in morph_analysis_scores]
+        all_scores = np.reshape(dynet.concatenate(morph_analysis_scores).npvalue(), (-1,))
+
+        selected_morph_analysis_representations = []
+        start = 0
+        for n_analyses_for_word in n_analyses:
+            selected_morph_analysis_representations.append(np.argmax(all_scores[start:start + n_analyses_for_word]))
+            start += n_analyses_for_word
 
         return selected_morph_analysis_representations
 
@@ -356,41 +446,23 @@ class MainTaggerModel(object):
             # new_weights = np.zeros([n_words, word_dim], dtype='float32')
             if pre_emb and training:
                 print('Loading pretrained embeddings from %s...' % pre_emb)
-                pretrained = {}
-                emb_invalid = 0
-                for i, line in enumerate(codecs.open(pre_emb, 'r', 'utf-8')):
-                    line = line.split()
-                    if len(line) == word_dim + 1:
-                        pretrained[line[0]] = np.array(
-                            [float(x) for x in line[1:]]
-                        ).astype(np.float32)
-                    else:
-                        emb_invalid += 1
-                if emb_invalid > 0:
-                    print('WARNING: %i invalid lines' % emb_invalid)
+                # only the rows of the words in the vocabulary are read from the memory-mapped store
+                pretrained = EmbeddingStore.open_or_convert(pre_emb, word_dim)
                 c_found = 0
                 c_lower = 0
                 c_zeros = 0
                 # Lookup table initialization
                 for i in range(n_words):
-                    raw_word = self.id_to_word[i]
-                    if raw_word != "<UNK>":
-                        # word = raw_word.split(" ")[1]
-                        word = raw_word
-                    else:
-                        word = raw_word
-                    # print word
-                    if word in pretrained:
-                        new_weights[i] = pretrained[word]
-                        c_found += 1
-                    elif word.lower() in pretrained:
-                        new_weights[i] = pretrained[word.lower()]
-                        c_lower += 1
-                    elif re.sub('\d', '0', word.lower()) in pretrained:
-                        new_weights[i] = pretrained[
-                            re.sub('\d', '0', word.lower())
-                        ]
-                        c_zeros += 1
+                    word = self.id_to_word[i]
+                    row, form_idx = pretrained.lookup_with_fallbacks(word, PRETRAINED_EMBEDDING_FALLBACKS)
+                    if row >= 0:
+                        new_weights[i] = pretrained.vectors[row]
+                        if form_idx == 0:
+                            c_found += 1
+                        elif form_idx == 1:
+                            c_lower += 1
+                        else:
+                            c_zeros += 1
 
                 print('Loaded %i pretrained embeddings.' % len(pretrained))
                 print(('%i / %i (%.4f%%) words have been initialized with '
@@ -418,13 +490,19 @@ class MainTaggerModel(object):
 
             return builder
 
+        def create_char_encoder(label, input_dim, output_dim, bilstm=True):
+            if self.parameters.get('char_encoder', 'bilstm') == 'cnn':
+                return CharCNNEncoder(input_dim, output_dim, self.model)
+            else:
+                return create_bilstm_layer(label, input_dim, output_dim, bilstm=bilstm)
+
         # Chars inputs
         #
         if char_dim:
             self.char_embeddings = self.model.add_lookup_parameters((n_chars, char_dim),
                                                                     name="charembeddings")
 
-            self.char_lstm_layer = create_bilstm_layer("char",
+            self.char_lstm_layer = create_char_encoder("char",
                                                        char_dim,
                                                        (2 if ch_b else 1) * char_lstm_dim,
                                                        bilstm=True if ch_b else False)
@@ -437,20 +515,24 @@ class MainTaggerModel(object):
         if self.parameters['active_models'] in [1, 2, 3]:
 
             self.char_lstm_layer_for_morph_analysis_roots = \
-                create_bilstm_layer("char_for_morph_analysis_root",
-                                   char_dim,
-                                   2 * mt_d,
-                                   bilstm=True)
+                create_char_encoder("char_for_morph_analysis_root",
+                                    char_dim,
+                                    2 * mt_d,
+                                    bilstm=True)
 
             self.morpho_tag_embeddings = self.model.add_lookup_parameters((n_morpho_tags, mt_d),
                                                                     name="charembeddings")
             # self.blank_morpho_tag_embedding = self.model.add_parameters(mt_d)
             self.blank_morpho_tag_embedding = dynet.inputVector(list(np.zeros(mt_d)))
-            self.morpho_tag_lstm_layer_for_morph_analysis_tags = \
-                create_bilstm_layer("morpho_tag_for_morph_analysis_tags",
-                                    mt_d,
-                                    2 * mt_d,
-                                    bilstm=True)
+            if self.parameters.get('morpho_tag_encoder', 'bilstm') == 'sum':
+                self.morpho_tag_lstm_layer_for_morph_analysis_tags = \
+                    PositionWeightedSumEncoder(mt_d, 2 * mt_d, self.model)
+            else:
+                self.morpho_tag_lstm_layer_for_morph_analysis_tags = \
+                    create_bilstm_layer("morpho_tag_for_morph_analysis_tags",
+                                        mt_d,
+                                        2 * mt_d,
+                                        bilstm=True)
 
 
             # self.blank_morpho_tag_sequence_rep = \
@@ -543,7 +625,12 @@ class MainTaggerModel(object):
         else:
             self.f_tying_method = _create_tying_method(activation_function=dynet.tanh, classic=True)
 
-        self.crf_module = CRF(self.model, self.id_to_tag)
+        # crf=0 used to be ignored, so the models saved before the format version 1 have a CRF
+        if self.parameters.get('crf', True) or self.parameters.get('model_format_version', 0) < 1:
+            self.crf_module = CRF(self.model, self.id_to_tag, tag_scheme=self.parameters['t_s'])
+        else:
+            # per-token softmax over the tag scores
+            self.crf_module = None
 
 
 
@@ -574,27 +661,97 @@ class MainTaggerModel(object):
 
         # self.trainer = dynet.SimpleSGDTrainer(self.model, learning_rate=0.01)
 
-        self.saver = DynetSaver(self.model, self.model_path)
+        self.saver = DynetSaver(self.model, self.model_path,
+                                checkpoint_format=self.parameters.get('checkpoint_format', 'text'))
 
         return self
 
-    def get_char_representations(self, sentence):
-        # initial_state = self.char_lstm_layer.initial_state()
+    def get_char_representations(self, sentence, training=None):
+        """
+        Character based representations of the words of a sentence, computed in a single batched pass.
+        At inference, the representations are also looked up in and added to the char representation cache,
+        so only the words which are not in the cache are encoded.
+        """
+        if training is None:
+            training = self.training
 
-        char_embeddings = [[self.char_embeddings[char_id] for char_id in word]
-                           for sentence_pos, word in enumerate(sentence['char_for_ids'])]
+        if training:
+            return self.encode_char_sequences(self.char_lstm_layer, sentence['char_for_ids'])
+
+        keys = [tuple(word) for word in sentence['char_for_ids']]
+        char_representations = self._encode_with_cache(
+            self.char_representation_cache, keys,
+            lambda missing_keys: self.encode_char_sequences(self.char_lstm_layer,
+                                                            [list(key) for key in missing_keys]))
+        return [char_representations[key] for key in keys]
+
+    def encode_char_sequences(self, encoder, sequences):
+        """
+        Representations of char id sequences, e.g. words or roots, computed in a single batched pass of
+        a char BiLSTM or a CharCNNEncoder, see --char_encoder.
+        """
+        if isinstance(encoder, CharCNNEncoder):
+            return encoder.encode_batch(self.char_embeddings, sequences)
+        else:
+            return get_final_representations_batch(encoder, self.char_embeddings, sequences)
+
+    def _encode_with_cache(self, cache, keys, encode):
+        """
+        Looks the given keys up in an inference cache of NumPy vectors. Only the unique keys which are
+        missing are encoded, with a single call to encode and a single forward computation, and then
+        added to the cache.
+
+        :param cache: LRUCache
+        :param keys: list of keys, may contain duplicates
+        :param encode: function from a list of keys to the list of their representations
+        :return: dict from keys to input expressions holding their representations
+        """
+        values = {}
+        missing_keys = []
+        for key in sorted(set(keys)):
+            value = cache.get(key)
+            if value is None:
+                missing_keys.append(key)
+            else:
+                values[key] = value
+
+        if len(missing_keys) > 0:
+            missing_values = np.reshape(dynet.concatenate_cols(encode(missing_keys)).npvalue(),
+                                        (-1, len(missing_keys)))
+            for idx, key in enumerate(missing_keys):
+                values[key] = missing_values[:, idx]
+                cache.put(key, values[key])
+
+        return {key: dynet.inputTensor(value) for key, value in values.items()}
+
+    def get_char_representations_batch(self, sentences, training=None):
+        """
+        Character based representations of the words of several sentences, computed in a single
+        batched pass over all the words of all the sentences. At inference, the char representation
+        cache is used as in get_char_representations.
+
+        :return: list of char representation lists, one for each sentence
+        """
+        if training is None:
+            training = self.training
+
+        words = [word for sentence in sentences for word in sentence['char_for_ids']]
+        if training:
+            word_representations = self.encode_char_sequences(self.char_lstm_layer, words)
+        else:
+            keys = [tuple(word) for word in words]
+            cached_representations = self._encode_with_cache(
+                self.char_representation_cache, keys,
+                lambda missing_keys: self.encode_char_sequences(self.char_lstm_layer,
+                                                                [list(key) for key in missing_keys]))
+            word_representations = [cached_representations[key] for key in keys]
 
         char_representations = []
-        for sentence_pos, char_embeddings_for_word in enumerate(char_embeddings):
-            # print char_embeddings_for_word
-            try:
-                # char_representations.append(
-                #     self.char_lstm_layer.transduce(char_embeddings_for_word)[-1])
-                char_representations.append(self.char_lstm_layer.get_representation_concat(char_embeddings_for_word)[0])
-            except IndexError as e:
-                print(sentence)
-                print(char_embeddings_for_word)
-                print(e)
+        start = 0
+        for sentence in sentences:
+            end = start + len(sentence['char_for_ids'])
+            char_representations.append(word_representations[start:end])
+            start = end
         return char_representations
 
     def get_sentence_level_bilstm_outputs(self,
@@ -613,6 +770,34 @@ class MainTaggerModel(object):
         last_layer_context_representations, multilayered_context_representations = \
             self.sentence_level_bilstm_layer.transduce(combined_word_representations)
 
+        return self._select_sentence_level_outputs(last_layer_context_representations,
+                                                   multilayered_context_representations,
+                                                   which_layer_to_use_for_morpho_disamb)
+
+    def get_sentence_level_bilstm_outputs_batch(self,
+                                                combined_word_representations_batch,
+                                                which_layer_to_use_for_morpho_disamb):
+        """
+        Batched version of get_sentence_level_bilstm_outputs, which runs the sentence level BiLSTM over
+        all the sentences at once.
+
+         :param combined_word_representations_batch: list of word representation lists, one for each sentence
+         :return: list of the two outputs of get_sentence_level_bilstm_outputs, one pair for each sentence
+        """
+        transduced = self.sentence_level_bilstm_layer.transduce_batch(
+            combined_word_representations_batch,
+            bucket_width=self.parameters.get('sentence_bucket_width', 0))
+
+        return [self._select_sentence_level_outputs(last_layer_context_representations,
+                                                    multilayered_context_representations,
+                                                    which_layer_to_use_for_morpho_disamb)
+                for last_layer_context_representations, multilayered_context_representations in transduced]
+
+    def _select_sentence_level_outputs(self,
+                                       last_layer_context_representations,
+                                       multilayered_context_representations,
+                                       which_layer_to_use_for_morpho_disamb):
+
         last_layer_context_representations = [dynet.tanh(dynet.affine_transform([self.tanh_layer_b.expr(),
                                                                       self.tanh_layer_W.expr(),
                                                                       context])) \
@@ -620,36 +805,101 @@ class MainTaggerModel(object):
         return last_layer_context_representations, \
                multilayered_context_representations[which_layer_to_use_for_morpho_disamb-1]
 
-    def predict(self, sentence):
+    def predict(self, sentence, n_best=1, tasks=PREDICTION_TASKS):
+        """
+        Tags a sentence.
+
+        :param sentence: whole sentence with input values as ids
+        :param n_best: when larger than 1, the k best tag sequences are decoded from the same tag scores
+        :param tasks: the outputs to compute, a subset of PREDICTION_TASKS. The outputs which are not
+            requested are returned empty and the morphological analyses are not scored if they cannot
+            affect the requested outputs.
+        :return: the selected morphological analysis indices and the decoded tags. If n_best is larger
+            than 1, the decoded tags are a list of (tag sequence, score) pairs, best first.
+        """
 
         context_representations_for_ner_loss, context_representations_for_md_loss = \
             self.get_context_representations(sentence, training=False)
 
-        last_layer_context_representations, _, _ = \
-            self.get_last_layer_context_representations(sentence,
-                                                        context_representations_for_ner_loss,
-                                                        context_representations_for_md_loss)
+        if self._needs_morph_analyses(tasks):
+            last_layer_context_representations, _, selected_morph_analysis_representations = \
+                self.get_last_layer_context_representations(sentence,
+                                                            context_representations_for_ner_loss,
+                                                            context_representations_for_md_loss)
+        else:
+            last_layer_context_representations = context_representations_for_ner_loss
+            selected_morph_analysis_representations = []
+
+        return self._decode(last_layer_context_representations, selected_morph_analysis_representations,
+                            n_best, tasks)
+
+    def predict_batch(self, sentences, n_best=1, tasks=PREDICTION_TASKS):
+        """
+        Tags several sentences in a single computation graph. The char representations, the encodings of
+        the candidate analyses and the sentence level BiLSTM outputs are computed for all the sentences at once.
+        The caller is expected to renew the computation graph before every batch.
+
+        :param sentences: list of sentences with input values as ids
+        :return: list of the outputs of predict, one for each sentence
+        """
+        char_representations_batch = self.get_char_representations_batch(sentences, training=False)
+        needs_morph_analyses = self._needs_morph_analyses(tasks)
+        if needs_morph_analyses:
+            morph_analysis_encodings = self.encode_morph_analyses(sentences, training=False)
+        else:
+            morph_analysis_encodings = None
+        context_representations_batch = self.get_context_representations_batch(
+            sentences, training=False, char_representations_batch=char_representations_batch)
+
+        predictions = []
+        for sentence, (context_representations_for_ner_loss, context_representations_for_md_loss) in \
+                zip(sentences, context_representations_batch):
+            if needs_morph_analyses:
+                last_layer_context_representations, _, selected_morph_analysis_representations = \
+                    self.get_last_layer_context_representations(sentence,
+                                                                context_representations_for_ner_loss,
+                                                                context_representations_for_md_loss,
+                                                                morph_analysis_encodings=morph_analysis_encodings)
+            else:
+                last_layer_context_representations = context_representations_for_ner_loss
+                selected_morph_analysis_representations = []
+            predictions.append(self._decode(last_layer_context_representations,
+                                            selected_morph_analysis_representations,
+                                            n_best, tasks))
+        return predictions
+
+    def _needs_morph_analyses(self, tasks):
+        """
+        The morphological analyses are scored if they are requested or if the NER tags are requested and
+        depend on the selected analyses, i.e. with integration_mode 2.
+        """
+        if self.parameters['active_models'] not in [1, 2, 3]:
+            return False
+        return "md" in tasks or ("ner" in tasks and self.parameters['integration_mode'] == 2)
 
-        if self.parameters['active_models'] in [0, 2, 3]:
+    def _decode(self, last_layer_context_representations, selected_morph_analysis_representations, n_best=1,
+                tasks=PREDICTION_TASKS):
+
+        if self.parameters['active_models'] in [0, 2, 3] and "ner" in tasks:
             tag_scores = self.calculate_tag_scores(last_layer_context_representations)
             # _, decoded_tags = self.crf_module.viterbi_loss(tag_scores,
             #                                                   sentence['tag_ids'])
-            observations = [dynet.concatenate([obs, dynet.inputVector([-1e10, -1e10])], d=0) for obs in
-                            tag_scores]
-            # print("\n".join([" ".join([str(xx) for xx in x.value()]) for x in observations]))
-            decoded_tags, _ = self.crf_module.viterbi_decoding(observations)
+            if self.crf_module is None:
+                if n_best > 1:
+                    raise Exception("n-best decoding requires the CRF, i.e. --crf 1")
+                decoded_tags = self.greedy_decode(tag_scores,
+                                                  repair=self.parameters.get('constrained_decoding', False))
+            elif n_best > 1:
+                decoded_tags = self.crf_module.viterbi_nbest(tag_scores, n_best,
+                                                             constrained=self.parameters.get('constrained_decoding', False))
+            else:
+                decoded_tags, _ = self.crf_module.decode(tag_scores,
+                                                         constrained=self.parameters.get('constrained_decoding', False))
         else:
             decoded_tags = []
 
-        # if self.parameters['integration_mode'] in [1, 2] or self.parameters['active_models'] == 1:
-        if self.parameters['active_models'] in [1, 2, 3]:
-            morph_analysis_representations, morph_analysis_scores = \
-                self.get_morph_analysis_representations_and_scores(sentence,
-                                                                   context_representations_for_md_loss)
-
-            selected_morph_analysis_representations = \
-                self.disambiguate_morph_analyzes(morph_analysis_scores)
-        else:
+        # the analyses are already disambiguated by get_last_layer_context_representations
+        if self.parameters['active_models'] not in [1, 2, 3] or "md" not in tasks:
             selected_morph_analysis_representations = []
 
         return selected_morph_analysis_representations, decoded_tags
@@ -659,8 +909,31 @@ class MainTaggerModel(object):
         # read configuration
 
         dynet.renew_cg()
+        # the parameters are about to change, so the cached inference time representations become stale
+        self.clear_inference_caches()
+        self.loss_anomaly_detector.clear()
         loss_array = []
-        for sentence in sentences_in_the_batch:
+        crf_observations_batch = []
+        crf_tags_batch = []
+        crf_sentence_ids = []
+        autobatch = self.parameters.get('train_batching', 'padded') == 'autobatch'
+        # the roots and morpho tag sequences of the candidate analyses in the batch are encoded once
+        if self.parameters['active_models'] in [1, 2, 3]:
+            morph_analysis_encodings = self.encode_morph_analyses(sentences_in_the_batch)
+        else:
+            morph_analysis_encodings = None
+        if autobatch:
+            # the graph of every sentence is built on its own and dynet's automatic batching
+            # (--dynet-autobatch) groups the operations of the sentences when the loss is computed
+            context_representations_batch = [self.get_context_representations(sentence)
+                                             for sentence in sentences_in_the_batch]
+        else:
+            # the char representations of every word in the batch are computed at once
+            char_representations_batch = self.get_char_representations_batch(sentences_in_the_batch)
+            # and the sentence level BiLSTM runs over all the sentences of the batch at once
+            context_representations_batch = self.get_context_representations_batch(
+                sentences_in_the_batch, char_representations_batch=char_representations_batch)
+        for sentence, context_representations in zip(sentences_in_the_batch, context_representations_batch):
             """
             data.append({
                 'str_words': str_words,
@@ -685,32 +958,70 @@ class MainTaggerModel(object):
                 both are available. The latter one is only possible for Turkish.
             """
 
-            losses_for_sentence, _ = self._get_loss(sentence)
+            losses_for_sentence, tag_scores = self._get_loss(sentence,
+                                                             context_representations=context_representations,
+                                                             morph_analysis_encodings=morph_analysis_encodings)
             loss_array += losses_for_sentence
+            for md_loss in losses_for_sentence:
+                self.loss_anomaly_detector.record(sentence.get('sentence_id'), "md", md_loss)
+
+            if self.parameters['active_models'] in [0, 2, 3] and len(sentence['tag_ids']) > 0:
+                crf_observations_batch.append(tag_scores)
+                crf_tags_batch.append(sentence['tag_ids'])
+                crf_sentence_ids.append(sentence.get('sentence_id'))
+
+        if len(crf_observations_batch) > 0:
+            if self.crf_module is None:
+                for tag_scores, tag_ids, sentence_id in zip(crf_observations_batch, crf_tags_batch, crf_sentence_ids):
+                    softmax_loss = dynet.esum([dynet.pickneglogsoftmax(tag_score, tag_id)
+                                               for tag_score, tag_id in zip(tag_scores, tag_ids)])
+                    self.loss_anomaly_detector.record(sentence_id, "softmax", softmax_loss)
+                    loss_array.append(softmax_loss)
+            elif self.parameters.get('crf_objective', 'nll') == 'margin':
+                # sentences whose best path is already the golden path do not contribute a loss
+                for tag_scores, tag_ids, sentence_id in zip(crf_observations_batch, crf_tags_batch, crf_sentence_ids):
+                    margin_loss, _ = self.crf_module.viterbi_loss(tag_scores, tag_ids,
+                                                                  constrained=self.parameters.get('constrained_decoding', False))
+                    if margin_loss is not None:
+                        self.loss_anomaly_detector.record(sentence_id, "crf", margin_loss)
+                        loss_array.append(margin_loss)
+            elif autobatch:
+                for tag_scores, tag_ids, sentence_id in zip(crf_observations_batch, crf_tags_batch, crf_sentence_ids):
+                    crf_loss = self.crf_module.neg_log_loss(tag_scores, tag_ids)
+                    self.loss_anomaly_detector.record(sentence_id, "crf", crf_loss)
+                    loss_array.append(crf_loss)
+            else:
+                # one batched CRF loss for every sentence with golden NER tags
+                crf_losses = self.crf_module.neg_log_loss_batch(crf_observations_batch, crf_tags_batch)
+                for batch_idx, sentence_id in enumerate(crf_sentence_ids):
+                    self.loss_anomaly_detector.record(sentence_id, "crf", dynet.pick_batch_elem(crf_losses, batch_idx))
+                loss_array.append(dynet.sum_batches(crf_losses))
+
+        if len(loss_array) == 0:
+            # nothing to learn from this batch
+            return None
 
         return dynet.esum(loss_array)
 
-    def _get_loss(self, sentence):
+    def _get_loss(self, sentence, context_representations=None, morph_analysis_encodings=None):
+        """
+        Builds the MD loss and the NER tag scores of a single sentence. The CRF loss is left to
+        the caller so that it can be computed for the whole batch at once.
+        """
         loss_array = []
         tag_scores = []
-        context_representations_for_ner_loss, context_representations_for_md_loss = \
-            self.get_context_representations(sentence)
+        if context_representations is None:
+            context_representations = self.get_context_representations(sentence)
+        context_representations_for_ner_loss, context_representations_for_md_loss = context_representations
         last_layer_context_representations, md_loss, _ = \
             self.get_last_layer_context_representations(sentence,
                                                         context_representations_for_ner_loss,
-                                                        context_representations_for_md_loss)
+                                                        context_representations_for_md_loss,
+                                                        morph_analysis_encodings=morph_analysis_encodings,
+                                                        disambiguate=False)
         if self.parameters['active_models'] in [0, 2, 3]:  # 0: NER, 1: MD, 2: JOINT, 3: JOINT_MULTILAYER
             tag_scores = self.calculate_tag_scores(last_layer_context_representations)
 
-            if len(sentence['tag_ids']) > 0:
-                crf_loss = self.crf_module.neg_log_loss(tag_scores, sentence['tag_ids'])
-            else:
-                crf_loss = dynet.scalarInput(0)
-
-            if crf_loss.value() > 1000:
-                logging.error("BEEP")
-            loss_array.append(crf_loss)
-
         if self.parameters['active_models'] in [1, 2, 3]:
             loss_array.append(md_loss)
 
@@ -731,25 +1042,6 @@ class MainTaggerModel(object):
 
         return None
 
-    def _valid_path_probs(self, tag_scores, valid_paths_as_ids):
-
-        valid_path_scores = []
-        for valid_path_as_ids in valid_paths_as_ids:
-            node_scores = []
-            for time_t, tag_id in enumerate(valid_path_as_ids):
-                node_scores.append(tag_scores[time_t][tag_id])
-            if len(node_scores) == 1:
-                path_score = node_scores[0]
-            else:
-                node_scores = dynet.concatenate(node_scores)
-                path_score = log_sum_exp(node_scores)
-            path_score = dynet.exp(path_score)
-            valid_path_scores.append(path_score)
-        sum_valid_path_scores = dynet.esum(valid_path_scores)
-        valid_path_probs = dynet.cdiv(dynet.concatenate(valid_path_scores), sum_valid_path_scores)
-        # valid_path_probs = [s.value()/float(dynet.esum(valid_path_scores).value()) for s in valid_path_scores]
-        return valid_path_probs
-
     def obtain_valid_paths(self, sequence_length):
         if sequence_length in self._valid_path_cache:
             return self._valid_path_cache[sequence_length]
@@ -791,7 +1083,7 @@ class MainTaggerModel(object):
             for entity_type in self.entity_types:
                 ret.append(["S-%s" % entity_type])
         else:
-            ret = ["O" for _ in range(sequence_length)]
+            ret = [["O" for _ in range(sequence_length)]]
             for entity_type in self.entity_types:
                 if entity_type != "OUTSIDE":
                     sub_ret = ["B-%s" % entity_type]
@@ -803,6 +1095,14 @@ class MainTaggerModel(object):
         return ret
 
     def probs_for_a_specific_entity(self, sentence, entity_indices):
+        """
+        Probabilities of the valid tag paths over the span given by entity_indices, renormalized
+        over the set of valid paths. The path probabilities are obtained from the CRF marginals,
+        so the cost is a single forward-backward pass whatever the number of paths.
+        """
+
+        if self.crf_module is None:
+            raise Exception("Entity probabilities are computed from the CRF marginals, i.e. --crf 1 is required")
 
         valid_paths = self.obtain_valid_paths(entity_indices[-1]-entity_indices[0])
         tag_to_id = {tag: id for id, tag in self.id_to_tag.items()}
@@ -813,12 +1113,14 @@ class MainTaggerModel(object):
         self.blank_morpho_tag_embedding = dynet.inputVector(list(np.zeros(self.parameters['mt_d'])))
         tag_scores = self._predict_for_xnlp(sentence)
 
-        valid_path_probs = self._valid_path_probs(tag_scores[entity_indices[0]:entity_indices[-1]],
-                                                  valid_paths_as_ids)
+        marginals = self.crf_module.marginals(tag_scores)
 
-        valid_path_probs = valid_path_probs.value()
-        if len(valid_path_probs) == 0:
+        valid_path_log_probs = np.array([marginals.segment_log_prob(entity_indices[0], valid_path_as_ids)
+                                         for valid_path_as_ids in valid_paths_as_ids])
+        if len(valid_path_log_probs) == 0:
             print(sentence)
+            return []
+        valid_path_probs = np.exp(valid_path_log_probs - crf_numpy.log_sum_exp(valid_path_log_probs))
 
         return [("NA", prob) for prob in valid_path_probs]
 
@@ -830,17 +1132,36 @@ class MainTaggerModel(object):
                       for context in context_representations]
         return tag_scores
 
+    def greedy_decode(self, tag_scores, repair=True):
+        """
+        Picks the highest scoring tag of every token independently, which is what the softmax
+        output layer is trained for when the CRF is disabled.
+
+        :param tag_scores: list of n_tags dimensional expressions
+        :param repair: fix the tag sequences that are invalid in the tagging scheme
+        :return: list of tag ids
+        """
+        if len(tag_scores) == 0:
+            return []
+        n_tags = len(self.id_to_tag)
+        tag_scores = np.reshape(dynet.concatenate_cols(tag_scores).npvalue(), (n_tags, len(tag_scores)))
+        decoded_tags = [int(tag_id) for tag_id in np.argmax(tag_scores, axis=0)]
+        if repair:
+            decoded_tags = repair_tag_ids(decoded_tags, self.id_to_tag, tag_scheme=self.parameters['t_s'])
+        return decoded_tags
+
     def get_morph_analysis_representation_in_old_style(self, sentence):
         # these morpho_tag_ids are either chars or tags depending on the morpho_tag_type
         return [self.old_style_morpho_tag_lstm_layer_for_golden_morpho_analyzes\
                     .get_representation_concat([self.morpho_tag_embeddings[morpho_tag_id] for morpho_tag_id in morpho_tag_sequence])[0]
                 for morpho_tag_sequence in sentence['morpho_tag_ids']]
 
-    def get_combined_word_representations(self, sentence, training=None):
+    def get_combined_word_representations(self, sentence, training=None, char_representations=None):
         """
         
         :param training:
         :param sentence: whole sentence with input values as ids
+        :param char_representations: precomputed char representations of the words, e.g. computed for the whole batch
         :return: word representations made up according to the user preferences
         """
 
@@ -851,7 +1172,8 @@ class MainTaggerModel(object):
         word_embedding_based_representations = \
             [self.word_embeddings[word_id] for word_id in sentence['word_ids']]
         representations_to_be_zipped.append(dynet.concatenate([dynet.transpose(x) for x in word_embedding_based_representations]))
-        char_representations = self.get_char_representations(sentence)
+        if char_representations is None:
+            char_representations = self.get_char_representations(sentence, training=training)
         representations_to_be_zipped.append(dynet.concatenate([dynet.transpose(x) for x in char_representations]))
         if self.parameters['use_golden_morpho_analysis_in_word_representation']:
             morph_tag_based_representations = self.get_morph_analysis_representation_in_old_style(sentence)
@@ -878,47 +1200,131 @@ class MainTaggerModel(object):
 
         return combined_word_representations
 
-    def get_context_representations(self, sentence, training=None):
+    def get_context_representations(self, sentence, training=None, char_representations=None):
         """
         
         :param training:
         :param sentence: whole sentence with input values as ids
+        :param char_representations: precomputed char representations of the words, e.g. computed for the whole batch
         :return: context representations for every layer of RNN (Bi-LSTM in our case)
         """
 
         if training is None:
             training = self.training
 
-        combined_word_representations = self.get_combined_word_representations(sentence, training=training)
+        combined_word_representations = self.get_combined_word_representations(sentence, training=training,
+                                                                               char_representations=char_representations)
 
         context_representations_for_ner_loss, context_representations_for_md_loss = \
             self.get_sentence_level_bilstm_outputs(combined_word_representations,
                                                    1 if self.parameters['multilayer'] else 1)
         return context_representations_for_ner_loss, context_representations_for_md_loss
 
-    def get_morph_analysis_representations(self, sentence):
-
-        try:
-            root_representations = \
-                [[self.char_lstm_layer_for_morph_analysis_roots.get_representation([self.char_embeddings[char_id]
-                                                              for char_id in root_char_sequence])[0]
-                for root_char_sequence in root_as_char_sequences_for_word]
-                for root_as_char_sequences_for_word in sentence['morpho_analyzes_roots']]
-        except IndexError as e:
-            print(e)
-            print(root_char_sequence)
-
-        try:
-            morpho_tag_sequence_representations = \
-                [[(self.morpho_tag_lstm_layer_for_morph_analysis_tags.get_representation([self.morpho_tag_embeddings[morpho_tag_id]
-                                                              for morpho_tag_id in morpho_tag_sequence])[0]
-                   if len(morpho_tag_sequence) > 0 else
-                   (self.morpho_tag_lstm_layer_for_morph_analysis_tags.get_representation([self.blank_morpho_tag_embedding])[0]))
-                for morpho_tag_sequence in morpho_tag_sequences_for_word]
-                for morpho_tag_sequences_for_word in sentence['morpho_analyzes_tags']]
-        except IndexError as e:
-            print(e)
-            print(morpho_tag_sequence)
+    def get_context_representations_batch(self, sentences, training=None, char_representations_batch=None):
+        """
+        Batched version of get_context_representations.
+
+        :param sentences: list of sentences with input values as ids
+        :param char_representations_batch: precomputed char representations of the words of each sentence
+        :return: list of the two outputs of get_context_representations, one pair for each sentence
+        """
+
+        if training is None:
+            training = self.training
+
+        if char_representations_batch is None:
+            char_representations_batch = [None] * len(sentences)
+
+        combined_word_representations_batch = \
+            [self.get_combined_word_representations(sentence, training=training,
+                                                    char_representations=char_representations)
+             for sentence, char_representations in zip(sentences, char_representations_batch)]
+
+        return self.get_sentence_level_bilstm_outputs_batch(combined_word_representations_batch,
+                                                            1 if self.parameters['multilayer'] else 1)
+
+    def encode_morph_analyses(self, sentences, training=None):
+        """
+        Encodes the unique roots and the unique morpho tag sequences of the candidate analyses of the
+        given sentences once, each kind in a single batched pass. At inference, the encodings are also
+        looked up in and added to the morph analysis cache.
+
+        :param sentences: list of sentences with input values as ids
+        :return: dict from ("root", root char ids) and ("tags", morpho tag ids) keys to representations
+        """
+        if training is None:
+            training = self.training
+
+        root_keys = [("root", tuple(root_char_sequence))
+                     for sentence in sentences
+                     for root_as_char_sequences_for_word in sentence['morpho_analyzes_roots']
+                     for root_char_sequence in root_as_char_sequences_for_word]
+        tag_keys = [("tags", tuple(morpho_tag_sequence))
+                    for sentence in sentences
+                    for morpho_tag_sequences_for_word in sentence['morpho_analyzes_tags']
+                    for morpho_tag_sequence in morpho_tag_sequences_for_word]
+
+        def encode(keys):
+            root_char_sequences = [list(key[1]) for key in keys if key[0] == "root"]
+            morpho_tag_sequences = [list(key[1]) for key in keys if key[0] == "tags" and len(key[1]) > 0]
+            root_representations = iter(
+                [dynet.rectify(x) for x in
+                 self.encode_char_sequences(self.char_lstm_layer_for_morph_analysis_roots,
+                                            root_char_sequences)])
+            if isinstance(self.morpho_tag_lstm_layer_for_morph_analysis_tags, PositionWeightedSumEncoder):
+                morpho_tag_sequence_representations = \
+                    self.morpho_tag_lstm_layer_for_morph_analysis_tags.encode_batch(self.morpho_tag_embeddings,
+                                                                                    morpho_tag_sequences)
+            else:
+                morpho_tag_sequence_representations = \
+                    get_final_representations_batch(self.morpho_tag_lstm_layer_for_morph_analysis_tags,
+                                                    self.morpho_tag_embeddings,
+                                                    morpho_tag_sequences)
+            morpho_tag_sequence_representations = iter([dynet.rectify(x) for x in morpho_tag_sequence_representations])
+            representations = []
+            for key in keys:
+                if key[0] == "root":
+                    representations.append(next(root_representations))
+                elif len(key[1]) > 0:
+                    representations.append(next(morpho_tag_sequence_representations))
+                else:
+                    # analyses without any morpho tags are represented by a blank morpho tag
+                    if isinstance(self.morpho_tag_lstm_layer_for_morph_analysis_tags, PositionWeightedSumEncoder):
+                        # the sum of the zero embedding is zero
+                        representations.append(
+                            dynet.rectify(self.morpho_tag_lstm_layer_for_morph_analysis_tags.b.expr()))
+                    else:
+                        blank_morpho_tag_embedding = dynet.inputVector(list(np.zeros(self.parameters['mt_d'])))
+                        representations.append(self.morpho_tag_lstm_layer_for_morph_analysis_tags
+                                               .get_representation([blank_morpho_tag_embedding])[0])
+            return representations
+
+        if training:
+            unique_keys = sorted(set(root_keys + tag_keys))
+            return dict(zip(unique_keys, encode(unique_keys)))
+        else:
+            return self._encode_with_cache(self.morph_analysis_cache, root_keys + tag_keys, encode)
+
+    def get_morph_analysis_representations(self, sentence, morph_analysis_encodings=None):
+        """
+        Representations of every candidate analysis of every word, which tie the representations of
+        the root and of the morpho tag sequence of the analysis.
+
+        :param morph_analysis_encodings: precomputed root and morpho tag sequence representations,
+            e.g. computed for the whole batch by encode_morph_analyses
+        """
+        if morph_analysis_encodings is None:
+            morph_analysis_encodings = self.encode_morph_analyses([sentence])
+
+        root_representations = \
+            [[morph_analysis_encodings[("root", tuple(root_char_sequence))]
+              for root_char_sequence in root_as_char_sequences_for_word]
+             for root_as_char_sequences_for_word in sentence['morpho_analyzes_roots']]
+
+        morpho_tag_sequence_representations = \
+            [[morph_analysis_encodings[("tags", tuple(morpho_tag_sequence))]
+              for morpho_tag_sequence in morpho_tag_sequences_for_word]
+             for morpho_tag_sequences_for_word in sentence['morpho_analyzes_tags']]
 
         tyed_representations_for_every_analysis = \
             [[self.f_tying_method(root_representation, morpho_tag_representation)
@@ -0,0 +1,378 @@
+#
+# NumPy inference engine for models trained with toolkit.joint_ner_and_md_model.MainTaggerModel
+#
+# MainTaggerModel.export_numpy writes the parameters and the mappings of a trained model into a
+# single .npz bundle. NumpyTagger loads such a bundle and reproduces MainTaggerModel.predict
+# without dynet, so serving does not need to build the computation graph nor a trainer.
+#
+# Bundle layout:
+#   parameters: JSON string of the model parameters
+#   id_to_word, id_to_char, id_to_tag, id_to_morpho_tag: strings ordered by id
+#   *_embeddings, *_W, *_b: lookup tables and dense layers named after the model attributes
+#   <builder>.l<layer>.<fw|bw>.<name>: CoupledLSTMBuilder weights, name in LSTM_PARAMETER_NAMES
+#   <builder>.cnn.widths, <builder>.cnn.w<width>.W, <builder>.cnn.b: toolkit.cnn.CharCNNEncoder weights
+#   <builder>.sum.position_weights, <builder>.sum.W, <builder>.sum.b:
+#       toolkit.bag_of_tags.PositionWeightedSumEncoder weights
+#   crf_transitions: (n_tags+2, n_tags+2) array, transitions[next_tag, prev_tag]
+#
+# The word embeddings, which hold a row for every pretrained word with --all_emb 1, are written
+# next to the bundle as a separate .npy file (see word_embeddings_path) and are paged in on demand.
+#
+
+import json
+import os
+
+import numpy as np
+
+from toolkit import crf_numpy
+from utils import repair_tag_ids
+from utils.embedding_store import PagedEmbeddings
+
+# the order of the parameters of a CoupledLSTMBuilder layer, as returned by get_parameters()
+LSTM_PARAMETER_NAMES = ["x2i", "h2i", "c2i", "bi", "x2o", "h2o", "c2o", "bo", "x2c", "h2c", "bc"]
+
+BUILDER_NAMES = ["char_lstm_layer",
+                 "char_lstm_layer_for_morph_analysis_roots",
+                 "morpho_tag_lstm_layer_for_morph_analysis_tags",
+                 "old_style_morpho_tag_lstm_layer_for_golden_morpho_analyzes",
+                 "sentence_level_bilstm_layer"]
+
+DENSE_PARAMETER_NAMES = ["word_embeddings", "char_embeddings", "cap_embeddings", "morpho_tag_embeddings",
+                         "tanh_layer_W", "tanh_layer_b",
+                         "last_layer_W", "last_layer_b",
+                         "transform_context_layer_W", "transform_context_layer_b",
+                         "tying_method_W", "tying_method_b"]
+
+MAPPING_NAMES = ["id_to_word", "id_to_char", "id_to_tag", "id_to_morpho_tag"]
+
+
+def word_embeddings_path(bundle_path):
+    """
+    :return: path of the word embeddings file which accompanies the bundle at bundle_path
+    """
+    if bundle_path.endswith(".npz"):
+        bundle_path = bundle_path[:-len(".npz")]
+    return bundle_path + ".word_embeddings.npy"
+
+
+def logistic(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def rectify(x):
+    return np.maximum(x, 0)
+
+
+def coupled_lstm_transduce(weights, inputs):
+    """
+    Runs a CoupledLSTMBuilder layer, i.e. an LSTM with peephole connections whose forget gate is
+    one minus the input gate, starting from zero states.
+
+    :param weights: dict from LSTM_PARAMETER_NAMES to arrays
+    :param inputs: (n_steps, batch_size, input_dim) array
+    :return: (n_steps, batch_size, hidden_dim) array of outputs
+    """
+    n_steps, batch_size, _ = inputs.shape
+    hidden_dim = weights["bi"].shape[0]
+    h = np.zeros((batch_size, hidden_dim), dtype=inputs.dtype)
+    c = np.zeros((batch_size, hidden_dim), dtype=inputs.dtype)
+    # the input projections do not depend on the previous states
+    x2i = np.dot(inputs, weights["x2i"].T) + weights["bi"]
+    x2o = np.dot(inputs, weights["x2o"].T) + weights["bo"]
+    x2c = np.dot(inputs, weights["x2c"].T) + weights["bc"]
+    outputs = np.zeros((n_steps, batch_size, hidden_dim), dtype=inputs.dtype)
+    for t in range(n_steps):
+        input_gate = logistic(x2i[t] + np.dot(h, weights["h2i"].T) + np.dot(c, weights["c2i"].T))
+        candidate = np.tanh(x2c[t] + np.dot(h, weights["h2c"].T))
+        c = (1 - input_gate) * c + input_gate * candidate
+        output_gate = logistic(x2o[t] + np.dot(h, weights["h2o"].T) + np.dot(c, weights["c2o"].T))
+        h = output_gate * np.tanh(c)
+        outputs[t] = h
+    return outputs
+
+
+def char_cnn_encode(widths, filter_Ws, b, inputs, lengths):
+    """
+    NumPy version of toolkit.cnn.CharCNNEncoder.encode_batch.
+
+    :param inputs: (n_steps, batch_size, input_dim) array, zero after the end of every sequence
+    :param lengths: (batch_size,) array of the sequence lengths
+    :return: (batch_size, output_dim) array
+    """
+    n_steps, batch_size, input_dim = inputs.shape
+    pooled = []
+    for width, filter_W in zip(widths, filter_Ws):
+        padded_inputs = np.concatenate([inputs, np.zeros((width - 1, batch_size, input_dim), dtype=inputs.dtype)],
+                                       axis=0)
+        windows = np.concatenate([padded_inputs[k:k + n_steps] for k in range(width)], axis=2)
+        activations = np.dot(windows, filter_W.T)
+        valid_windows = np.arange(n_steps)[:, np.newaxis] <= np.maximum(lengths - width, 0)[np.newaxis, :]
+        activations = np.where(valid_windows[:, :, np.newaxis], activations, -np.inf)
+        pooled.append(activations.max(axis=0))
+    return np.tanh(np.concatenate(pooled, axis=1) + b)
+
+
+def position_weighted_sum_encode(position_weights, W, b, inputs):
+    """
+    NumPy version of toolkit.bag_of_tags.PositionWeightedSumEncoder.encode_batch.
+
+    :param inputs: (n_steps, batch_size, input_dim) array, zero after the end of every sequence
+    :return: (batch_size, output_dim) array
+    """
+    positions = np.minimum(np.arange(inputs.shape[0]), position_weights.shape[0] - 1)
+    weighted_sums = (inputs * position_weights[positions][:, np.newaxis, :]).sum(axis=0)
+    return np.dot(weighted_sums, W.T) + b
+
+
+class NumpyTagger(object):
+
+    def __init__(self, arrays):
+        """
+
+        :param arrays: dict of the arrays in a bundle written by MainTaggerModel.export_numpy
+        """
+        self.parameters = json.loads(str(arrays["parameters"]))
+        for mapping_name in MAPPING_NAMES:
+            setattr(self, mapping_name, {idx: str(item) for idx, item in enumerate(arrays[mapping_name])})
+        self.arrays = arrays
+
+        self.n_tags = len(self.id_to_tag)
+        self.b_id = self.n_tags
+        self.e_id = self.n_tags + 1
+        self.predecessor_index, self.predecessor_mask = \
+            crf_numpy.allowed_predecessors(self.id_to_tag, self.b_id, self.e_id, tag_scheme=self.parameters['t_s'])
+
+    @classmethod
+    def load(cls, filepath, word_embeddings_cache_size=1024):
+        """
+        Loads a bundle written by MainTaggerModel.export_numpy, and its word embeddings file if the model has
+        word embeddings.
+
+        :param word_embeddings_cache_size: number of word embedding rows kept in memory, the others are read
+            from the memory-mapped word embeddings file when they are looked up
+        """
+        with np.load(filepath) as bundle:
+            arrays = {name: bundle[name] for name in bundle.files}
+        if os.path.exists(word_embeddings_path(filepath)):
+            arrays["word_embeddings"] = PagedEmbeddings(word_embeddings_path(filepath),
+                                                        cache_size=word_embeddings_cache_size)
+        return cls(arrays)
+
+    def _lstm_weights(self, builder_name, layer_idx, direction):
+        prefix = "%s.l%d.%s." % (builder_name, layer_idx, direction)
+        return {name: self.arrays[prefix + name] for name in LSTM_PARAMETER_NAMES}
+
+    def _has_builder(self, builder_name):
+        return ("%s.l0.fw.bi" % builder_name) in self.arrays
+
+    def _is_bidirectional(self, builder_name):
+        return ("%s.l0.bw.bi" % builder_name) in self.arrays
+
+    def final_representations(self, builder_name, lookup_name, sequences):
+        """
+        NumPy version of toolkit.rnn.get_final_representations_batch, or of CharCNNEncoder.encode_batch
+        for the builders exported from a CharCNNEncoder.
+
+        :return: (n_sequences, output_dim) array
+        """
+        lookup = self.arrays[lookup_name]
+        # as in the dynet encoders, an empty sequence is encoded as the single pad id 0
+        sequences = [sequence if len(sequence) > 0 else [0] for sequence in sequences]
+        lengths = np.array([len(sequence) for sequence in sequences])
+        max_length = max(lengths)
+        rows = np.arange(len(sequences))
+
+        if ("%s.cnn.widths" % builder_name) in self.arrays or ("%s.sum.W" % builder_name) in self.arrays:
+            ids = np.zeros((max_length, len(sequences)), dtype=np.int64)
+            for sequence_idx, sequence in enumerate(sequences):
+                ids[:len(sequence), sequence_idx] = sequence
+            step_mask = (np.arange(max_length)[:, np.newaxis] < lengths[np.newaxis, :])
+            inputs = (lookup[ids] * step_mask[:, :, np.newaxis]).astype(lookup.dtype)
+            if ("%s.sum.W" % builder_name) in self.arrays:
+                return position_weighted_sum_encode(self.arrays["%s.sum.position_weights" % builder_name],
+                                                    self.arrays["%s.sum.W" % builder_name],
+                                                    self.arrays["%s.sum.b" % builder_name],
+                                                    inputs)
+            widths = [int(width) for width in self.arrays["%s.cnn.widths" % builder_name]]
+            return char_cnn_encode(widths,
+                                   [self.arrays["%s.cnn.w%d.W" % (builder_name, width)] for width in widths],
+                                   self.arrays["%s.cnn.b" % builder_name],
+                                   inputs, lengths)
+
+        def run_padded(weights, padded_sequences):
+            ids = np.zeros((max_length, len(padded_sequences)), dtype=np.int64)
+            for sequence_idx, sequence in enumerate(padded_sequences):
+                ids[:len(sequence), sequence_idx] = sequence
+            outputs = coupled_lstm_transduce(weights, lookup[ids])
+            return outputs[lengths - 1, rows]
+
+        forward_states = run_padded(self._lstm_weights(builder_name, 0, "fw"), sequences)
+        if not self._is_bidirectional(builder_name):
+            return forward_states
+        backward_states = run_padded(self._lstm_weights(builder_name, 0, "bw"),
+                                     [list(reversed(sequence)) for sequence in sequences])
+        return np.concatenate([forward_states, backward_states], axis=1)
+
+    def sentence_level_transduce(self, inputs):
+        """
+        NumPy version of BiLSTMMultiLayeredWithShortcutConnections.transduce.
+
+        :param inputs: (n_words, input_dim) array
+        :return: last layer outputs and the list of the outputs of every layer, (n_words, output_dim) arrays
+        """
+        layer_outputs = []
+        es = inputs
+        layer_idx = 0
+        while ("sentence_level_bilstm_layer.l%d.fw.bi" % layer_idx) in self.arrays:
+            fs = coupled_lstm_transduce(self._lstm_weights("sentence_level_bilstm_layer", layer_idx, "fw"),
+                                        es[:, np.newaxis, :])[:, 0, :]
+            bs = coupled_lstm_transduce(self._lstm_weights("sentence_level_bilstm_layer", layer_idx, "bw"),
+                                        es[::-1, np.newaxis, :])[::-1, 0, :]
+            if self.parameters['shortcut_connections']:
+                es = np.concatenate([inputs, fs, bs], axis=1)
+            else:
+                es = np.concatenate([fs, bs], axis=1)
+            layer_outputs.append(es)
+            layer_idx += 1
+        return es, layer_outputs
+
+    def get_combined_word_representations(self, sentence):
+        representations = [self.arrays["word_embeddings"][sentence['word_ids']],
+                           self.final_representations("char_lstm_layer", "char_embeddings",
+                                                      sentence['char_for_ids'])]
+        if self.parameters['use_golden_morpho_analysis_in_word_representation']:
+            representations.append(
+                self.final_representations("old_style_morpho_tag_lstm_layer_for_golden_morpho_analyzes",
+                                           "morpho_tag_embeddings",
+                                           sentence['morpho_tag_ids']))
+        if self.parameters['cap_dim'] > 0:
+            representations.append(self.arrays["cap_embeddings"][sentence['cap_ids']])
+        return np.concatenate(representations, axis=1)
+
+    def get_morph_analysis_representations(self, sentence):
+        """
+        :return: list of (n_analyses, representation_dim) arrays, one for every word
+        """
+        roots = [root for roots_for_word in sentence['morpho_analyzes_roots'] for root in roots_for_word]
+        morpho_tag_sequences = [morpho_tag_sequence
+                                for morpho_tag_sequences_for_word in sentence['morpho_analyzes_tags']
+                                for morpho_tag_sequence in morpho_tag_sequences_for_word]
+
+        root_representations = rectify(self.final_representations("char_lstm_layer_for_morph_analysis_roots",
+                                                                  "char_embeddings",
+                                                                  roots))
+
+        # analyses without any morpho tags are represented by a blank, i.e. zero, morpho tag embedding
+        if "morpho_tag_lstm_layer_for_morph_analysis_tags.sum.b" in self.arrays:
+            blank_representation = rectify(self.arrays["morpho_tag_lstm_layer_for_morph_analysis_tags.sum.b"])
+        else:
+            weights = [self._lstm_weights("morpho_tag_lstm_layer_for_morph_analysis_tags", 0, direction)
+                       for direction in ["fw", "bw"]]
+            blank_input = np.zeros((1, 1, self.parameters['mt_d']), dtype=self.arrays["morpho_tag_embeddings"].dtype)
+            blank_representation = rectify(np.concatenate([coupled_lstm_transduce(w, blank_input)[-1, 0]
+                                                           for w in weights]))
+        non_empty_sequences = [sequence for sequence in morpho_tag_sequences if len(sequence) > 0]
+        if len(non_empty_sequences) > 0:
+            non_empty_representations = iter(
+                rectify(self.final_representations("morpho_tag_lstm_layer_for_morph_analysis_tags",
+                                                   "morpho_tag_embeddings",
+                                                   non_empty_sequences)))
+        morpho_tag_representations = np.stack([next(non_empty_representations) if len(sequence) > 0
+                                               else blank_representation
+                                               for sequence in morpho_tag_sequences])
+
+        if self.parameters['tying_method']:
+            tied_representations = np.tanh(
+                np.dot(np.concatenate([root_representations, morpho_tag_representations], axis=1),
+                       self.arrays["tying_method_W"].T) + self.arrays["tying_method_b"])
+        else:
+            tied_representations = np.tanh(root_representations + morpho_tag_representations)
+
+        representations = []
+        start = 0
+        for roots_for_word in sentence['morpho_analyzes_roots']:
+            representations.append(tied_representations[start:start + len(roots_for_word)])
+            start += len(roots_for_word)
+        return representations
+
+    def disambiguate_morph_analyzes(self, sentence, context_representations):
+        """
+        :return: the representations of the candidate analyses of every word and the selected analysis indices
+        """
+        morph_analysis_representations = self.get_morph_analysis_representations(sentence)
+        transformed_contexts = np.tanh(np.dot(context_representations, self.arrays["transform_context_layer_W"].T) +
+                                       self.arrays["transform_context_layer_b"])
+        selected_morph_analysis_representations = []
+        for representations_for_word, transformed_context in zip(morph_analysis_representations,
+                                                                 transformed_contexts):
+            if representations_for_word.shape[0] == 1:
+                selected_morph_analysis_representations.append(0)
+            else:
+                # the softmax does not change the argmax
+                selected_morph_analysis_representations.append(
+                    int(np.argmax(np.dot(representations_for_word, transformed_context))))
+        return morph_analysis_representations, selected_morph_analysis_representations
+
+    def calculate_tag_scores(self, sentence):
+        """
+        :return: (n_words, n_tags) array of tag scores and the selected morphological analysis indices
+        """
+        combined_word_representations = self.get_combined_word_representations(sentence)
+        last_layer_outputs, layer_outputs = self.sentence_level_transduce(combined_word_representations)
+        context_representations = np.tanh(np.dot(last_layer_outputs, self.arrays["tanh_layer_W"].T) +
+                                          self.arrays["tanh_layer_b"])
+
+        selected_morph_analysis_representations = None
+        if self.parameters['active_models'] in [1, 2, 3]:
+            morph_analysis_representations, selected_morph_analysis_representations = \
+                self.disambiguate_morph_analyzes(sentence, layer_outputs[0])
+            if self.parameters['integration_mode'] == 2:
+                context_representations = np.concatenate(
+                    [context_representations,
+                     np.stack([representations_for_word[selected_idx]
+                               for representations_for_word, selected_idx in
+                               zip(morph_analysis_representations, selected_morph_analysis_representations)])],
+                    axis=1)
+
+        tag_scores = np.dot(context_representations, self.arrays["last_layer_W"].T) + self.arrays["last_layer_b"]
+        return tag_scores, selected_morph_analysis_representations
+
+    def predict(self, sentence, n_best=1):
+        """
+        Tags a sentence, see MainTaggerModel.predict.
+
+        :param sentence: whole sentence with input values as ids, as prepared by utils.loader.prepare_dataset
+        :return: the selected morphological analysis indices and the decoded tags
+        """
+        tag_scores, selected_morph_analysis_representations = self.calculate_tag_scores(sentence)
+        constrained = self.parameters.get('constrained_decoding', False)
+
+        if self.parameters['active_models'] in [0, 2, 3]:
+            if "crf_transitions" not in self.arrays:
+                if n_best > 1:
+                    raise Exception("n-best decoding requires the CRF, i.e. --crf 1")
+                decoded_tags = [int(tag_id) for tag_id in np.argmax(tag_scores, axis=1)]
+                if constrained:
+                    decoded_tags = repair_tag_ids(decoded_tags, self.id_to_tag, tag_scheme=self.parameters['t_s'])
+            else:
+                emissions = crf_numpy.pad_emissions(tag_scores)
+                transitions = self.arrays["crf_transitions"]
+                if n_best > 1:
+                    if constrained:
+                        transitions = crf_numpy.mask_transitions(transitions,
+                                                                 self.predecessor_index, self.predecessor_mask)
+                    decoded_tags = crf_numpy.viterbi_nbest(emissions, transitions, self.b_id, self.e_id, n_best)
+                elif constrained:
+                    decoded_tags, _ = crf_numpy.constrained_viterbi_decode(emissions, transitions,
+                                                                           self.b_id, self.e_id,
+                                                                           self.predecessor_index,
+                                                                           self.predecessor_mask)
+                else:
+                    decoded_tags, _ = crf_numpy.viterbi_decode(emissions, transitions, self.b_id, self.e_id)
+        else:
+            decoded_tags = []
+
+        if self.parameters['active_models'] not in [1, 2, 3]:
+            selected_morph_analysis_representations = []
+
+        return selected_morph_analysis_representations, decoded_tags
@@ -86,5 +86,104 @@ class BiLSTMMultiLayeredWithShortcutConnections(BiRNNBuilder):
             layer_outputs.append(es)
         return es, layer_outputs
 
-
-
+    def transduce_batch(self, sentences, bucket_width=0):
+        """
+        Batched version of transduce for several sentences.
+
+        The sentences are grouped into buckets of similar lengths and every bucket is padded to its
+        longest sentence, so each layer is run once per bucket with the sentences in the dynet batch
+        dimension. The backward RNNs run over the reversed sentences padded the same way, so in both
+        directions the padding only follows the real inputs and never reaches their outputs. Only the
+        outputs at real positions are concatenated and fed to the next layer, i.e. the padding is masked
+        out of the shortcut connections.
+
+        @param sentences: list of lists of Expression, i.e. the inputs of each sentence
+        @param bucket_width: sentences whose lengths fall into the same bucket_width wide range are
+            run together, 0 runs all the sentences in a single bucket
+        @return: list of (es, layer_outputs) pairs, one for each sentence, as returned by transduce
+        """
+        buckets = {}
+        for sentence_idx, es in enumerate(sentences):
+            bucket_id = (len(es) - 1) // bucket_width if bucket_width > 0 else 0
+            buckets.setdefault(bucket_id, []).append(sentence_idx)
+
+        results = [None] * len(sentences)
+        for bucket_id in sorted(buckets.keys()):
+            sentence_indices = buckets[bucket_id]
+            bucket_results = self._transduce_bucket([list(sentences[sentence_idx])
+                                                     for sentence_idx in sentence_indices])
+            for sentence_idx, result in zip(sentence_indices, bucket_results):
+                results[sentence_idx] = result
+        return results
+
+    def _transduce_bucket(self, sentences):
+
+        def run_padded(builder, padded_sentences):
+            """
+            Runs builder over the sentences padded at the end, returns the outputs at the real positions.
+            """
+            max_length = max([len(es) for es in padded_sentences])
+            input_dim = padded_sentences[0][0].dim()[0][0]
+            padding = dynet.inputVector([0.0] * input_dim)
+            inputs = [dynet.concatenate_to_batch([es[t] if t < len(es) else padding for es in padded_sentences])
+                      for t in range(max_length)]
+            outputs = builder.initial_state().transduce(inputs)
+            return [[dynet.pick_batch_elem(outputs[t], sentence_idx) for t in range(len(es))]
+                    for sentence_idx, es in enumerate(padded_sentences)]
+
+        original_inputs = sentences
+        layer_inputs = sentences
+        layer_outputs_for_sentences = [[] for _ in sentences]
+        for layer_idx, (fb, bb) in enumerate(self.builder_layers):
+            fss = run_padded(fb, layer_inputs)
+            bss = run_padded(bb, [list(reversed(es)) for es in layer_inputs])
+            next_layer_inputs = []
+            for sentence_idx, (original_input, fs, bs) in enumerate(zip(original_inputs, fss, bss)):
+                if self.shortcut_connections:
+                    es = [dynet.concatenate([original_input_item, f, b])
+                          for original_input_item, f, b in zip(original_input, fs, reversed(bs))]
+                else:
+                    es = [dynet.concatenate([f, b])
+                          for f, b in zip(fs, reversed(bs))]
+                layer_outputs_for_sentences[sentence_idx].append(es)
+                next_layer_inputs.append(es)
+            layer_inputs = next_layer_inputs
+        return [(es, layer_outputs) for es, layer_outputs in zip(layer_inputs, layer_outputs_for_sentences)]
+
+
+def get_final_representations_batch(builder, lookup_parameters, sequences, pad_id=0):
+    """
+    Encodes a set of id sequences, e.g. the characters of every word in a sentence or a minibatch,
+    with a single batched pass of the builder instead of one pass per sequence.
+
+    The sequences are padded to the longest one and every time step embeds the ids of all sequences
+    with lookup_batch. The backward direction runs over the reversed sequences padded the same way,
+    so the padding always comes after the last real input and the final state of a sequence is
+    read at its own last position, i.e. the padded steps are masked out of the representation.
+
+    @param builder: BiRNNBuilder with a single layer or a unidirectional builder, e.g. CoupledLSTMBuilder
+    @param lookup_parameters: LookupParameters holding the embeddings of the ids
+    @param sequences: list of id lists. An empty sequence, e.g. a word made of chars unseen in training,
+        is encoded as the single id pad_id, as there is no last position to read its state at.
+    @return: list of Expression, the forward and backward final states concatenated for every sequence
+    """
+    if len(sequences) == 0:
+        return []
+    sequences = [sequence if len(sequence) > 0 else [pad_id] for sequence in sequences]
+    max_length = max([len(sequence) for sequence in sequences])
+
+    def transduce_padded(rnn_builder, padded_sequences):
+        inputs = [dynet.lookup_batch(lookup_parameters,
+                                     [sequence[t] if t < len(sequence) else pad_id for sequence in padded_sequences])
+                  for t in range(max_length)]
+        outputs = rnn_builder.initial_state().transduce(inputs)
+        return [dynet.pick_batch_elem(outputs[len(sequence)-1], sequence_idx)
+                for sequence_idx, sequence in enumerate(padded_sequences)]
+
+    if isinstance(builder, BiRNNBuilder):
+        (fb, bb) = builder.builder_layers[0]
+        forward_states = transduce_padded(fb, sequences)
+        backward_states = transduce_padded(bb, [list(reversed(sequence)) for sequence in sequences])
+        return [dynet.concatenate([f, b]) for f, b in zip(forward_states, backward_states)]
+    else:
+        return transduce_padded(builder, sequences)
@@ -24,6 +24,10 @@ if not os.path.exists(eval_logs_dir):
 
 eval_script = os.path.join(eval_path, "conlleval-runner.sh")
 
+# version of the parameters saved with a model. The models saved before version 1 have no
+# 'model_format_version' and were built with a CRF even with crf=0, see MainTaggerModel.build
+MODEL_FORMAT_VERSION = 1
+
 
 class RegexpTokenizer():
 
@@ -231,6 +235,28 @@ def iobes_iob(tags):
     return new_tags
 
 
+def repair_tags(tags, tag_scheme="iobes"):
+    """
+    Turns a possibly invalid tag sequence, e.g. the output of greedy decoding, into a valid one
+    in the given tagging scheme. Entity continuations without a proper start open a new entity.
+    """
+    tags = iobes_iob(tags)
+    iob2(tags)
+    if tag_scheme == "iobes":
+        tags = iob_iobes(tags)
+    return tags
+
+
+def repair_tag_ids(tag_ids, id_to_tag, tag_scheme="iobes"):
+    """
+    repair_tags on tag ids. A repaired tag which is not among the tags of the model, e.g. S-X when
+    the training data had only multi token X entities, keeps the original tag id.
+    """
+    tag_to_id = {tag: tag_id for tag_id, tag in id_to_tag.items()}
+    repaired_tags = repair_tags([id_to_tag[tag_id] for tag_id in tag_ids], tag_scheme=tag_scheme)
+    return [tag_to_id.get(tag, tag_id) for tag, tag_id in zip(repaired_tags, tag_ids)]
+
+
 def insert_singletons(words, singletons, p=0.5):
     """
     Replace singletons by the unknown word with a probability p.
@@ -366,6 +392,19 @@ def read_args(evaluation=False, args_as_a_list=sys.argv[1:], for_xnlp=False):
             "-b", "--char_bidirect", default="1",
             type='int', help="Use a bidirectional LSTM for chars"
         )
+        optparser.add_option(
+            "--char_encoder", default="bilstm", choices=["bilstm", "cnn"],
+            help="Encoder of the chars of the words and of the roots of the analyses: a BiLSTM or "
+                 "convolutions of widths 2, 3 and 4 with max pooling"
+        )
+        optparser.add_option(
+            "--char_cache_size", default="100000",
+            type='int', help="Number of char representations of words cached at inference (0 to disable)"
+        )
+        optparser.add_option(
+            "--analysis_cache_size", default="100000",
+            type='int', help="Number of root and morpho tag sequence representations cached at inference (0 to disable)"
+        )
         # morpho_tag section
         optparser.add_option(
             "--morpho_tag_dim", default="100",
@@ -379,6 +418,11 @@ def read_args(evaluation=False, args_as_a_list=sys.argv[1:], for_xnlp=False):
             "--morpho_tag_bidirect", default="1",
             type='int', help="Use a bidirectional LSTM for morpho tags"
         )
+        optparser.add_option(
+            "--morpho_tag_encoder", default="bilstm", choices=["bilstm", "sum"],
+            help="Encoder of the morpho tag sequences of the analyses: a BiLSTM or a position weighted sum "
+                 "of the morpho tag embeddings"
+        )
         optparser.add_option(
             "--morpho_tag_type", default="char",
             help="Mode of morphological tag extraction"
@@ -387,6 +431,11 @@ def read_args(evaluation=False, args_as_a_list=sys.argv[1:], for_xnlp=False):
             "--morpho-tag-column-index", default="1",
             type='int', help="the index of the column which contains the morphological tags in the conll format"
         )
+        optparser.add_option(
+            "--max_analyses_per_word", default="0",
+            type='int', help="Keep only the most frequent analyses of every word by the morpho tag sequence "
+                             "frequencies of the training set (0 to keep all the analyses)"
+        )
         optparser.add_option(
             "--integration_mode", default="0",
             type='int', help="integration mode"
@@ -419,6 +468,16 @@ def read_args(evaluation=False, args_as_a_list=sys.argv[1:], for_xnlp=False):
             "-B", "--word_bidirect", default="1",
             type='int', help="Use a bidirectional LSTM for words"
         )
+        optparser.add_option(
+            "--train_batching", default="padded", choices=["padded", "autobatch"],
+            help="padded: the char and sentence level BiLSTMs run over padded batches, "
+                 "autobatch: the graph is built sentence by sentence for dynet's automatic batching"
+        )
+        optparser.add_option(
+            "--sentence_bucket_width", default="0",
+            type='int', help="Width of the sentence length ranges run together by the batched sentence level BiLSTM "
+                             "(0 to pad all the sentences of a batch to the longest one)"
+        )
         optparser.add_option(
             "-p", "--pre_emb", default="",
             help="Location of pretrained embeddings"
@@ -433,7 +492,19 @@ def read_args(evaluation=False, args_as_a_list=sys.argv[1:], for_xnlp=False):
         )
         optparser.add_option(
             "-f", "--crf", default="1",
-            type='int', help="Use CRF (0 to disable)"
+            type='int', help="Use CRF (0 to disable, i.e. use a per-token softmax with greedy decoding)"
+        )
+        optparser.add_option(
+            "--crf_objective", default="nll", choices=["nll", "margin"],
+            help="Training objective of the CRF: negative log likelihood or the Viterbi based structured hinge loss"
+        )
+        optparser.add_option(
+            "--loss_anomaly_threshold", default="1000.0",
+            type='float', help="Per-sentence loss magnitude above which a loss anomaly warning is logged"
+        )
+        optparser.add_option(
+            "--constrained_decoding", default="0",
+            type='int', help="Only decode tag sequences which are valid in the tagging scheme (1 to enable)"
         )
         optparser.add_option(
             "-D", "--dropout", default="0.5",
@@ -485,6 +556,15 @@ def read_args(evaluation=False, args_as_a_list=sys.argv[1:], for_xnlp=False):
             "--batch-size", default="5",
             type='int', help="Number of samples in one epoch"
         )
+        optparser.add_option(
+            "--eval-batch-size", default="16",
+            type='int', help="Number of sentences tagged together during evaluation"
+        )
+        optparser.add_option(
+            "--eval-workers", default="1",
+            type='int', help="Number of forked processes which tag the shards of every evaluation dataset, "
+                             "only on CPU, i.e. with --dynet-gpu 0"
+        )
         optparser.add_option(
             "--file_format", default="conll", choices=["conll", "conllu"],
             help="File format of the data files"
@@ -497,10 +577,29 @@ def read_args(evaluation=False, args_as_a_list=sys.argv[1:], for_xnlp=False):
             "--dynet-gpu", default="1",
             type='int', help="Use gpu or not"
         )
+        optparser.add_option(
+            "--dynet-autobatch", default="0", choices=["0", "1", "2"],
+            help="Automatic batching strategy of dynet, read by dynet itself: 0 (off), 1 (agenda based), "
+                 "2 (depth based)"
+        )
         optparser.add_option(
             "--port", default="8888",
             type='int', help="Webapp port to serve on localhost"
         )
+        optparser.add_option(
+            "--serving_tasks", default="ner",
+            help="Comma separated outputs computed by the webapp, ner and/or md. The NER tags are always "
+                 "computed, as they make up the response. The morphological analyses are not scored when "
+                 "they cannot affect the requested outputs"
+        )
+        optparser.add_option(
+            "--checkpoint_format", default="text", choices=["text", "quantized"],
+            help="Format of the saved checkpoints: dynet text format or int8 lookup tables and float16 weights"
+        )
+        optparser.add_option(
+            "--numpy-bundle-path", default="",
+            help="Path of the .npz bundle written by the export_numpy command, model.npz in the model epoch directory by default"
+        )
         if evaluation:
             optparser.add_option(
                 "--run-for-all-checkpoints", default="0",
@@ -518,11 +617,18 @@ def form_parameters_dict(opts):
     parameters['char_dim'] = opts.char_dim
     parameters['char_lstm_dim'] = opts.char_lstm_dim
     parameters['ch_b'] = opts.char_bidirect == 1
+    parameters['char_encoder'] = opts.char_encoder
+    parameters['train_batching'] = opts.train_batching
+    parameters['sentence_bucket_width'] = opts.sentence_bucket_width
+    parameters['char_cache_size'] = opts.char_cache_size
+    parameters['analysis_cache_size'] = opts.analysis_cache_size
 
     # morpho_tag section
     parameters['mt_d'] = opts.morpho_tag_dim
     parameters['mt_t'] = opts.morpho_tag_type
+    parameters['morpho_tag_encoder'] = opts.morpho_tag_encoder
     parameters['mt_ci'] = opts.morpho_tag_column_index
+    parameters['max_analyses_per_word'] = opts.max_analyses_per_word
     parameters['integration_mode'] = opts.integration_mode
     parameters['active_models'] = opts.active_models
 
@@ -540,16 +646,24 @@ def form_parameters_dict(opts):
     parameters['all_emb'] = opts.all_emb == 1
     parameters['cap_dim'] = opts.cap_dim
     parameters['crf'] = opts.crf == 1
+    parameters['crf_objective'] = opts.crf_objective
+    parameters['constrained_decoding'] = opts.constrained_decoding == 1
+    parameters['loss_anomaly_threshold'] = opts.loss_anomaly_threshold
     parameters['dropout'] = opts.dropout
     parameters['lr_method'] = opts.lr_method
     parameters['sparse_updates_enabled'] = opts.sparse_updates_enabled
 
     parameters['batch_size'] = opts.batch_size
+    parameters['eval_batch_size'] = opts.eval_batch_size
+    parameters['eval_workers'] = opts.eval_workers
 
     parameters['file_format'] = opts.file_format
     parameters['lang_name'] = opts.lang_name
 
     parameters['debug'] = 1 if opts.debug == 1 else 0
+    parameters['checkpoint_format'] = opts.checkpoint_format
+
+    parameters['model_format_version'] = MODEL_FORMAT_VERSION
 
     return parameters
 
@@ -0,0 +1,50 @@
+import logging
+
+import dynet
+
+logger = logging.getLogger("diagnostics")
+
+
+class LossAnomalyDetector(object):
+    """
+    Collects the per-sentence loss expressions of a batch while the graph is being built and checks
+    their magnitudes only after the forward computation of the whole batch, so that the checks do not
+    force any intermediate forward computations.
+    """
+
+    def __init__(self, threshold=1000.0):
+        self.threshold = threshold
+        self.records = []
+
+    def record(self, sentence_id, component, loss_expression):
+        """
+
+        :param sentence_id: id of the sentence given by prepare_dataset
+        :param component: name of the loss component, e.g. "crf" or "md"
+        :param loss_expression: scalar expression
+        """
+        self.records.append((sentence_id, component, loss_expression))
+
+    def clear(self):
+        self.records = []
+
+    def check(self):
+        """
+        Evaluates the recorded losses with a single forward computation, which reuses the values
+        already computed for the batch loss, and logs a warning for every loss above the threshold.
+
+        :return: list of (sentence_id, component, magnitude) for the anomalous losses
+        """
+        if len(self.records) == 0:
+            return []
+        magnitudes = dynet.concatenate([loss_expression for _, _, loss_expression in self.records]).npvalue()
+        magnitudes = magnitudes.reshape((-1,))
+
+        anomalies = []
+        for (sentence_id, component, _), magnitude in zip(self.records, magnitudes):
+            if magnitude > self.threshold:
+                anomalies.append((sentence_id, component, float(magnitude)))
+                logger.warning("Loss anomaly: sentence_id=%s component=%s magnitude=%f threshold=%f",
+                               sentence_id, component, magnitude, self.threshold)
+        self.clear()
+        return anomalies
@@ -1,13 +1,89 @@
 import os
 import shutil
 
+import numpy as np
+
+QUANTIZED_CHECKPOINT_FILENAME = "model.quantized.npz"
+# the word, char and morpho tag embedding tables, which are the large lookup parameters. The others, e.g.
+# the CRF transitions, are small and precision sensitive scoring tables, so they are kept as float32.
+INT8_LOOKUP_PARAMETER_NAMES = ["wordembeddings", "charembeddings"]
+
+
+def quantize_rows(matrix):
+    """
+    Per-row scaled int8 quantization, every row is scaled so that its largest magnitude maps to 127.
+
+    :return: int8 matrix and the float32 scale of every row
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    scales = np.max(np.abs(matrix), axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.round(matrix / scales[:, np.newaxis]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def dequantize_rows(quantized, scales):
+    return quantized.astype(np.float32) * scales[:, np.newaxis]
+
+
+def is_int8_lookup_parameter_name(name):
+    """
+    :param name: name of a lookup parameter as given by dynet, e.g. "/charembeddings_1"
+    """
+    base_name = name.strip("/").split("/")[-1]
+    return any(base_name == prefix or base_name.startswith(prefix + "_") for prefix in INT8_LOOKUP_PARAMETER_NAMES)
+
+
+def save_quantized(parameter_collection, filepath):
+    """
+    Writes the parameters in a compressed format: the embedding tables as per-row scaled int8, the
+    other lookup tables as float32 and the other parameters as float16.
+    """
+    arrays = {}
+    lookup_parameters = parameter_collection.lookup_parameters_list()
+    parameters = parameter_collection.parameters_list()
+    for idx, lookup_parameter in enumerate(lookup_parameters):
+        if is_int8_lookup_parameter_name(lookup_parameter.name()):
+            arrays["lookup_%d" % idx], arrays["lookup_%d_scales" % idx] = quantize_rows(lookup_parameter.as_array())
+        else:
+            arrays["lookup_%d" % idx] = lookup_parameter.as_array().astype(np.float32)
+    for idx, parameter in enumerate(parameters):
+        arrays["parameter_%d" % idx] = parameter.as_array().astype(np.float16)
+    arrays["lookup_names"] = np.array([p.name() for p in lookup_parameters], dtype=str)
+    arrays["parameter_names"] = np.array([p.name() for p in parameters], dtype=str)
+    with open(filepath, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def restore_quantized(parameter_collection, filepath):
+    """
+    Dequantizes a checkpoint written by save_quantized into the parameters of an identically built
+    parameter collection.
+    """
+    with np.load(filepath) as arrays:
+        lookup_parameters = parameter_collection.lookup_parameters_list()
+        parameters = parameter_collection.parameters_list()
+        assert list(arrays["lookup_names"]) == [p.name() for p in lookup_parameters] and \
+            list(arrays["parameter_names"]) == [p.name() for p in parameters], \
+            "The quantized checkpoint %s does not belong to this model" % filepath
+        for idx, lookup_parameter in enumerate(lookup_parameters):
+            if ("lookup_%d_scales" % idx) in arrays:
+                lookup_parameter.init_from_array(dequantize_rows(arrays["lookup_%d" % idx],
+                                                                 arrays["lookup_%d_scales" % idx]))
+            else:
+                lookup_parameter.init_from_array(arrays["lookup_%d" % idx])
+        for idx, parameter in enumerate(parameters):
+            parameter.set_value(arrays["parameter_%d" % idx].astype(np.float32))
+
 
 class DynetSaver():
 
-    def __init__(self, parameter_collection, checkpoint_dir, max_saves=3):
+    def __init__(self, parameter_collection, checkpoint_dir, max_saves=3, checkpoint_format="text"):
+        assert checkpoint_format in ["text", "quantized"]
         self.parameter_collection = parameter_collection
         self.checkpoint_dir = checkpoint_dir
         self.max_saves = max_saves
+        self.checkpoint_format = checkpoint_format
 
     def save(self, epoch=None, n_bests=None):
         assert epoch or (n_bests >= 0), "One of epoch or n_bests should be specified"
@@ -18,8 +94,20 @@ class DynetSaver():
         model_checkpoint_dir_path = os.path.join(self.checkpoint_dir, model_dir_path)
         if not os.path.exists(model_checkpoint_dir_path):
             os.mkdir(model_checkpoint_dir_path)
-        self.parameter_collection.save(os.path.join(model_checkpoint_dir_path,
-                                                    "model.ckpt"))
+        if self.checkpoint_format == "quantized":
+            save_quantized(self.parameter_collection,
+                           os.path.join(model_checkpoint_dir_path, QUANTIZED_CHECKPOINT_FILENAME))
+        else:
+            self.parameter_collection.save(os.path.join(model_checkpoint_dir_path,
+                                                        "model.ckpt"))
 
     def restore(self, filepath):
-        self.parameter_collection.populate(filepath)
+        """
+        Restores the text checkpoint at filepath or, if there is none, the quantized checkpoint
+        next to it.
+        """
+        quantized_filepath = os.path.join(os.path.dirname(filepath), QUANTIZED_CHECKPOINT_FILENAME)
+        if not os.path.exists(filepath) and os.path.exists(quantized_filepath):
+            restore_quantized(self.parameter_collection, quantized_filepath)
+        else:
+            self.parameter_collection.populate(filepath)
@@ -0,0 +1,195 @@
+import codecs
+import os
+import re
+import zlib
+
+import numpy as np
+
+from utils.lru_cache import LRUCache
+
+# alternative forms of a word which are tried when the word itself has no pretrained embedding
+PRETRAINED_EMBEDDING_FALLBACKS = [lambda word: word.lower(),
+                                  lambda word: re.sub('\\d', '0', word.lower())]
+
+
+class EmbeddingStore(object):
+    """
+    Binary version of a pretrained embeddings text file, made of a float32 matrix with one row per word
+    and a hashed word index (open addressing on the crc32 of the word). All the parts are memory-mapped,
+    so opening a store costs nothing and only the rows which are actually looked up are read from disk.
+
+    A store is a directory with the following files:
+        vectors.npy: (n_words, dim) float32 matrix
+        words.bin: utf-8 encoded words, one after the other
+        offsets.npy: (n_words+1,) offsets of the words in words.bin
+        index.npy: hash table of row+1 values, 0 marks an empty slot
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self.vectors = np.load(os.path.join(store_path, "vectors.npy"), mmap_mode='r')
+        self.offsets = np.load(os.path.join(store_path, "offsets.npy"), mmap_mode='r')
+        self.index = np.load(os.path.join(store_path, "index.npy"), mmap_mode='r')
+        self.words_blob = np.memmap(os.path.join(store_path, "words.bin"), dtype=np.uint8, mode='r') \
+            if os.path.getsize(os.path.join(store_path, "words.bin")) > 0 else np.zeros(0, dtype=np.uint8)
+        self.dim = self.vectors.shape[1]
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def __contains__(self, word):
+        return self.lookup(word) >= 0
+
+    def word(self, row):
+        return self.words_blob[self.offsets[row]:self.offsets[row+1]].tobytes().decode("utf-8")
+
+    def words(self):
+        for row in range(len(self)):
+            yield self.word(row)
+
+    def lookup(self, word):
+        """
+        :return: the row of the word, -1 if it is not in the store
+        """
+        encoded_word = word.encode("utf-8")
+        mask = len(self.index) - 1
+        slot = zlib.crc32(encoded_word) & mask
+        while self.index[slot] != 0:
+            row = int(self.index[slot]) - 1
+            if self.words_blob[self.offsets[row]:self.offsets[row+1]].tobytes() == encoded_word:
+                return row
+            slot = (slot + 1) & mask
+        return -1
+
+    def lookup_with_fallbacks(self, word, fallbacks):
+        """
+        :param fallbacks: functions which give the alternative forms of the word to try in order, e.g. lowercasing
+        :return: the row of the first form found in the store and the index of that form (0 for the word itself),
+            or (-1, -1)
+        """
+        for form_idx, form in enumerate([word] + [fallback(word) for fallback in fallbacks]):
+            row = self.lookup(form)
+            if row >= 0:
+                return row, form_idx
+        return -1, -1
+
+    @staticmethod
+    def default_store_path(ext_emb_path):
+        return ext_emb_path + ".store"
+
+    @classmethod
+    def open_or_convert(cls, ext_emb_path, word_dim):
+        """
+        Opens the store of a pretrained embeddings text file, converting the file first if there is no store
+        or if the store is older than the file.
+        """
+        store_path = cls.default_store_path(ext_emb_path)
+        if not os.path.exists(os.path.join(store_path, "index.npy")) or \
+                os.path.getmtime(os.path.join(store_path, "index.npy")) < os.path.getmtime(ext_emb_path):
+            cls.convert(ext_emb_path, store_path, word_dim)
+        store = cls(store_path)
+        assert store.dim == word_dim, "The embeddings in %s are not %d dimensional" % (store_path, word_dim)
+        return store
+
+    @staticmethod
+    def convert(ext_emb_path, store_path, word_dim):
+        """
+        Converts a pretrained embeddings text file with a word and its word_dim values on each line. Lines
+        with another number of fields are skipped. If a word occurs more than once, its last vector is kept.
+        """
+        print('Converting pretrained embeddings from %s to %s...' % (ext_emb_path, store_path))
+        if not os.path.exists(store_path):
+            os.makedirs(store_path)
+        elif os.path.exists(os.path.join(store_path, "index.npy")):
+            os.remove(os.path.join(store_path, "index.npy"))
+
+        n_valid_lines = 0
+        emb_invalid = 0
+        for line in codecs.open(ext_emb_path, 'r', 'utf-8'):
+            if len(line.split()) == word_dim + 1:
+                n_valid_lines += 1
+            else:
+                emb_invalid += 1
+        if emb_invalid > 0:
+            print('WARNING: %i invalid lines' % emb_invalid)
+
+        vectors = np.lib.format.open_memmap(os.path.join(store_path, "vectors.npy"), mode='w+',
+                                            dtype=np.float32, shape=(n_valid_lines, word_dim))
+        offsets = np.zeros(n_valid_lines + 1, dtype=np.int64)
+        index_size = 1
+        while index_size < 2 * n_valid_lines:
+            index_size *= 2
+        index = np.zeros(index_size, dtype=np.int64)
+        mask = index_size - 1
+        encoded_words = []
+
+        row = 0
+        with open(os.path.join(store_path, "words.bin"), "wb") as words_f:
+            for line in codecs.open(ext_emb_path, 'r', 'utf-8'):
+                line = line.split()
+                if len(line) != word_dim + 1:
+                    continue
+                encoded_word = line[0].encode("utf-8")
+                vectors[row] = np.array(line[1:], dtype=np.float32)
+                words_f.write(encoded_word)
+                encoded_words.append(encoded_word)
+                offsets[row+1] = offsets[row] + len(encoded_word)
+
+                slot = zlib.crc32(encoded_word) & mask
+                while index[slot] != 0 and encoded_words[index[slot] - 1] != encoded_word:
+                    slot = (slot + 1) & mask
+                # a later occurrence of a word replaces the earlier one
+                index[slot] = row + 1
+                row += 1
+
+        vectors.flush()
+        del vectors
+        np.save(os.path.join(store_path, "offsets.npy"), offsets)
+        # written last, as its presence marks a complete store
+        np.save(os.path.join(store_path, "index.npy"), index)
+
+
+class PagedEmbeddings(object):
+    """
+    Inference-only lookup table which stays in a memory-mapped .npy file. A row is read from the
+    file when it is first looked up and the most recently used rows are kept in a small cache.
+    Processes which open the same file share its pages, so every process only holds the rows it
+    actually touches.
+    """
+
+    def __init__(self, filepath, cache_size=1024):
+        """
+
+        :param cache_size: maximum number of rows kept in the hot row cache, 0 disables the cache
+        """
+        self.filepath = filepath
+        self.table = np.load(filepath, mmap_mode='r')
+        self.shape = self.table.shape
+        self.dtype = self.table.dtype
+        self.hot_rows = LRUCache(cache_size)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def row(self, idx):
+        row = self.hot_rows.get(idx)
+        if row is None:
+            row = np.array(self.table[idx])
+            self.hot_rows.put(idx, row)
+        return row
+
+    def __getitem__(self, ids):
+        """
+        :param ids: a row id or an array-like of row ids
+        :return: the rows, with the shape of ids followed by the embedding dimension
+        """
+        ids = np.asarray(ids)
+        if ids.ndim == 0:
+            return self.row(int(ids))
+        if ids.size == 0:
+            return np.zeros(ids.shape + self.shape[1:], dtype=self.dtype)
+        rows = np.stack([self.row(int(idx)) for idx in ids.reshape(-1)])
+        return rows.reshape(ids.shape + self.shape[1:])
+
+    def __repr__(self):
+        return "PagedEmbeddings(%s, shape=%s, %r)" % (self.filepath, self.shape, self.hot_rows)
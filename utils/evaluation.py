@@ -7,7 +7,10 @@
 from collections import defaultdict as dd
 import logging
 import math
+import multiprocessing
+import shutil
 import sys
+import tempfile
 
 import subprocess
 
@@ -19,7 +22,7 @@ import os
 import dynet
 
 from evaluation.conlleval import evaluate as conll_evaluate, report as conll_report, metrics
-from toolkit.joint_ner_and_md_model import MainTaggerModel
+from toolkit.joint_ner_and_md_model import MainTaggerModel, PREDICTION_TASKS
 from utils import eval_script, iobes_iob, eval_logs_dir
 from utils.loader import prepare_datasets, extract_mapping_dictionaries_from_model
 
@@ -27,14 +30,150 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("eval")
 
 
+# the model used by the evaluation worker processes, which inherit it when they are forked, and the
+# version of the parameters it holds, see EvaluationWorkerPool
+_eval_worker_model = None
+_eval_worker_parameters_version = 0
+
+
+def predict_in_batches(model, sentences, batch_size, show_progress=False, tasks=PREDICTION_TASKS):
+    """
+    Tags the sentences with MainTaggerModel.predict_batch, renewing the computation graph for every batch.
+
+    :return: list of the outputs of MainTaggerModel.predict, one for each sentence
+    """
+    predictions = []
+    for start in range(0, len(sentences), batch_size):
+        if show_progress:
+            sys.stdout.write(". ")
+            sys.stdout.flush()
+        # one computation graph for all the sentences in the batch
+        dynet.renew_cg()
+        predictions += model.predict_batch(sentences[start:start + batch_size], tasks=tasks)
+    if show_progress:
+        print("")
+    return predictions
+
+
+def _predict_shard(args):
+    sentences, batch_size, tasks, parameters_path, parameters_version = args
+    global _eval_worker_parameters_version
+    if parameters_version != _eval_worker_parameters_version:
+        _eval_worker_model.model.populate(parameters_path)
+        _eval_worker_model.clear_inference_caches()
+        _eval_worker_parameters_version = parameters_version
+    return predict_in_batches(_eval_worker_model, sentences, batch_size, tasks=tasks)
+
+
+def dynet_gpu_requested(argv=None):
+    """
+    Whether dynet may run on a GPU: if --dynet-devices is given, whether it lists a GPU, otherwise
+    unless --dynet-gpu 0 is given, as --dynet-gpu defaults to 1, and no GPU is requested with --dynet-gpus.
+    """
+    argv = sys.argv if argv is None else argv
+    dynet_gpu = "1"
+    for idx, arg in enumerate(argv):
+        if arg == "--dynet-devices" and idx + 1 < len(argv):
+            return "GPU" in argv[idx + 1]
+        elif arg.startswith("--dynet-devices="):
+            return "GPU" in arg
+        elif arg == "--dynet-gpu" and idx + 1 < len(argv):
+            dynet_gpu = argv[idx + 1]
+        elif arg.startswith("--dynet-gpu="):
+            dynet_gpu = arg.split("=", 1)[1]
+        elif arg.startswith("--dynet-gpus"):
+            dynet_gpu = "1"
+    return dynet_gpu != "0"
+
+
+class EvaluationWorkerPool(object):
+    """
+    Forked processes which tag the shards of the evaluation datasets, shared by all the evaluations of a
+    run, e.g. of every epoch of a training. Used as a context manager, which terminates the workers.
+
+    The workers are forked once and inherit the model, so the model should be built before. As the
+    parameters change between the evaluations, they are written to a temporary file before every
+    evaluation and the workers load them before tagging their next shard.
+
+    A GPU device cannot be shared with forked processes, so the datasets are tagged in the calling
+    process when dynet may run on a GPU.
+    """
+
+    def __init__(self, model, n_workers):
+        if n_workers > 1 and dynet_gpu_requested():
+            logger.warning("Tagging the evaluation datasets in a single process, as the %d evaluation workers "
+                           "cannot share a GPU device, use --dynet-gpu 0 to run them on CPU" % n_workers)
+            n_workers = 1
+        self.model = model
+        self.n_workers = n_workers
+        self.pool = None
+        self.parameters_dir = None
+        self.parameters_version = 0
+
+    def __enter__(self):
+        if self.n_workers > 1:
+            global _eval_worker_model
+            _eval_worker_model = self.model
+            self.parameters_dir = tempfile.mkdtemp(prefix="eval-workers-")
+            self.pool = multiprocessing.get_context("fork").Pool(self.n_workers)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.pool is not None:
+            if exc_type is None:
+                self.pool.close()
+            else:
+                self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            shutil.rmtree(self.parameters_dir, ignore_errors=True)
+        return False
+
+    def sync_parameters(self):
+        """
+        Writes the current parameters for the workers, called once before every evaluation.
+        """
+        if self.pool is not None:
+            self.parameters_version += 1
+            self.model.model.save(os.path.join(self.parameters_dir, "model.ckpt"))
+
+    def predict(self, sentences, batch_size, tasks=PREDICTION_TASKS):
+        """
+        Tags contiguous shards of the sentences in the workers, so that the predictions are merged back
+        in the order of the sentences.
+        """
+        if self.pool is None:
+            print(("n_batches: %d" % int(math.ceil(float(len(sentences)) / batch_size))))
+            return predict_in_batches(self.model, sentences, batch_size, show_progress=True, tasks=tasks)
+        shard_size = int(math.ceil(float(len(sentences)) / self.n_workers))
+        shards = [sentences[start:start + shard_size] for start in range(0, len(sentences), shard_size)]
+        print(("n_shards: %d" % len(shards)))
+        parameters_path = os.path.join(self.parameters_dir, "model.ckpt")
+        return [prediction
+                for predictions_for_the_shard in
+                self.pool.map(_predict_shard, [(shard, batch_size, tasks, parameters_path, self.parameters_version)
+                                               for shard in shards])
+                for prediction in predictions_for_the_shard]
+
+
 def eval_with_specific_model(model,
                              epoch,
                              datasets_to_be_predicted,
-                             return_datasets_with_predicted_labels=False):
+                             return_datasets_with_predicted_labels=False,
+                             n_workers=None,
+                             eval_worker_pool=None):
+
+    # type: (MainTaggerModel, int, dict, bool, int, EvaluationWorkerPool) -> object
+    if eval_worker_pool is None:
+        # the datasets are tagged in this process unless the caller explicitly asks for workers, which
+        # then only live for this evaluation. Training keeps a single pool for the whole run instead.
+        with EvaluationWorkerPool(model, n_workers if n_workers is not None else 1) as eval_worker_pool:
+            return eval_with_specific_model(model, epoch, datasets_to_be_predicted,
+                                            return_datasets_with_predicted_labels=return_datasets_with_predicted_labels,
+                                            eval_worker_pool=eval_worker_pool)
 
-    # type: (MainTaggerModel, int, dict, bool) -> object
     eval_dir = eval_logs_dir
-    batch_size = 1 # model.parameters['batch_size'] TODO: switch back for new models.
+    batch_size = model.parameters.get('eval_batch_size', 1)
     integration_mode = model.parameters['integration_mode']
     active_models = model.parameters['active_models']
     id_to_tag = model.id_to_tag
@@ -71,6 +210,8 @@ def eval_with_specific_model(model,
                                         for purpose in list(datasets_to_be_predicted[label].keys())}
                                 for label in list(datasets_to_be_predicted.keys())}
 
+    eval_worker_pool.sync_parameters()
+
     test_metrics = None
     # for dataset_label, dataset_as_list in datasets_to_be_predicted:
     for label in list(datasets_to_be_predicted.keys()):
@@ -89,69 +230,55 @@ def eval_with_specific_model(model,
             n_tags = len(id_to_tag)
             count = np.zeros((n_tags, n_tags), dtype=np.int32)
 
-            n_batches = int(math.ceil(float(len(dataset_as_list)) / batch_size))
-
             print("dataset_label: %s" % (label+"_"+purpose))
-            print(("n_batches: %d" % n_batches))
 
             debug = False
 
-            for batch_idx in range(n_batches):
-                # print("batch_idx: %d" % batch_idx)
-                sys.stdout.write(". ")
-                sys.stdout.flush()
-
-                sentences_in_the_batch = dataset_as_list[
-                                         (batch_idx * batch_size):((batch_idx + 1) * batch_size)]
-
-                for sentence in sentences_in_the_batch:
-                    dynet.renew_cg()
-
-                    sentence_length = len(sentence['word_ids'])
-
-                    if active_models in [2, 3] and label in "ner md".split(" "):
-                        selected_morph_analyzes, decoded_tags = model.predict(sentence)
-                        if debug:
-                            print("decoded_tags: ", decoded_tags)
-                            print("selected_morph_analyzes: ", selected_morph_analyzes)
-                    elif active_models in [1] and label == "md":
-                        selected_morph_analyzes, _ = model.predict(sentence)
-                    elif active_models in [0] and label == "ner":
-                        _, decoded_tags = model.predict(sentence)
-
-                    if active_models in [0, 2, 3] and label == "ner": # i.e. except MD
-                        p_tags = [id_to_tag[p_tag] for p_tag in decoded_tags]
-                        r_tags = [id_to_tag[r_tag] for r_tag in sentence['tag_ids']]
-                        if tag_scheme == 'iobes':
-                            p_tags = iobes_iob(p_tags)
-                            r_tags = iobes_iob(r_tags)
-
-                        for i, (y_pred, y_real) in enumerate(
-                                zip(decoded_tags, sentence['tag_ids'])):
-                            new_line = " ".join([sentence['str_words'][i]] + [r_tags[i], p_tags[i]])
-                            predictions.append(new_line)
-                            count[y_real, y_pred] += 1
-                        predictions.append("")
-
-                    if debug:
-                        print("predictions: ", predictions)
-
-                    if active_models in [1, 2, 3] and label == "md":
-                        n_correct_morph_disambs = \
-                            sum([x == y for x, y, z in zip(selected_morph_analyzes,
-                                                        sentence['golden_morph_analysis_indices'],
-                                                        sentence['morpho_analyzes_tags']) if len(z) > 1])
-                        total_correct_disambs[label][purpose] += n_correct_morph_disambs
-                        total_disamb_targets[label][purpose] += sum([1 for el in sentence['morpho_analyzes_tags'] if len(el) > 1])
-                        for key, value in [(len(el), x == y) for el, x, y in zip(sentence['morpho_analyzes_tags'],
-                                                               selected_morph_analyzes,
-                                                               sentence['golden_morph_analysis_indices'])]:
-                            if value:
-                                detailed_correct_disambs[label][purpose][key] += 1
-                            detailed_total_target_disambs[label][purpose][key] += 1
-                        # total_possible_analyzes += sum([len(el) for el in sentence['morpho_analyzes_tags'] if len(el) > 1])
-
-            print("")
+            predictions_for_the_dataset = eval_worker_pool.predict(dataset_as_list, batch_size, tasks={label})
+
+            for sentence, (selected_morph_analyzes, decoded_tags) in zip(dataset_as_list,
+                                                                         predictions_for_the_dataset):
+
+                if debug:
+                    print("decoded_tags: ", decoded_tags)
+                    print("selected_morph_analyzes: ", selected_morph_analyzes)
+
+                if active_models in [0, 2, 3] and label == "ner": # i.e. except MD
+                    p_tags = [id_to_tag[p_tag] for p_tag in decoded_tags]
+                    r_tags = [id_to_tag[r_tag] for r_tag in sentence['tag_ids']]
+                    if tag_scheme == 'iobes':
+                        p_tags = iobes_iob(p_tags)
+                        r_tags = iobes_iob(r_tags)
+
+                    for i, (y_pred, y_real) in enumerate(
+                            zip(decoded_tags, sentence['tag_ids'])):
+                        new_line = " ".join([sentence['str_words'][i]] + [r_tags[i], p_tags[i]])
+                        predictions.append(new_line)
+                        count[y_real, y_pred] += 1
+                    predictions.append("")
+
+                if debug:
+                    print("predictions: ", predictions)
+
+                if active_models in [1, 2, 3] and label == "md":
+                    # the targets are the words with more than one candidate analysis before any pruning
+                    # (see --max_analyses_per_word), and a pruned correct analysis (golden index -1) is
+                    # never selected, so it is counted as an error
+                    n_candidate_analyses = sentence.get('n_candidate_analyses',
+                                                        [len(el) for el in sentence['morpho_analyzes_tags']])
+                    n_correct_morph_disambs = \
+                        sum([x == y for x, y, z in zip(selected_morph_analyzes,
+                                                    sentence['golden_morph_analysis_indices'],
+                                                    n_candidate_analyses) if z > 1])
+                    total_correct_disambs[label][purpose] += n_correct_morph_disambs
+                    total_disamb_targets[label][purpose] += sum([1 for el in n_candidate_analyses if el > 1])
+                    for key, value in [(el, x == y) for el, x, y in zip(n_candidate_analyses,
+                                                           selected_morph_analyzes,
+                                                           sentence['golden_morph_analysis_indices'])]:
+                        if value:
+                            detailed_correct_disambs[label][purpose][key] += 1
+                        detailed_total_target_disambs[label][purpose][key] += 1
+                    # total_possible_analyzes += sum([len(el) for el in sentence['morpho_analyzes_tags'] if len(el) > 1])
 
             if active_models in [0, 2, 3] and label == "ner":
                 # Write predictions to disk and run CoNLL script externally
@@ -332,7 +459,7 @@ def extract_multi_token_entities(tag_sequence):
 
 
 
-def evaluate_model_dir_path(models_dir_path, model_dir_path, model_epoch_dir_path):
+def evaluate_model_dir_path(models_dir_path, model_dir_path, model_epoch_dir_path, n_workers=None):
 
     model, opts, parameters = initialize_model_with_pretrained_parameters(model_dir_path,
                                                                           model_epoch_dir_path,
@@ -352,23 +479,25 @@ def evaluate_model_dir_path(models_dir_path, model_dir_path, model_epoch_dir_pat
 
     f_scores, morph_accuracies, _ = predict_tags_given_model_and_input(data_dict,
                                                                        model,
-                                                                       return_result=False)
+                                                                       return_result=False,
+                                                                       n_workers=n_workers)
 
     print(f_scores)
     print(morph_accuracies)
 
 
-def predict_sentences_given_model(sentences_string, model):
+def predict_sentences_given_model(sentences_string, model, tasks=PREDICTION_TASKS):
     """
 
     :type sentences_string: string
     :type model: MainTaggerModel
     :param model:
         Mappings must be loaded.
+    :param tasks: the labels to predict, a subset of PREDICTION_TASKS
     """
 
     from utils import tokenize_sentences_string
-    from utils.loader import load_sentences, prepare_dataset
+    from utils.loader import load_sentences, prepare_dataset, load_morph_analysis_prior
 
     tokenized_sentences = tokenize_sentences_string(sentences_string)
 
@@ -405,7 +534,9 @@ def predict_sentences_given_model(sentences_string, model):
         model.parameters['lower'],
         model.parameters['mt_d'], model.parameters['mt_t'], model.parameters['mt_ci'],
         morpho_tag_separator=("+" if model.parameters['lang_name'] == "turkish" else "|"),
-        for_prediction=True
+        for_prediction=True,
+        morph_analysis_prior=load_morph_analysis_prior(model),
+        max_analyses_per_word=model.parameters.get('max_analyses_per_word', 0)
     )
 
     print("sentences_data: ", sentences_data)
@@ -414,12 +545,13 @@ def predict_sentences_given_model(sentences_string, model):
 
     datasets_to_be_tested = {label: {purpose: sentences_data
                                      for purpose in ["dev", "test"]}
-                             for label in ["ner", "md"]}
+                             for label in ["ner", "md"] if label in tasks}
 
     f_scores, morph_accuracies, labeled_sentences = \
         predict_tags_given_model_and_input(datasets_to_be_tested,
                                            model,
-                                           return_result=True)
+                                           return_result=True,
+                                           n_workers=1)
 
     print(labeled_sentences)
     return labeled_sentences, dataset_file_string
@@ -427,12 +559,14 @@ def predict_sentences_given_model(sentences_string, model):
 
 def predict_tags_given_model_and_input(datasets_to_be_tested,
                                        model,
-                                       return_result=False):
+                                       return_result=False,
+                                       n_workers=None):
 
     f_scores, morph_accuracies, labeled_sentences, _ = eval_with_specific_model(model,
                                                                              -1,
                                                                              datasets_to_be_tested,
-                                                                             return_result)
+                                                                             return_result,
+                                                                             n_workers=n_workers)
     return f_scores, morph_accuracies, labeled_sentences
 
 
@@ -465,7 +599,8 @@ def evaluate(sys_argv):
     evaluate_model_dir_path(
         models_dir_path=models_path,
         model_dir_path=opts.model_path,
-        model_epoch_dir_path=opts.model_epoch_path
+        model_epoch_dir_path=opts.model_epoch_path,
+        n_workers=opts.eval_workers
     )
 
 
@@ -501,4 +636,144 @@ def predict_from_stdin(sys_argv):
         # "ali ata bak\ndeneme deneme"
         print("Input sentence: %s", line)
         predict_sentences_given_model(line, model)
-        line = sys.stdin.readline()
\ No newline at end of file
+        line = sys.stdin.readline()
+
+    cache = model.char_representation_cache
+    print("Char representation cache: %d hits, %d misses, hit rate %.3f" % (cache.hits, cache.misses, cache.hit_rate()))
+
+
+def export_numpy(sys_argv):
+
+    from utils import read_args
+
+    opts = read_args(args_as_a_list=sys_argv[1:])
+
+    from utils.train import models_path
+
+    model, _, _ = initialize_model_with_pretrained_parameters(opts.model_path,
+                                                              opts.model_epoch_path,
+                                                              models_path)
+
+    numpy_bundle_path = opts.numpy_bundle_path
+    if not numpy_bundle_path:
+        numpy_bundle_path = os.path.join(models_path, opts.model_path, opts.model_epoch_path, "model.npz")
+
+    from toolkit.numpy_engine import word_embeddings_path
+
+    model.export_numpy(numpy_bundle_path)
+    print("Exported the parameters and the mappings to %s and the word embeddings to %s" %
+          (numpy_bundle_path, word_embeddings_path(numpy_bundle_path)))
+
+
+def quantization_report(sys_argv):
+    """
+    Writes the quantized version of a text checkpoint next to it and reports the checkpoint sizes,
+    the load times and the change in the dev and test scores.
+    """
+
+    import time
+
+    from utils import read_args
+    from utils.dynetsaver import QUANTIZED_CHECKPOINT_FILENAME, save_quantized, restore_quantized
+
+    opts = read_args(args_as_a_list=sys_argv[1:])
+
+    from utils.train import models_path
+
+    model, model_opts, parameters = initialize_model_with_pretrained_parameters(opts.model_path,
+                                                                                opts.model_epoch_path,
+                                                                                models_path)
+
+    data_dict, _, _, _, _, _ = prepare_datasets(model, model_opts, parameters, for_training=False)
+
+    checkpoint_dir_path = os.path.join(models_path, opts.model_path, opts.model_epoch_path)
+    text_checkpoint_path = os.path.join(checkpoint_dir_path, "model.ckpt")
+    quantized_checkpoint_path = os.path.join(checkpoint_dir_path, QUANTIZED_CHECKPOINT_FILENAME)
+
+    start_time = time.time()
+    model.saver.restore(text_checkpoint_path)
+    text_load_time = time.time() - start_time
+    model.clear_inference_caches()
+    text_f_scores, text_morph_accuracies, _ = predict_tags_given_model_and_input(data_dict, model)
+
+    save_quantized(model.model, quantized_checkpoint_path)
+    start_time = time.time()
+    restore_quantized(model.model, quantized_checkpoint_path)
+    quantized_load_time = time.time() - start_time
+    model.clear_inference_caches()
+    quantized_f_scores, quantized_morph_accuracies, _ = predict_tags_given_model_and_input(data_dict, model)
+
+    print("Quantized checkpoint: %s" % quantized_checkpoint_path)
+    print("Checkpoint size: text %d bytes, quantized %d bytes" % (os.path.getsize(text_checkpoint_path),
+                                                                  os.path.getsize(quantized_checkpoint_path)))
+    print("Load time: text %.3f seconds, quantized %.3f seconds" % (text_load_time, quantized_load_time))
+    for metric_name, text_scores, quantized_scores in [("NER F1", text_f_scores, quantized_f_scores),
+                                                       ("MD accuracy", text_morph_accuracies,
+                                                        quantized_morph_accuracies)]:
+        for label in sorted(text_scores.keys()):
+            for purpose in sorted(text_scores[label].keys()):
+                print("%s %s_%s: text %lf, quantized %lf, delta %lf" % (metric_name, label, purpose,
+                                                                       text_scores[label][purpose],
+                                                                       quantized_scores[label][purpose],
+                                                                       quantized_scores[label][purpose] -
+                                                                       text_scores[label][purpose]))
+
+
+def analysis_pruning_report(sys_argv):
+    """
+    Reports the scores and the tagging speed of a model with all the candidate analyses of every word
+    and with only the --max_analyses_per_word most frequent ones.
+    """
+
+    import pickle
+    import time
+
+    from utils import read_args
+    from utils.loader import _prepare_datasets, estimate_morph_analysis_prior, morph_analysis_prior_path
+
+    opts = read_args(args_as_a_list=sys_argv[1:])
+    assert opts.max_analyses_per_word > 0, "--max_analyses_per_word should be positive"
+
+    from utils.train import models_path
+
+    model, model_opts, parameters = initialize_model_with_pretrained_parameters(opts.model_path,
+                                                                                opts.model_epoch_path,
+                                                                                models_path)
+
+    if not os.path.exists(morph_analysis_prior_path(model)):
+        # the model has been trained with all the analyses, so the prior is estimated here
+        training_sets, _, _ = _prepare_datasets(model_opts, parameters, for_training=True)
+        morph_analysis_prior = estimate_morph_analysis_prior(
+            training_sets['ner']['train'] + training_sets['md']['train'],
+            morpho_tag_column_index=parameters['mt_ci'],
+            file_format=parameters['file_format'],
+            morpho_tag_separator=("+" if parameters['lang_name'] == "turkish" else "|"))
+        with open(morph_analysis_prior_path(model), 'wb') as f:
+            pickle.dump(morph_analysis_prior, f)
+
+    scores = {}
+    for max_analyses_per_word in [0, opts.max_analyses_per_word]:
+        parameters['max_analyses_per_word'] = max_analyses_per_word
+        model.parameters['max_analyses_per_word'] = max_analyses_per_word
+        data_dict, _, _, _, _, _ = prepare_datasets(model, model_opts, parameters, for_training=False)
+        n_sentences = sum([len(data_dict[label][purpose]) for label in data_dict for purpose in data_dict[label]])
+
+        model.clear_inference_caches()
+        start_time = time.time()
+        f_scores, morph_accuracies, _ = predict_tags_given_model_and_input(data_dict, model)
+        scores[max_analyses_per_word] = (f_scores, morph_accuracies, n_sentences / (time.time() - start_time))
+
+    all_f_scores, all_morph_accuracies, all_speed = scores[0]
+    pruned_f_scores, pruned_morph_accuracies, pruned_speed = scores[opts.max_analyses_per_word]
+    print("Speed: all analyses %.2f sentences/sec, top %d analyses %.2f sentences/sec" %
+          (all_speed, opts.max_analyses_per_word, pruned_speed))
+    for metric_name, all_scores, pruned_scores in [("NER F1", all_f_scores, pruned_f_scores),
+                                                   ("MD accuracy", all_morph_accuracies, pruned_morph_accuracies)]:
+        for label in sorted(all_scores.keys()):
+            for purpose in sorted(all_scores[label].keys()):
+                print("%s %s_%s: all analyses %lf, top %d analyses %lf, delta %lf" % (
+                    metric_name, label, purpose,
+                    all_scores[label][purpose],
+                    opts.max_analyses_per_word,
+                    pruned_scores[label][purpose],
+                    pruned_scores[label][purpose] - all_scores[label][purpose]))
@@ -3,13 +3,13 @@ from functools import partial
 import itertools
 import json
 import os
+import pickle
 import re
 import codecs
 
 from utils import create_dico, create_mapping, zero_digits
 from utils import iob2, iob_iobes
-
-from toolkit.joint_ner_and_md_model import MainTaggerModel
+from utils.embedding_store import EmbeddingStore, PRETRAINED_EMBEDDING_FALLBACKS
 
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -400,6 +400,52 @@ def extract_all_analyses_from_conllu(word):
         return []
 
 
+def analysis_signature(analysis, morpho_tag_separator="+"):
+    """
+    The morpho tags of an analysis without its root, e.g. Noun+A3sg+Pnon+Nom for ev+Noun+A3sg+Pnon+Nom
+    """
+    return morpho_tag_separator.join(analysis.split(morpho_tag_separator)[1:])
+
+
+def estimate_morph_analysis_prior(sentences, morpho_tag_column_index=1, file_format="conll",
+                                  morpho_tag_separator="+"):
+    """
+    Counts how many times every morpho tag sequence is the correct analysis of a word.
+
+    :return: dict from analysis signatures to counts
+    """
+    prior = {}
+    for sentence in sentences:
+        for word in sentence:
+            if file_format == "conll":
+                correct_analysis = word[morpho_tag_column_index]
+            elif contains_golden_label(word, "CORRECT_ANALYSIS"):
+                correct_analysis = extract_correct_analysis_from_conllu(word)
+            else:
+                continue
+            signature = analysis_signature(correct_analysis, morpho_tag_separator)
+            prior[signature] = prior.get(signature, 0) + 1
+    return prior
+
+
+def select_top_analyses(analyses, prior, max_analyses, golden_idx=None, morpho_tag_separator="+"):
+    """
+    Picks the max_analyses analyses with the largest prior counts, the earlier analyses first among equal counts.
+
+    :param golden_idx: index of the correct analysis, which is always kept if given
+    :return: the indices of the kept analyses, in their original order
+    """
+    if len(analyses) <= max_analyses:
+        return list(range(len(analyses)))
+    ranked_indices = sorted(range(len(analyses)),
+                            key=lambda idx: (-prior.get(analysis_signature(analyses[idx], morpho_tag_separator), 0),
+                                             idx))
+    kept_indices = ranked_indices[:max_analyses]
+    if golden_idx is not None and golden_idx not in kept_indices:
+        kept_indices[-1] = golden_idx
+    return sorted(kept_indices)
+
+
 def is_number(s):
     try:
         float(s)
@@ -471,18 +517,34 @@ def prepare_dataset(sentences,
                     morpho_tag_column_index=1,
                     file_format="conll",
                     morpho_tag_separator="+",
-                    for_prediction=True):
+                    for_prediction=True,
+                    morph_analysis_prior=None,
+                    max_analyses_per_word=0,
+                    keep_golden_analysis=False,
+                    dataset_name=None):
     """
     Prepare the dataset. Return a list of lists of dictionaries containing:
         - word indexes
         - word char indexes
         - tag indexes
+
+    If max_analyses_per_word is positive, only that many candidate analyses of every word are kept,
+    the most frequent ones by morph_analysis_prior (see estimate_morph_analysis_prior). With
+    keep_golden_analysis, the correct analysis is always among them, otherwise a pruned correct
+    analysis gets the golden index -1. The numbers of candidate analyses before the pruning are kept in
+    'n_candidate_analyses' for the evaluation.
+
+    The 'sentence_id' of every sentence is its index, prefixed with dataset_name, e.g. "ner_train:17",
+    so that the sentences of different datasets can be told apart.
     """
 
     def lower_or_not(x): return x.lower() if lower else x
     data = []
+    n_analyses_before_pruning = 0
+    n_analyses_after_pruning = 0
+    n_pruned_golden_analyses = 0
 
-    for sentence in sentences:
+    for sentence_id, sentence in enumerate(sentences):
         # surface form related
         surface_form_index = 0
         if file_format == "conll":
@@ -623,10 +685,13 @@ def prepare_dataset(sentences,
             return turkish_lower(s.replace("+Prop", ""))
 
         golden_analysis_indices = []
+        # words without a correct analysis get the placeholder golden index 0, which is not remapped by the pruning
+        has_golden_analysis = []
         if file_format == "conll" or (file_format == "conllu"):
             for w_idx in range(len(sentence)):
                 if not(contains_golden_label(sentence[w_idx], "CORRECT_ANALYSIS") and contains_golden_label(sentence[w_idx], "ALL_ANALYSES")):
                     golden_analysis_idx = 0
+                    has_golden_analysis.append(False)
                 else:
                     found = False
                     try:
@@ -656,9 +721,32 @@ def prepare_dataset(sentences,
                         golden_analysis_idx < 0 or \
                         golden_analysis_idx >= len(morph_analyses_roots[w_idx]):
                         logging.error("BEEP at golden analysis idx")
+                    has_golden_analysis.append(True)
                 golden_analysis_indices.append(golden_analysis_idx)
 
+        n_candidate_analyses = [len(analyses_for_word) for analyses_for_word in morph_analyses_tags]
+        if max_analyses_per_word > 0 and morph_analysis_prior is not None:
+            for w_idx in range(len(all_analyses)):
+                if w_idx < len(has_golden_analysis) and has_golden_analysis[w_idx]:
+                    golden_analysis_idx = golden_analysis_indices[w_idx]
+                else:
+                    golden_analysis_idx = None
+                kept_indices = select_top_analyses(all_analyses[w_idx], morph_analysis_prior, max_analyses_per_word,
+                                                   golden_idx=golden_analysis_idx if keep_golden_analysis else None,
+                                                   morpho_tag_separator=morpho_tag_separator)
+                n_analyses_before_pruning += len(all_analyses[w_idx])
+                n_analyses_after_pruning += len(kept_indices)
+                morph_analyses_tags[w_idx] = [morph_analyses_tags[w_idx][idx] for idx in kept_indices]
+                morph_analyses_roots[w_idx] = [morph_analyses_roots[w_idx][idx] for idx in kept_indices]
+                if golden_analysis_idx is not None:
+                    if golden_analysis_idx in kept_indices:
+                        golden_analysis_indices[w_idx] = kept_indices.index(golden_analysis_idx)
+                    else:
+                        golden_analysis_indices[w_idx] = -1
+                        n_pruned_golden_analyses += 1
+
         data_item = {
+            'sentence_id': ("%s:%d" % (dataset_name, sentence_id)) if dataset_name else sentence_id,
             'str_words': surface_forms,
 
             'word_ids': words,
@@ -667,6 +755,7 @@ def prepare_dataset(sentences,
 
             'morpho_analyzes_tags': morph_analyses_tags,
             'morpho_analyzes_roots': morph_analyses_roots,
+            'n_candidate_analyses': n_candidate_analyses,
 
             'char_lengths': [len(char) for char in chars],
             'sentence_lengths': len(sentence),
@@ -700,6 +789,14 @@ def prepare_dataset(sentences,
 
         data.append(data_item)
 
+    if n_analyses_before_pruning > 0:
+        n_words = sum([len(sentence) for sentence in sentences])
+        print("Pruned the analyses to at most %d per word: %.2f -> %.2f analyses per word, "
+              "the correct analysis is pruned for %d words" % (max_analyses_per_word,
+                                                               float(n_analyses_before_pruning) / n_words,
+                                                               float(n_analyses_after_pruning) / n_words,
+                                                               n_pruned_golden_analyses))
+
     logging.info("Sorting the dataset by sentence length..")
     data_sorted_by_sentence_length = sorted(data, key=lambda x: x['sentence_lengths'])
     stats = [[data_item['sentence_lengths'],
@@ -729,37 +826,30 @@ def prepare_dataset(sentences,
     return buckets, stats, n_unique_words, data
 
 
-def augment_with_pretrained(dictionary, ext_emb_path, words):
+def augment_with_pretrained(dictionary, ext_emb_path, words, word_dim):
     """
     Augment the dictionary with words that have a pretrained embedding.
     If `words` is None, we add every word that has a pretrained embedding
     to the dictionary, otherwise, we only add the words that are given by
     `words` (typically the words in the development and test sets.)
+    The pretrained embeddings are read from their memory-mapped store, see EmbeddingStore.
     """
     print('Loading pretrained embeddings from %s...' % ext_emb_path)
     assert os.path.isfile(ext_emb_path)
 
-    # Load pretrained embeddings from file
-    pretrained = set([
-        line.split()[0].strip()
-        for line in codecs.open(ext_emb_path, 'r', 'utf-8')
-        if len(ext_emb_path) > 0
-    ])
+    pretrained = EmbeddingStore.open_or_convert(ext_emb_path, word_dim)
 
     # We either add every word in the pretrained file,
     # or only words given in the `words` list to which
     # we can assign a pretrained embedding
     if words is None:
-        for word in pretrained:
+        for word in pretrained.words():
             if word not in dictionary:
                 dictionary[word] = 0
     else:
         for word in words:
-            if any(x in pretrained for x in [
-                word,
-                word.lower(),
-                re.sub('\d', '0', word.lower())
-            ]) and word not in dictionary:
+            if word not in dictionary and \
+                    pretrained.lookup_with_fallbacks(word, PRETRAINED_EMBEDDING_FALLBACKS)[0] >= 0:
                 dictionary[word] = 0
 
     word_to_id, id_to_word = create_mapping(dictionary)
@@ -818,7 +908,8 @@ def create_mappings(training_sets, parameters, file_format="conll",
                 [[w[0] for w in s] for s in
                  training_sets['ner']['dev'] + training_sets['md']['dev'] +
                  training_sets['ner']['test'] + training_sets['md']['test']])
-            ) if not parameters['all_emb'] else None
+            ) if not parameters['all_emb'] else None,
+            parameters['word_dim']
         )
     else:
         dico_words, word_to_id, id_to_word = word_mapping(training_sets['ner']['train'] + training_sets['md']['train'],
@@ -862,6 +953,23 @@ def create_mappings(training_sets, parameters, file_format="conll",
            morpho_tag_to_id, id_to_morpho_tag
 
 
+MORPH_ANALYSIS_PRIOR_FILENAME = "morph_analysis_prior.pkl"
+
+
+def morph_analysis_prior_path(model):
+    return os.path.join(os.path.dirname(model.mappings_path), MORPH_ANALYSIS_PRIOR_FILENAME)
+
+
+def load_morph_analysis_prior(model):
+    """
+    :return: the morph analysis prior estimated when the model was trained, None if the model keeps all the analyses
+    """
+    if model.parameters.get('max_analyses_per_word', 0) <= 0:
+        return None
+    with open(morph_analysis_prior_path(model), 'rb') as f:
+        return pickle.load(f)
+
+
 def prepare_datasets(model, opts, parameters, for_training=True, do_xnlp=False):
     """
 
@@ -909,6 +1017,20 @@ def prepare_datasets(model, opts, parameters, for_training=True, do_xnlp=False):
         print('Saving the mappings to disk...')
         model.save_mappings(id_to_word, id_to_char, id_to_tag, id_to_morpho_tag)
 
+    # the analyses are pruned by the frequencies of the correct analyses in the training set
+    morph_analysis_prior = None
+    if parameters.get('max_analyses_per_word', 0) > 0:
+        if for_training and not do_xnlp:
+            morph_analysis_prior = estimate_morph_analysis_prior(
+                training_sets['ner']['train'] + training_sets['md']['train'],
+                morpho_tag_column_index=parameters['mt_ci'],
+                file_format=parameters['file_format'],
+                morpho_tag_separator=("+" if model.parameters['lang_name'] == "turkish" else ud_morpho_tag_separator))
+            with open(morph_analysis_prior_path(model), 'wb') as f:
+                pickle.dump(morph_analysis_prior, f)
+        else:
+            morph_analysis_prior = load_morph_analysis_prior(model)
+
     data_dict = {"ner": {}, "md": {}}
     unique_words_dict = {"ner": {}, "md": {}}
     stats_dict = {"ner": {}, "md": {}}
@@ -923,7 +1045,11 @@ def prepare_datasets(model, opts, parameters, for_training=True, do_xnlp=False):
                                         word_to_id, char_to_id, tag_to_id, morpho_tag_to_id,
                                         parameters['lower'], parameters['mt_d'], parameters['mt_t'], parameters['mt_ci'],
                                         file_format=parameters['file_format'],
-                                        morpho_tag_separator=("+" if model.parameters['lang_name'] == "turkish" else ud_morpho_tag_separator))
+                                        morpho_tag_separator=("+" if model.parameters['lang_name'] == "turkish" else ud_morpho_tag_separator),
+                                        morph_analysis_prior=morph_analysis_prior,
+                                        max_analyses_per_word=parameters.get('max_analyses_per_word', 0),
+                                        keep_golden_analysis=(purpose == "train"),
+                                        dataset_name=(label + "_" + purpose))
 
     for label in ["ner", "md"]:
         print(label)
@@ -933,7 +1059,10 @@ def prepare_datasets(model, opts, parameters, for_training=True, do_xnlp=False):
                 word_to_id, char_to_id, tag_to_id, morpho_tag_to_id,
                 parameters['lower'], parameters['mt_d'], parameters['mt_t'], parameters['mt_ci'],
                 file_format=parameters['file_format'],
-                morpho_tag_separator=("+" if model.parameters['lang_name'] == "turkish" else ud_morpho_tag_separator))
+                morpho_tag_separator=("+" if model.parameters['lang_name'] == "turkish" else ud_morpho_tag_separator),
+                morph_analysis_prior=morph_analysis_prior,
+                max_analyses_per_word=parameters.get('max_analyses_per_word', 0),
+                dataset_name=(label + "_test"))
 
     if for_training or do_xnlp:
         for label in ["ner", "md"]:
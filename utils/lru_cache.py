@@ -0,0 +1,54 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A bounded mapping which evicts the least recently used entry when it is full.
+    It counts the lookups which are found in the cache (hits) and the ones which are not (misses).
+    """
+
+    def __init__(self, capacity):
+        """
+
+        :param capacity: maximum number of entries, 0 disables the cache
+        """
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        else:
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self):
+        n_lookups = self.hits + self.misses
+        return float(self.hits) / n_lookups if n_lookups > 0 else 0.0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return "LRUCache(size=%d, capacity=%d, hits=%d, misses=%d)" % (len(self), self.capacity,
+                                                                       self.hits, self.misses)
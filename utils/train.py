@@ -12,7 +12,7 @@ import os
 
 import numpy as np
 
-from utils.evaluation import eval_with_specific_model
+from utils.evaluation import EvaluationWorkerPool, eval_with_specific_model
 from utils.loader import prepare_datasets
 
 from toolkit.joint_ner_and_md_model import MainTaggerModel
@@ -48,6 +48,10 @@ def train(sys_argv):
 
     print("MainTaggerModel location: {}".format(model.model_path))
 
+    if model.parameters.get('train_batching', 'padded') == 'autobatch' and opts.dynet_autobatch == "0":
+        logger.warning("--train_batching autobatch relies on dynet's automatic batching, "
+                       "which is off without --dynet-autobatch 1 or 2")
+
     # Prepare the data
     # dev_data, _, \
     # id_to_tag, tag_scheme, test_data, \
@@ -88,112 +92,123 @@ def train(sys_argv):
     def update_loss(sentences_in_the_batch, loss_function):
 
         loss = loss_function(sentences_in_the_batch)
+        if loss is None:
+            # e.g. every predicted path is the golden path with the margin objective, so skip the backward pass
+            return 0.0
+        # the single forward computation of the batch, the anomaly checks reuse its values
+        loss_value = loss.value()
+        model.loss_anomaly_detector.check()
         loss.backward()
         model.trainer.update()
-        if loss.value() / batch_size >= (10000000000.0 - 1):
-            logging.error("BEEP")
-
-        return loss.value()
-
-    for epoch_no in range(starting_epoch_no, maximum_epoch_no+1):
-        start_time = time.time()
-        epoch_costs = []
-        print("Starting epoch {}...".format(epoch_no))
-
-        n_samples_trained = 0
-
-        loss_configuration_parameters = {}
-
-        train_data = []
-        for label in ["ner", "md"]:
-            for purpose in ["train"]:
-                train_data += data_dict[label][purpose]
-
-        shuffled_data = list(train_data)
-        random.shuffle(shuffled_data)
-
-        index = 0
-        while index < len(shuffled_data):
-            batch_data = shuffled_data[index:(index + batch_size)]
-            epoch_costs += [update_loss(batch_data,
-                            loss_function=partial(model.get_loss,
-                                                  loss_configuration_parameters=loss_configuration_parameters))]
-            n_samples_trained += batch_size
-            index += batch_size
-
-            if n_samples_trained % 50 == 0 and n_samples_trained != 0:
-                sys.stdout.write("%s%f " % ("G", np.mean(epoch_costs[-50:])))
-                sys.stdout.flush()
-                if np.mean(epoch_costs[-50:]) > 100:
-                    logging.error("BEEP")
-
-        print("")
-        print("Epoch {epoch_no} Avg. loss over training set: {epoch_loss_mean}".format(epoch_no=epoch_no,
-                                                                                       epoch_loss_mean=np.mean(epoch_costs)))
-
-        model.trainer.status()
-
-        last_N_epochs_avg_loss_values = last_N_epochs_avg_loss_values[1:] + [np.mean(epoch_costs)]
-
-        # datasets_to_be_tested = {"ner": {"dev": data_dict["ner"]["dev"], "test": data_dict["ner"]["test"]},
-        #                          "md": {"dev": data_dict["md"]["dev"], "test": data_dict["md"]["test"]}}
-
-        datasets_to_be_tested = {label: {purpose: data_dict[label][purpose]
-                                         for purpose in ["dev", "test"] if purpose in data_dict[label]}
-                                 for label in ["ner", "md"]}
-
-        f_scores, morph_accuracies, _, test_metrics = eval_with_specific_model(model,
-                                                                 epoch_no,
-                                                                 datasets_to_be_tested,
-                                                                 return_datasets_with_predicted_labels=False)
-
-        metrics_by_type = test_metrics[1]
-
-        if model.parameters['active_models'] in [0, 2, 3]:
-            if "dev" in f_scores["ner"]:
-                if best_dev < f_scores["ner"]["dev"]:
-                    print("NER Epoch: %d New best dev score => best_dev, best_test: %lf %lf" % (epoch_no,
-                                                                                                       f_scores["ner"]["dev"],
-                                                                                                       f_scores["ner"]["test"]))
-                    print("NER Epoch: %d |" % epoch_no + "|".join(["%s: %2.3lf" % (entity_type, m.fscore)
-                                                       for entity_type, m in sorted(metrics_by_type.items(), key=lambda x: x[0])]))
-                    last_epoch_with_best_scores = epoch_no
-                    best_dev = f_scores["ner"]["dev"]
-                    best_test = f_scores["ner"]["test"]
-                    model.save(epoch_no)
-                    model.save_best_performances_and_costs(epoch_no,
-                                                           best_performances=[f_scores["ner"]["dev"], f_scores["ner"]["test"]],
-                                                           epoch_costs=epoch_costs)
-                    model_epoch_dir_path = "model-epoch-%08d" % epoch_no
-                    print("LOG: model_epoch_dir_path: {}".format(model_epoch_dir_path))
-                else:
-                    print("NER Epoch: %d Best dev and accompanying test score, best_dev, best_test: %lf %lf" % (epoch_no,
-                                                                                                           best_dev,
-                                                                                                           best_test))
-                    print("NER Epoch: %d |" % epoch_no + "|".join(["%s: %2.3lf" % (entity_type, m.fscore)
-                                                        for entity_type, m in
-                                                        sorted(metrics_by_type.items(), key=lambda x: x[0])]))
-
-        if model.parameters['active_models'] in [1, 2, 3]:
-            if "dev" in morph_accuracies["md"]:
-                if best_morph_dev < morph_accuracies["md"]["dev"]:
-                    print("MORPH Epoch: %d New best dev score => best_dev, best_test: %lf %lf" %
-                          (epoch_no, morph_accuracies["md"]["dev"], morph_accuracies["md"]["test"]))
-                    best_morph_dev = morph_accuracies["md"]["dev"]
-                    best_morph_test = morph_accuracies["md"]["test"]
-                else:
-                    print("MORPH Epoch: %d Best dev and accompanying test score, best_dev, best_test: %lf %lf"
-                          % (epoch_no, best_morph_dev, best_morph_test))
-
-        print("Epoch {} done. Average cost: {}".format(epoch_no, np.mean(epoch_costs)))
-        print("MainTaggerModel dir: {}".format(model.model_path))
-        print("Training took {} seconds for this epoch".format(time.time()-start_time))
-
-        if epoch_no-last_epoch_with_best_scores == 0 or epoch_no < last_epoch_with_best_scores + 10:
-            print("Continue to train as the last peoch with best scores was only %d epochs before" % (epoch_no-last_epoch_with_best_scores))
-        else:
-            print("Stop training as the last epoch with best scores was %d epochs before" % (epoch_no-last_epoch_with_best_scores))
-            break
+
+        return loss_value
+
+    # the evaluation workers, if any, are forked once for the whole training
+    with EvaluationWorkerPool(model, model.parameters.get('eval_workers', 1)) as eval_worker_pool:
+        for epoch_no in range(starting_epoch_no, maximum_epoch_no+1):
+            start_time = time.time()
+            epoch_costs = []
+            print("Starting epoch {}...".format(epoch_no))
+
+            n_samples_trained = 0
+
+            loss_configuration_parameters = {}
+
+            train_data = []
+            for label in ["ner", "md"]:
+                for purpose in ["train"]:
+                    train_data += data_dict[label][purpose]
+
+            shuffled_data = list(train_data)
+            random.shuffle(shuffled_data)
+
+            index = 0
+            while index < len(shuffled_data):
+                batch_data = shuffled_data[index:(index + batch_size)]
+                epoch_costs += [update_loss(batch_data,
+                                loss_function=partial(model.get_loss,
+                                                      loss_configuration_parameters=loss_configuration_parameters))]
+                n_samples_trained += batch_size
+                index += batch_size
+
+                if n_samples_trained % 50 == 0 and n_samples_trained != 0:
+                    sys.stdout.write("%s%f " % ("G", np.mean(epoch_costs[-50:])))
+                    sys.stdout.flush()
+                    if np.mean(epoch_costs[-50:]) > 100:
+                        logger.warning("Loss anomaly: epoch=%d n_samples_trained=%d mean_batch_loss=%f",
+                                       epoch_no, n_samples_trained, np.mean(epoch_costs[-50:]))
+
+            print("")
+            print("Epoch {epoch_no} Avg. loss over training set: {epoch_loss_mean}".format(epoch_no=epoch_no,
+                                                                                           epoch_loss_mean=np.mean(epoch_costs)))
+            print("Epoch {} training with the {} objective took {} seconds".format(epoch_no,
+                                                                                  model.parameters.get('crf_objective', 'nll'),
+                                                                                  time.time()-start_time))
+
+            model.trainer.status()
+
+            last_N_epochs_avg_loss_values = last_N_epochs_avg_loss_values[1:] + [np.mean(epoch_costs)]
+
+            # datasets_to_be_tested = {"ner": {"dev": data_dict["ner"]["dev"], "test": data_dict["ner"]["test"]},
+            #                          "md": {"dev": data_dict["md"]["dev"], "test": data_dict["md"]["test"]}}
+
+            datasets_to_be_tested = {label: {purpose: data_dict[label][purpose]
+                                             for purpose in ["dev", "test"] if purpose in data_dict[label]}
+                                     for label in ["ner", "md"]}
+
+            f_scores, morph_accuracies, _, test_metrics = eval_with_specific_model(model,
+                                                                     epoch_no,
+                                                                     datasets_to_be_tested,
+                                                                     return_datasets_with_predicted_labels=False,
+                                                                     eval_worker_pool=eval_worker_pool)
+
+            metrics_by_type = test_metrics[1]
+
+            if model.parameters['active_models'] in [0, 2, 3]:
+                if "dev" in f_scores["ner"]:
+                    if best_dev < f_scores["ner"]["dev"]:
+                        print("NER Epoch: %d New best dev score => best_dev, best_test: %lf %lf" % (epoch_no,
+                                                                                                           f_scores["ner"]["dev"],
+                                                                                                           f_scores["ner"]["test"]))
+                        print("NER Epoch: %d |" % epoch_no + "|".join(["%s: %2.3lf" % (entity_type, m.fscore)
+                                                           for entity_type, m in sorted(metrics_by_type.items(), key=lambda x: x[0])]))
+                        last_epoch_with_best_scores = epoch_no
+                        best_dev = f_scores["ner"]["dev"]
+                        best_test = f_scores["ner"]["test"]
+                        model.save(epoch_no)
+                        model.save_best_performances_and_costs(epoch_no,
+                                                               best_performances=[f_scores["ner"]["dev"], f_scores["ner"]["test"]],
+                                                               epoch_costs=epoch_costs)
+                        model_epoch_dir_path = "model-epoch-%08d" % epoch_no
+                        print("LOG: model_epoch_dir_path: {}".format(model_epoch_dir_path))
+                    else:
+                        print("NER Epoch: %d Best dev and accompanying test score, best_dev, best_test: %lf %lf" % (epoch_no,
+                                                                                                               best_dev,
+                                                                                                               best_test))
+                        print("NER Epoch: %d |" % epoch_no + "|".join(["%s: %2.3lf" % (entity_type, m.fscore)
+                                                            for entity_type, m in
+                                                            sorted(metrics_by_type.items(), key=lambda x: x[0])]))
+
+            if model.parameters['active_models'] in [1, 2, 3]:
+                if "dev" in morph_accuracies["md"]:
+                    if best_morph_dev < morph_accuracies["md"]["dev"]:
+                        print("MORPH Epoch: %d New best dev score => best_dev, best_test: %lf %lf" %
+                              (epoch_no, morph_accuracies["md"]["dev"], morph_accuracies["md"]["test"]))
+                        best_morph_dev = morph_accuracies["md"]["dev"]
+                        best_morph_test = morph_accuracies["md"]["test"]
+                    else:
+                        print("MORPH Epoch: %d Best dev and accompanying test score, best_dev, best_test: %lf %lf"
+                              % (epoch_no, best_morph_dev, best_morph_test))
+
+            print("Epoch {} done. Average cost: {}".format(epoch_no, np.mean(epoch_costs)))
+            print("MainTaggerModel dir: {}".format(model.model_path))
+            print("Training took {} seconds for this epoch".format(time.time()-start_time))
+
+            if epoch_no-last_epoch_with_best_scores == 0 or epoch_no < last_epoch_with_best_scores + 10:
+                print("Continue to train as the last peoch with best scores was only %d epochs before" % (epoch_no-last_epoch_with_best_scores))
+            else:
+                print("Stop training as the last epoch with best scores was %d epochs before" % (epoch_no-last_epoch_with_best_scores))
+                break
 
 
 if __name__ == "__main__":
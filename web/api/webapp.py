@@ -5,6 +5,7 @@ import os
 import tornado.ioloop
 import tornado.web
 
+from toolkit.joint_ner_and_md_model import PREDICTION_TASKS
 from utils import read_args
 from utils.evaluation import initialize_model_with_pretrained_parameters
 from utils.train import models_path
@@ -13,8 +14,13 @@ from utils.train import models_path
 class DisambiguationHandler(tornado.web.RequestHandler):
 
     model = None
+    # the webapp only returns NER tags by default, so the morphological analyses are not scored
+    # unless the NER tags depend on them
+    tasks = {"ner"}
 
-    def initialize(self, model_path, model_epoch_path):
+    def initialize(self, model_path, model_epoch_path, tasks):
+
+        DisambiguationHandler.tasks = tasks
 
         if DisambiguationHandler.model is None:
 
@@ -33,7 +39,8 @@ class DisambiguationHandler(tornado.web.RequestHandler):
 
         print(line)
 
-        labeled_sentences, dataset_file_string = predict_sentences_given_model(line, DisambiguationHandler.model)
+        labeled_sentences, dataset_file_string = predict_sentences_given_model(line, DisambiguationHandler.model,
+                                                                                tasks=DisambiguationHandler.tasks)
 
         tagger_output_dict = {}
         for i, line in enumerate(labeled_sentences['ner']['test']):
@@ -67,9 +74,23 @@ class DisambiguationHandler(tornado.web.RequestHandler):
         self.finish()
 
 
+def parse_serving_tasks(serving_tasks):
+    """
+    :param serving_tasks: comma separated names of PREDICTION_TASKS, e.g. the value of --serving_tasks
+    :return: the set of the tasks, which always contains ner as the response is made of the NER tags
+    """
+    tasks = set([task.strip() for task in serving_tasks.split(",") if len(task.strip()) > 0])
+    unknown_tasks = tasks - PREDICTION_TASKS
+    if len(unknown_tasks) > 0:
+        raise ValueError("Unknown --serving_tasks %s, the tasks should be among %s" %
+                         (",".join(sorted(unknown_tasks)), ",".join(sorted(PREDICTION_TASKS))))
+    return tasks | {"ner"}
+
+
 def make_app(opts):
     return tornado.web.Application([
-        (r"/ner/predict/", DisambiguationHandler, dict(model_path=opts.model_path, model_epoch_path=opts.model_epoch_path)),
+        (r"/ner/predict/", DisambiguationHandler, dict(model_path=opts.model_path, model_epoch_path=opts.model_epoch_path,
+                                                       tasks=parse_serving_tasks(opts.serving_tasks))),
         (r"/(.*)", tornado.web.StaticFileHandler, {"path": os.path.join(os.path.curdir, "./web/public_html/")})
     ])
 